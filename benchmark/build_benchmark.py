@@ -0,0 +1,73 @@
+"""
+Compare serial circuit building (create.ntor, one after another) with
+extend.build_circuits, against an in-process fake guard relay answering
+after a simulated round trip time (see benchmark/fake_relay.py).
+
+Usage: python -m benchmark.build_benchmark [-n circuits] [-c concurrency]
+           [--rtt ms]
+"""
+import argparse
+import threading
+import asyncio
+import time
+
+import lightnion as lnn
+
+from benchmark import fake_relay
+
+
+def start_relay(delay):
+    ready = []
+
+    async def serve():
+        relay = fake_relay.relay(delay=delay)
+        await relay.start()
+        ready.append(relay)
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    while len(ready) == 0:
+        time.sleep(0.01)
+    return ready[0]
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main(argv):
+    relay = start_relay(argv.rtt / 1e3)
+    link = lnn.link.initiate(relay.host, relay.port)
+
+    start = time.perf_counter()
+    for _ in range(argv.n):
+        lnn.create.ntor(link, relay.guard)
+    serial = time.perf_counter() - start
+    print('serial: {:.0f} circuits/s'.format(argv.n / serial))
+
+    paths = [[relay.guard] for _ in range(argv.n)]
+    start = time.perf_counter()
+    results = lnn.extend.build_circuits(link, paths, concurrency=argv.c)
+    parallel = time.perf_counter() - start
+
+    timings = [result.timings[0] for result in results if result.ok]
+    print('build_circuits: {:.0f} circuits/s (concurrency {}, {} failed)'.format(
+        argv.n / parallel, argv.c, len(results) - len(timings)))
+    print('  first hop: p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        percentile(timings, 50) * 1e3, percentile(timings, 99) * 1e3))
+    link.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200,
+        help='Circuits built. (default: 200)')
+    parser.add_argument('-c', type=int, default=32,
+        help='Circuits built at once. (default: 32)')
+    parser.add_argument('--rtt', type=float, default=20,
+        help='Simulated round trip time, in ms. (default: 20)')
+
+    main(parser.parse_args())
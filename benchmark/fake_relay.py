@@ -0,0 +1,195 @@
+"""
+In-process fake tor relay (OR) for benchmarks, no network nor chutney needed.
+
+It performs the link handshake expected by lightnion.proxy.link.Link and
+lightnion.link.initiate (VERSIONS, CERTS, AUTH_CHALLENGE, NETINFO), answers CREATE_FAST and CREATE2
+(real ntor handshake), and echoes RELAY cells back as they are (no onion
+layer is removed, only the proxy in between is measured).
+
+Usage: python -m benchmark.fake_relay [port]
+"""
+import logging
+import asyncio
+import secrets
+import base64
+import ssl
+import os
+
+import nacl.public
+
+import lightnion as lnn
+import lightnion.utils
+import lightnion.crypto
+
+tools = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools')
+
+cmd_padding = int(lnn.cell.cmd.PADDING)
+cmd_relay = int(lnn.cell.cmd.RELAY)
+cmd_relay_early = int(lnn.cell.cmd.RELAY_EARLY)
+cmd_destroy = int(lnn.cell.cmd.DESTROY)
+cmd_create_fast = int(lnn.cell.cmd.CREATE_FAST)
+cmd_created_fast = int(lnn.cell.cmd.CREATED_FAST)
+cmd_create2 = int(lnn.cell.cmd.CREATE2)
+cmd_created2 = int(lnn.cell.cmd.CREATED2)
+cmd_certs = int(lnn.cell.cmd.CERTS)
+cmd_auth_challenge = int(lnn.cell.cmd.AUTH_CHALLENGE)
+
+
+def _variable_cell(cmd, payload):
+    return bytes(4) + bytes([cmd]) + len(payload).to_bytes(2, 'big') + payload
+
+
+def _fixed_cell(circuit_id, cmd, payload):
+    return lnn.utils.cell_pad_null(circuit_id.to_bytes(4, 'big') + bytes([cmd]) + payload)
+
+
+class relay:
+    """
+    Fake guard relay, see relay.guard for its descriptor.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, certfile=None, keyfile=None, delay=0):
+        self.host = host
+        self.port = port
+
+        # (answers are sent after `delay` seconds, to mimic a distant relay)
+        self.delay = delay
+
+        if certfile is None:
+            certfile = os.path.join(tools, 'cert.pem')
+            keyfile = os.path.join(tools, 'key.pem')
+
+        self.ctxt = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ctxt.load_cert_chain(certfile, keyfile)
+
+        self.identity = secrets.token_bytes(20)
+        self.onion_key = nacl.public.PrivateKey.generate()
+
+        self.server = None
+        self.connections = dict()
+
+        # Circuits created (and not destroyed yet), RELAY cells echoed.
+        self.circuits = set()
+        self.cells = 0
+
+    @property
+    def guard(self):
+        """
+        Descriptor of the relay, as used by the proxy and the clients.
+        """
+        identity = str(base64.b64encode(self.identity), 'utf8').rstrip('=')
+        onion_key = str(base64.b64encode(bytes(self.onion_key.public_key)), 'utf8').rstrip('=')
+        return {
+            'digest': self.identity.hex().upper(),
+            'router': {
+                'nickname': 'fakerelay',
+                'address': self.host,
+                'orport': self.port,
+                'identity': identity},
+            'ntor-onion-key': onion_key}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handler, self.host, self.port, ssl=self.ctxt)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info('Fake relay listening on %s:%d.', self.host, self.port)
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.connections.values():
+            writer.close()
+
+        # (let the handlers see their connection closed)
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=1)
+        await self.server.wait_closed()
+
+    def _answer(self, cell):
+        """
+        :param cell: cell received from the proxy.
+        :return: cell to send back, None if nothing.
+        """
+        circuit_id, cmd = lnn.utils.cell_header_unpack(cell)
+
+        if cmd == cmd_relay or cmd == cmd_relay_early:
+            self.cells += 1
+            return _fixed_cell(circuit_id, cmd_relay, bytes(cell[5:lnn.constants.full_cell_len]))
+
+        if cmd == cmd_create2:
+            length = int.from_bytes(cell[7:9], 'big')
+            answer = lnn.crypto.ntor.server(self.onion_key, self.identity,
+                bytes(cell[9:9 + length]), length=92)
+            if answer is None:
+                return _fixed_cell(circuit_id, cmd_destroy, bytes([int(lnn.cell.destroy.reason.PROTOCOL)]))
+
+            self.circuits.add(circuit_id)
+            _, message = answer
+            return _fixed_cell(circuit_id, cmd_created2, len(message).to_bytes(2, 'big') + message)
+
+        if cmd == cmd_create_fast:
+            material = bytes(cell[5:5 + 20])
+            derivative = secrets.token_bytes(20)
+            key_hash = lnn.crypto.kdf_tor(material + derivative).key_hash
+
+            self.circuits.add(circuit_id)
+            return _fixed_cell(circuit_id, cmd_created_fast, derivative + key_hash)
+
+        if cmd == cmd_destroy:
+            self.circuits.discard(circuit_id)
+
+        # (NETINFO, PADDING...)
+        return None
+
+    async def _handler(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+
+        # VERSIONS (with a 2-byte circuit id)
+        header = await reader.readexactly(5)
+        await reader.readexactly(int.from_bytes(header[3:5], 'big'))
+        writer.write(lnn.utils.cell_version_build([4, 5]))
+
+        # CERTS, AUTH_CHALLENGE and NETINFO, at once (read at once by Link)
+        # (one placeholder certificate, both authentication methods)
+        writer.write(_variable_cell(cmd_certs, b'\x01\x02\x00\x04' + secrets.token_bytes(4))
+            + _variable_cell(cmd_auth_challenge, secrets.token_bytes(32) + b'\x00\x02\x00\x01\x00\x03')
+            + lnn.utils.cell_netinfo_build(self.host))
+        await writer.drain()
+
+        buffer = lnn.utils.cell_buffer()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+
+                buffer.feed(data)
+                answers = []
+                for cell in buffer.cells():
+                    answer = self._answer(cell)
+                    if answer is not None:
+                        answers.append(answer)
+
+                if answers and self.delay > 0:
+                    asyncio.get_running_loop().call_later(self.delay, writer.write, b''.join(answers))
+                elif answers:
+                    writer.write(b''.join(answers))
+                    await writer.drain()
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+
+
+async def main(port):
+    fake = relay(port=port)
+    await fake.start()
+    print('Fake relay on 127.0.0.1:{}'.format(fake.port))
+    print(fake.guard)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 0))
@@ -0,0 +1,72 @@
+"""
+Dispatch throughput of lightnion.link.link with many registered circuits,
+no network needed: cells are fed by a fake io, then read back from each
+circuit in turn.
+
+Usage: python -m benchmark.link_benchmark [cells]
+"""
+import threading
+import queue
+import time
+import sys
+import os
+
+import lightnion as lnn
+
+
+class fake_io:
+    def __init__(self):
+        self.cells = queue.Queue()
+        self.dead = False
+
+    def recv(self, block=True):
+        return self.cells.get(block=block)
+
+    def send(self, cell, block=True):
+        pass
+
+    def close(self):
+        self.dead = True
+
+
+def measure(circuits, cells, batch=64):
+    io = fake_io()
+    link = lnn.link.link(io, 5)
+
+    registered = [lnn.create.circuit(0x80000001 + i, None) for i in range(circuits)]
+    for circuit in registered:
+        link.register(circuit)
+
+    payloads = [c.id.to_bytes(4, 'big') + bytes([3]) + os.urandom(509)
+        for c in registered[:batch]]
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(cells // batch):
+        for payload in payloads:
+            io.cells.put(payload)
+        for circuit in registered[:batch]:
+            link.get(circuit)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    # (idle: a reader waiting on one circuit, nothing coming)
+    reader = threading.Thread(target=lambda: link.get(registered[0]), daemon=True)
+    reader.start()
+    idle = time.process_time()
+    time.sleep(1)
+    idle = time.process_time() - idle
+
+    io.cells.put(payloads[0])
+    reader.join()
+    link.close()
+    return (cells // batch) * batch / elapsed, idle
+
+
+if __name__ == '__main__':
+    cells = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print('{:>9} {:>10} {:>16}'.format('circuits', 'cells/s', 'idle CPU s/s'))
+    for circuits in (64, 1024, 8192):
+        rate, idle = measure(circuits, cells)
+        print('{:>9} {:>10.0f} {:>16.3f}'.format(circuits, rate, idle))
@@ -0,0 +1,173 @@
+"""
+Load the proxy with a swarm of websocket clients, against an in-process fake
+guard relay (see benchmark/fake_relay.py): no network nor chutney needed.
+
+Each client opens a one-shot channel (websocket on /channels), performs a
+CREATE2 handshake with the fake relay through the proxy, then sends RELAY
+cells (at most `window` in flight) that the relay echoes back.
+
+Usage: python -m benchmark.load_benchmark [-n channels] [-c concurrency]
+           [--cells n] [--window n]
+"""
+import argparse
+import asyncio
+import base64
+import time
+
+import websockets
+
+import lightnion as lnn
+import lightnion.proxy
+import lightnion.crypto
+
+from benchmark import fake_relay
+
+ws_port = 18766
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def start_proxy(guard):
+    link = lnn.proxy.link.Link(guard)
+    channel_manager = lnn.proxy.jobs.ChannelManager()
+    websocket_manager = lnn.proxy.jobs.WebsocketManager(port=ws_port)
+
+    link.set_channel_manager(channel_manager)
+    channel_manager.set_link(link)
+    websocket_manager.set_channel_manager(channel_manager)
+
+    def factory(select_path, auth):
+        answer = channel_manager.create_channel(None, None, select_path=True)
+        return answer['id'], '{}'
+
+    websocket_manager.set_channel_factory(factory)
+
+    tasks = [asyncio.create_task(link.connection), asyncio.create_task(channel_manager.reap())]
+    await websocket_manager.serve()
+    return websocket_manager, tasks
+
+
+class stats:
+    def __init__(self):
+        self.opened = 0
+        self.failed = 0
+        self.cells = 0
+        self.open_latency = []
+        self.cell_latency = []
+
+
+async def client(guard, stats, cells, window):
+    identity = base64.b64decode(guard['router']['identity'] + '====')
+    onion_key = base64.b64decode(guard['ntor-onion-key'] + '====')
+    circuit_id = lnn.proxy.fake_circuit_id
+
+    uri = 'ws://127.0.0.1:{}{}/channels?select_path=true'.format(ws_port, lnn.proxy.base_url)
+
+    start = time.perf_counter()
+    async with websockets.connect(uri, compression=None) as ws:
+        # (CREATE2 is pipelined with the opening of the channel)
+        keys, handshake = lnn.crypto.ntor.hand(identity, onion_key)
+        await ws.send(lnn.create.ntor_raw2(circuit_id, handshake))
+
+        await ws.recv() # (channel information)
+        created = await ws.recv()
+        if lnn.utils.cell_get_cmd(created) != int(lnn.cell.cmd.CREATED2):
+            stats.failed += 1
+            return
+
+        length = int.from_bytes(created[5:7], 'big')
+        if lnn.crypto.ntor.shake(keys, created[7:7 + length], identity, onion_key, length=92) is None:
+            stats.failed += 1
+            return
+
+        stats.opened += 1
+        stats.open_latency.append(time.perf_counter() - start)
+
+        header = circuit_id.to_bytes(4, 'big') + bytes([int(lnn.cell.cmd.RELAY)])
+        padding = bytes(509 - 4)
+        sent = dict()
+        in_flight = asyncio.Semaphore(window)
+
+        async def sender():
+            for seq in range(cells):
+                await in_flight.acquire()
+                sent[seq] = time.perf_counter()
+                await ws.send(header + seq.to_bytes(4, 'big') + padding)
+
+        task = asyncio.create_task(sender())
+        for _ in range(cells):
+            cell = await ws.recv()
+            seq = int.from_bytes(cell[5:9], 'big')
+            stats.cell_latency.append(time.perf_counter() - sent.pop(seq))
+            stats.cells += 1
+            in_flight.release()
+        await task
+
+
+async def swarm(guard, stats, channels, concurrency, cells, window):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            try:
+                await client(guard, stats, cells, window)
+            except (OSError, websockets.exceptions.WebSocketException):
+                stats.failed += 1
+
+    await asyncio.gather(*[one() for _ in range(channels)])
+
+
+async def main(argv):
+    relay = fake_relay.relay()
+    await relay.start()
+
+    websocket_manager, tasks = await start_proxy(relay.guard)
+    await asyncio.sleep(0.5) # (link handshake)
+
+    # Channels only: open then close.
+    opening = stats()
+    start = time.perf_counter()
+    await swarm(relay.guard, opening, argv.n, argv.c, 0, 1)
+    open_elapsed = time.perf_counter() - start
+
+    # Cells: one channel per client, echo cells.
+    relaying = stats()
+    start = time.perf_counter()
+    await swarm(relay.guard, relaying, argv.c, argv.c, argv.cells, argv.window)
+    cells_elapsed = time.perf_counter() - start
+
+    await asyncio.sleep(0.5) # (last DESTROY cells)
+
+    print('channels: {} opened, {} failed, {:.0f} channels/s ({} clients)'.format(
+        opening.opened, opening.failed, opening.opened / open_elapsed, argv.c))
+    print('  open latency: p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        percentile(opening.open_latency, 50) * 1e3, percentile(opening.open_latency, 99) * 1e3))
+    print('cells: {} echoed, {:.0f} cells/s ({} clients, window {})'.format(
+        relaying.cells, relaying.cells / cells_elapsed, argv.c, argv.window))
+    print('  cell latency: p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        percentile(relaying.cell_latency, 50) * 1e3, percentile(relaying.cell_latency, 99) * 1e3))
+    print('circuits left open on the relay: {}'.format(len(relay.circuits)))
+
+    for task in tasks:
+        task.cancel()
+    await websocket_manager.stop()
+    await relay.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000,
+        help='Channels opened. (default: 2000)')
+    parser.add_argument('-c', type=int, default=100,
+        help='Concurrent clients. (default: 100)')
+    parser.add_argument('--cells', type=int, default=1000,
+        help='RELAY cells echoed per client. (default: 1000)')
+    parser.add_argument('--window', type=int, default=16,
+        help='RELAY cells in flight per client. (default: 16)')
+
+    asyncio.run(main(parser.parse_args()))
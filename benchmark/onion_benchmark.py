@@ -0,0 +1,117 @@
+"""
+Onion encryption throughput (onion.build and onion.peel) per circuit depth,
+no network needed: backward cells are built by a mirrored relay-side state.
+
+With --batch n, cells go through onion.build_many and onion.peel_many by
+batches of n cells.
+
+With --keystream, compare the cost of one AES-CTR layer per cell (as done
+by onion._ctr) with a XOR against a keystream generated ahead of time.
+
+Usage: python -m benchmark.onion_benchmark [cells] [--batch n] [--keystream]
+"""
+import collections
+import secrets
+import time
+import sys
+
+import lightnion as lnn
+import lightnion.crypto
+
+material = collections.namedtuple('material', ['forward_key', 'backward_key',
+    'forward_digest', 'backward_digest'])
+
+
+def states(depth):
+    client, relay = None, None
+    for _ in range(depth):
+        keys = lnn.crypto.kdf_tor(secrets.token_bytes(32))
+        mirror = material(keys.backward_key, keys.forward_key,
+            keys.backward_digest, keys.forward_digest)
+
+        layers = [
+            lnn.onion.state(None, lnn.create.circuit(0x80000001, keys)),
+            lnn.onion.state(None, lnn.create.circuit(0x80000001, mirror))]
+        if client is None:
+            client, relay = layers
+        else:
+            client.wrap(layers[0])
+            relay.wrap(layers[1])
+
+    return client, relay
+
+
+def measure(depth, cells, batch=None):
+    client, relay = states(depth)
+    payload = bytes(lnn.constants.payload_len - 11) # (full RELAY_DATA)
+    command = lnn.cell.relay.cmd.RELAY_DATA
+
+    start = time.perf_counter()
+    if batch is None:
+        for _ in range(cells):
+            client, cell = lnn.onion.build(client, command, payload, 1)
+    else:
+        for _ in range(cells // batch):
+            client, built = lnn.onion.build_many(client, command, [payload] * batch, 1)
+    build = cells / (time.perf_counter() - start)
+
+    backward = []
+    for _ in range(cells):
+        relay, cell = lnn.onion.build(relay, command, payload, 1)
+        backward.append(lnn.cell.relay.cell(cell.raw))
+
+    start = time.perf_counter()
+    if batch is None:
+        for cell in backward:
+            client, cell = lnn.onion.peel(client, cell)
+    else:
+        for index in range(0, cells - batch + 1, batch):
+            client, peeled = lnn.onion.peel_many(client, backward[index:index + batch])
+    peel = cells / (time.perf_counter() - start)
+
+    return build, peel
+
+
+def keystream(cells, batch=1):
+    payload = secrets.token_bytes(lnn.constants.payload_len * batch)
+    context = lnn.onion._ctr(secrets.token_bytes(16))
+
+    start = time.perf_counter()
+    for _ in range(cells // batch):
+        context.update(payload)
+    cipher = (time.perf_counter() - start) / cells
+
+    # (keystream generated ahead, 64 KiB at once, then XORed)
+    prefetched = memoryview(context.update(bytes(1 << 16)))
+    width = len(payload)
+
+    start = time.perf_counter()
+    index = 0
+    for _ in range(cells // batch):
+        if index + width > len(prefetched):
+            index = 0
+        stream = prefetched[index:index + width]
+        (int.from_bytes(payload, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(width, 'big')
+        index += width
+    xor = (time.perf_counter() - start) / cells
+
+    return cipher, xor
+
+
+if __name__ == '__main__':
+    if '--keystream' in sys.argv:
+        print('{:>6} {:>16} {:>16}'.format('batch', 'AES-CTR us/cell', 'XOR us/cell'))
+        for batch in (1, 32):
+            cipher, xor = keystream(200000, batch)
+            print('{:>6} {:>16.3f} {:>16.3f}'.format(batch, cipher * 1e6, xor * 1e6))
+        sys.exit(0)
+
+    cells = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 20000
+    batch = None
+    if '--batch' in sys.argv:
+        batch = int(sys.argv[sys.argv.index('--batch') + 1])
+
+    print('{:>5} {:>14} {:>14}'.format('hops', 'build cells/s', 'peel cells/s'))
+    for depth in (1, 2, 3):
+        build, peel = measure(depth, cells, batch)
+        print('{:>5} {:>14.0f} {:>14.0f}'.format(depth, build, peel))
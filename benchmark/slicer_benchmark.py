@@ -0,0 +1,109 @@
+"""
+Cell slicing micro-benchmark over a realistic stream: mostly fixed-size
+cells, with variable-length ones (VERSIONS, CERTS, AUTH_CHALLENGE, VPADDING)
+here and there, read by chunks of various sizes.
+
+Compares lnn.utils.cell_buffer (iterative, offset-based) with the recursive
+slicer that lightnion.socket used to have (kept below as a reference).
+
+Usage: python -m benchmark.slicer_benchmark [cells]
+"""
+import random
+import time
+import sys
+import os
+
+import lightnion as lnn
+import lightnion.utils
+
+
+def recursive_slice(payload, once=False):
+    # (reference: former lightnion.socket.cell_slice)
+    cell_header = lnn.cell.header(payload)
+    if len(payload) < cell_header.width:
+        return [], payload, True
+
+    if not cell_header.valid:
+        raise RuntimeError('Invalid cell header: {}'.format(cell_header.raw))
+
+    length = cell_header.width + lnn.constants.payload_len
+    if not cell_header.cmd.is_fixed:
+        cell_header = lnn.cell.header_variable(payload)
+        if len(payload) < cell_header.width:
+            return [], payload, True
+
+        if not cell_header.valid:
+            raise RuntimeError(
+                'Invalid variable cell header: {}'.format(cell_header.raw))
+
+        length = cell_header.width + cell_header.length
+
+    if len(payload) < length:
+        return [], payload, True
+
+    cells = [payload[:length]]
+    payload = payload[length:]
+    celling = False
+
+    if once:
+        return cells, payload, celling
+
+    while not celling and len(payload) > 0:
+        new_cells, payload, celling = recursive_slice(payload, once=True)
+        cells += new_cells
+    return cells, payload, celling
+
+
+def stream(count, seed=42):
+    rng = random.Random(seed)
+    variable = [(7, 4), (129, 1500), (130, 40), (128, 200)]
+
+    cells = []
+    for _ in range(count):
+        if rng.random() < 0.05:
+            cmd, length = rng.choice(variable)
+            cells.append(bytes(4) + bytes([cmd]) + length.to_bytes(2, 'big')
+                + os.urandom(length))
+        else:
+            cells.append((0x80000001).to_bytes(4, 'big') + bytes([3]) + os.urandom(509))
+    return cells
+
+
+def run_buffer(chunks):
+    buffer = lnn.utils.cell_buffer()
+    sliced = 0
+    for chunk in chunks:
+        buffer.feed(chunk)
+        for cell in buffer.cells():
+            bytes(cell)
+            sliced += 1
+    return sliced
+
+
+def run_recursive(chunks):
+    pending = b''
+    sliced = 0
+    for chunk in chunks:
+        cells, pending, _ = recursive_slice(pending + chunk)
+        sliced += len(cells)
+    return sliced
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cells = stream(count)
+    data = b''.join(cells)
+
+    print('{:>7} {:>18} {:>18}'.format('read', 'recursive cells/s', 'cell_buffer cells/s'))
+    for size in (4096, 16384, 65536):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+        rates = []
+        for run in (run_recursive, run_buffer):
+            try:
+                start = time.perf_counter()
+                assert run(chunks) == len(cells)
+                rates.append('{:.0f}'.format(len(cells) / (time.perf_counter() - start)))
+            except RecursionError:
+                rates.append('RecursionError')
+        print('{:>7} {:>18} {:>18}'.format(size, *rates))
@@ -0,0 +1,70 @@
+"""
+Round-trip latency and throughput of the client link (lightnion.link and
+lightnion.socket.io) against an in-process fake guard relay (see
+benchmark/fake_relay.py), which echoes RELAY cells back.
+
+Usage: python -m benchmark.socket_benchmark [cells]
+"""
+import threading
+import asyncio
+import time
+import sys
+
+import lightnion as lnn
+
+from benchmark import fake_relay
+
+
+def start_relay():
+    ready = []
+
+    async def serve():
+        relay = fake_relay.relay()
+        await relay.start()
+        ready.append(relay.port)
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    while len(ready) == 0:
+        time.sleep(0.01)
+    return ready[0]
+
+
+def main(cells):
+    link = lnn.link.initiate('127.0.0.1', start_relay())
+    circuit = lnn.create.fast(link).circuit
+    cell = circuit.id.to_bytes(4, 'big') + bytes([int(lnn.cell.cmd.RELAY)]) + bytes(509)
+
+    latency = []
+    for _ in range(500):
+        start = time.perf_counter()
+        link.send(cell)
+        link.get(circuit)
+        latency.append(time.perf_counter() - start)
+    latency.sort()
+
+    def sender():
+        for _ in range(cells):
+            link.send(cell)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=sender)
+    thread.start()
+    for _ in range(cells):
+        link.get(circuit)
+    elapsed = time.perf_counter() - start
+    thread.join()
+
+    idle = time.process_time()
+    time.sleep(2)
+    idle = (time.process_time() - idle) / 2
+
+    print('round trip: p50 {:.3f} ms, p99 {:.3f} ms'.format(
+        latency[len(latency) // 2] * 1e3, latency[int(len(latency) * 0.99)] * 1e3))
+    print('throughput: {:.0f} cells/s'.format(cells / elapsed))
+    print('idle CPU: {:.3f} s/s'.format(idle))
+    link.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
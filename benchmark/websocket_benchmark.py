@@ -0,0 +1,113 @@
+"""
+Compare the dedicated websocket server of the proxy with the websocket route
+of its HTTP server (same port as the API), on a loopback link: cells sent by
+the client come back on the same channel.
+
+Usage: python -m benchmark.websocket_benchmark [cells] [--multicell]
+"""
+import asyncio
+import time
+import sys
+
+import quart
+import websockets
+import hypercorn.asyncio
+import hypercorn.config
+
+import lightnion as lnn
+import lightnion.proxy
+
+http_port = 14990
+ws_port = 18765
+
+
+class loopback_link:
+    guard = {'digest': 'AAAAAAAAAAAAAAAAAAAAAAAAAAA'}
+
+    def __init__(self):
+        self.to_send = lnn.proxy.scheduler.CircuitScheduler()
+        self.circuit_id = 0x80000000
+        self.channel_manager = None
+
+    def gen_cid(self):
+        self.circuit_id += 1
+        return self.circuit_id
+
+    async def schedule_to_send(self, cell, channel):
+        await self.channel_manager.schedule_to_send(bytearray(cell), channel.cid)
+
+
+def prepare():
+    link = loopback_link()
+    channel_manager = lnn.proxy.jobs.ChannelManager(channel_queue=1 << 20)
+    channel_manager.set_link(link)
+    link.channel_manager = channel_manager
+
+    websocket_manager = lnn.proxy.jobs.WebsocketManager(port=ws_port)
+    websocket_manager.set_channel_manager(channel_manager)
+
+    app = quart.Quart(__name__)
+
+    @app.websocket(lnn.proxy.base_url + '/channels/<uid>')
+    async def channel_websocket(uid):
+        ws = lnn.proxy.jobs.QuartWebsocket(quart.websocket._get_current_object())
+        await ws.accept()
+        await websocket_manager.handle(ws, quart.websocket.path)
+
+    return channel_manager, websocket_manager, app
+
+
+async def measure(channel_manager, port, cells, multicell):
+    token = channel_manager.create_channel(None, None, select_path=True)['id']
+    uri = 'ws://127.0.0.1:{}{}/channels/{}'.format(port, lnn.proxy.base_url, token)
+
+    cell = lnn.proxy.fake_circuit_id.to_bytes(4, 'big') + bytes([3]) + bytes(509)
+    subprotocols = None
+    per_frame = 1
+    if multicell:
+        subprotocols = [lnn.proxy.multicell_subprotocol]
+        per_frame = 32
+
+    async with websockets.connect(uri, subprotocols=subprotocols,
+            compression=None, max_size=None) as ws:
+        async def sender():
+            for _ in range(cells // per_frame):
+                await ws.send(cell * per_frame)
+
+        start = time.perf_counter()
+        task = asyncio.create_task(sender())
+
+        received = 0
+        while received < (cells // per_frame) * per_frame:
+            received += len(await ws.recv()) // len(cell)
+
+        elapsed = time.perf_counter() - start
+        await task
+
+    return cells / elapsed
+
+
+async def main(cells, multicell):
+    channel_manager, websocket_manager, app = prepare()
+
+    await websocket_manager.serve()
+
+    config = hypercorn.config.Config()
+    config.bind = ['127.0.0.1:{}'.format(http_port)]
+    shutdown = asyncio.Event()
+    server = asyncio.create_task(hypercorn.asyncio.serve(app, config,
+        shutdown_trigger=shutdown.wait))
+    await asyncio.sleep(0.5)
+
+    for name, port in [('dedicated', ws_port), ('http port', http_port)]:
+        rate = await measure(channel_manager, port, cells, multicell)
+        print('{:>10}: {:>10.0f} cells/s'.format(name, rate))
+
+    shutdown.set()
+    await server
+    await websocket_manager.stop()
+
+
+if __name__ == '__main__':
+    cells = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 20000
+    asyncio.run(main(cells, '--multicell' in sys.argv))
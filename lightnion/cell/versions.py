@@ -36,9 +36,7 @@ def pack(versions):
     vercell.set(versions=versions)
     return vercell
 
-def recv(peer):
-    answer = peer.recv(_cell.header_legacy_view.width())
-
+def _length(answer):
     header = _cell.header_legacy(answer)
     if not header.valid:
         raise RuntimeError('Invalid v2 cell header: {}'.format(header.raw))
@@ -48,13 +46,23 @@ def recv(peer):
     length = header.length
     if length > constants.max_payload_len:
         raise RuntimeError('VERSIONS cell too long: {}'.format(header.length))
+    return length
 
-    answer += peer.recv(length)
+def _cell_of(answer):
     if not view.valid(answer):
         raise RuntimeError('Invalid VERSIONS cell: {}'.format(answer))
-
     return cell(answer)
 
+def recv(peer):
+    answer = peer.recv(_cell.header_legacy_view.width())
+    answer += peer.recv(_length(answer))
+    return _cell_of(answer)
+
+async def recv_async(reader):
+    answer = await reader.readexactly(_cell.header_legacy_view.width())
+    answer += await reader.readexactly(_length(answer))
+    return _cell_of(answer)
+
 def send(peer, payload):
     try:
         payload = payload.raw
@@ -24,6 +24,27 @@ class circuit(collections.namedtuple('circuit', ['id', 'material'])):
         return self.queue.get(block=block)
 
 
+def _pick_id(link):
+    # Pick an available ID (link version > 3)
+    link.last_id += 1
+    circuit_id = 0x80000000 + link.last_id
+    while circuit_id in link.circuits or circuit_id in link.reserved:
+        circuit_id += 1
+
+    # Sanity checks
+    try:
+        packed = lnn.cell.view.uint(4).write(value=circuit_id)
+        assert circuit_id == lnn.cell.view.uint(4).value(packed)
+    except (OverflowError, AssertionError):
+        link.last_id = 0
+        raise RuntimeError('Erroneous circuit ID: {} ({})'.format(
+            circuit_id, packed))
+
+    # (answers received before registration are kept, see link.link)
+    link.reserve(circuit_id)
+    return circuit_id
+
+
 async def fast_async(link):
     """Use a CREATE_FAST cell to initiate a one-hop circuit.
 
@@ -47,20 +68,7 @@ async def fast_async(link):
     :returns: a onion.state object, see: onion.state
     """
 
-    # Pick an available ID (link version > 3)
-    link.last_id += 1
-    circuit_id = 0x80000000 + link.last_id
-    while circuit_id in link.circuits:
-        circuit_id += 1
-
-    # Sanity checks
-    try:
-        packed = lnn.cell.view.uint(4).write(value=circuit_id)
-        assert circuit_id == lnn.cell.view.uint(4).value(packed)
-    except (OverflowError, AssertionError):
-        link.last_id = 0
-        raise RuntimeError('Erroneous circuit ID: {} ({})'.format(
-            circuit_id, packed))
+    circuit_id = _pick_id(link)
 
     # Send CREATE_FAST cell (contains OP material)
     op_cell = lnn.cell.create_fast.pack(circuit_id)
@@ -121,20 +129,7 @@ def fast(link):
     :returns: a onion.state object, see: onion.state
     """
 
-    # Pick an available ID (link version > 3)
-    link.last_id += 1
-    circuit_id = 0x80000000 + link.last_id
-    while circuit_id in link.circuits:
-        circuit_id += 1
-
-    # Sanity checks
-    try:
-        packed = lnn.cell.view.uint(4).write(value=circuit_id)
-        assert circuit_id == lnn.cell.view.uint(4).value(packed)
-    except (OverflowError, AssertionError):
-        link.last_id = 0
-        raise RuntimeError('Erroneous circuit ID: {} ({})'.format(
-            circuit_id, packed))
+    circuit_id = _pick_id(link)
 
     # Send CREATE_FAST cell (contains OP material)
     op_cell = lnn.cell.create_fast.pack(circuit_id)
@@ -173,20 +168,7 @@ def fast(link):
 
 
 def ntor_raw(link, payload, timeout=None):
-    # Pick an available ID (link version > 3)
-    link.last_id += 1
-    circuit_id = 0x80000000 + link.last_id
-    while circuit_id in link.circuits:
-        circuit_id += 1
-
-    # Sanity checks
-    try:
-        packed = lnn.cell.view.uint(4).write(value=circuit_id)
-        assert circuit_id == lnn.cell.view.uint(4).value(packed)
-    except (OverflowError, AssertionError):
-        link.last_id = 0
-        raise RuntimeError('Erroneous circuit ID: {} ({})'.format(
-            circuit_id, packed))
+    circuit_id = _pick_id(link)
 
     # Build a CREATE2 cell containing this first handshake part
     handshake = lnn.cell.create2.pack(circuit_id, payload)
@@ -206,7 +188,9 @@ def ntor_raw2(circuit_id, payload):
 
 # Was in the method above, before.
 def ntor_handshake(link, circuit_id, handshake, timeout=None):
-    link.send(handshake)
+    # (handshake is None if the CREATE2 cell was already sent)
+    if handshake is not None:
+        link.send(handshake)
 
     # (register a dummy circuit first to reuse the circuit API)
     dummy = circuit(circuit_id, None)
@@ -239,6 +223,34 @@ def ntor_handshake(link, circuit_id, handshake, timeout=None):
     return cell.created2.data
 
 
+async def ntor_handshake_async(link, circuit_id, handshake):
+    # (handshake is None if the CREATE2 cell was already sent)
+    if handshake is not None:
+        await link.send_async(handshake)
+
+    # (register a dummy circuit first to reuse the circuit API)
+    dummy = circuit(circuit_id, None)
+    await link.register_async(dummy)
+
+    # Receive answers
+    try:
+        cell = lnn.cell.created2.cell(await link.get_async(dummy))
+    except KeyError:
+        raise RuntimeError('Got DESTROY cell while creating circuit.')
+
+    # (unregister the dummy circuit before validation/material confirmation)
+    await link.unregister_async(dummy)
+    if not cell.valid:
+        raise RuntimeError('Got invalid CREATED2 cell: {}'.format(cell.raw))
+
+    return cell.created2.data
+
+
+async def ntor_raw_async(link, payload):
+    circuit_id, handshake = ntor_raw(link, payload)
+    return circuit_id, await ntor_handshake_async(link, circuit_id, handshake)
+
+
 async def ntor_async(link, descriptor):
     identity = base64.b64decode(descriptor['router']['identity'] + '====')
     onion_key = base64.b64decode(descriptor['ntor-onion-key'] + '====')
@@ -353,6 +353,79 @@ def parse_descriptors(descriptors, flavor='microdesc'):
     return fields, descriptors
 
 
+class incremental_parser:
+    """
+        Parse descriptors as they are downloaded (see hop.directory_stream):
+        each complete descriptor is parsed once, without waiting for (nor
+        keeping) the whole answer.
+    """
+
+    def __init__(self, flavor='microdesc'):
+        if flavor not in ['microdesc', 'unflavored']:
+            raise NotImplementedError(
+                'Consensus flavor "{}" not supported.'.format(flavor))
+
+        self.flavor = flavor
+        self.http = None
+        self.buffer = b''
+
+        # (descriptors start with their pivot field, see compute_descriptor_digest)
+        self.pivot = b'\nonion-key\n'
+        if flavor == 'unflavored':
+            self.pivot = b'\nrouter '
+
+    def _parse(self, descriptors):
+        nbdesc = descriptors.count(b'onion-key\n-----BEGIN')
+
+        descriptors, entries = consume_descriptors(descriptors, self.flavor)
+        if entries is None:
+            entries = []
+
+        if not len(entries) == nbdesc or descriptors not in [b'', b'\n']:
+            raise RuntimeError(
+                'Unexpected or corrupted descriptor? ({}/{} found)'.format(
+                    len(entries), nbdesc))
+
+        # Add flavor for convenience
+        for entry in entries:
+            entry['flavor'] = self.flavor
+        return entries
+
+    def feed(self, data):
+        """
+            :param bytes data: next chunk of the answer.
+
+            :returns: list of the descriptors completed by this chunk
+        """
+        self.buffer += data
+        if self.http is None:
+            if b'\r\n\r\n' not in self.buffer:
+                return []
+
+            self.buffer, self.http = consensus.consume_http(self.buffer)
+            if self.http is None:
+                raise RuntimeError('Expecting HTTP headers.')
+
+        # (the last descriptor may still be incomplete)
+        pivot = self.buffer.rfind(self.pivot)
+        if pivot < 0:
+            return []
+
+        descriptors = self.buffer[:pivot + 1]
+        self.buffer = self.buffer[pivot + 1:]
+        return self._parse(descriptors)
+
+    def close(self):
+        """
+            :returns: list of the remaining descriptors
+        """
+        if self.http is None:
+            raise RuntimeError('Expecting HTTP headers.')
+
+        descriptors, self.buffer = self.buffer, b''
+        return self._parse(descriptors)
+
+
 def batch_query(items, prefix, separator='-', fixed_max_length=4096-128):
     # About batches:
     #    https://github.com/plcp/tor-scripts/blob/master/torspec/dir-spec-4d0d42f.txt#L3392
@@ -543,7 +616,8 @@ def _download_raw_by_digests(host, port, digests, endpoint, separator):
     return desc
 
 
-def download(state, cons=None, flavor='microdesc', cache=True, fail_on_missing=False):
+def download(state, cons=None, flavor='microdesc', cache=True, fail_on_missing=False,
+        parallel=4):
     logging.warning('Use DEPRECATED method descriptor.download()!')
 
     if cons is None:
@@ -587,23 +661,25 @@ def download(state, cons=None, flavor='microdesc', cache=True, fail_on_missing=F
                 pass
         partial_digests = [d for d in digests if d not in cached_digests]
 
-    for query in batch_query(partial_digests, endpoint, separator):
-        state, answer = lnn.hop.directory_query(state, query)
+    # (batches are downloaded in parallel, on concurrent streams)
+    queries = list(batch_query(partial_digests, endpoint, separator))
+    for offset in range(0, len(queries), parallel):
+        batch = queries[offset:offset + parallel]
 
-        if answer is None or len(answer) == 0:
-            continue
+        # (descriptors are parsed while being downloaded, as cells arrive)
+        parsers = [incremental_parser(flavor) for _ in batch]
+        new_batches = [[] for _ in batch]
+        for index, chunk in lnn.hop.directory_select(state, batch):
+            new_batches[index] += parsers[index].feed(chunk)
 
-        new_batch, remaining = parse_descriptors(answer, flavor=flavor)
-        if new_batch is None or remaining is None or len(remaining) > 0:
-            raise RuntimeError('Unable to parse descriptors.')
+        for parser, new_batch in zip(parsers, new_batches):
+            new_batch += parser.close()
 
-        if (len(new_batch['descriptors']) == 0
-            and not new_batch['http']['code'] == '404'):
-            raise RuntimeError(
-                'No descriptor listed. http={}.'.format(new_batch['http']))
+            if len(new_batch) == 0 and not parser.http.get('code') == '404':
+                raise RuntimeError(
+                    'No descriptor listed. http={}.'.format(parser.http))
 
-        if new_batch is not None:
-            descriptors += new_batch['descriptors']
+            descriptors += new_batch
 
     if flavor == 'microdesc':
         obtained = [d['micro-digest'] for d in descriptors]
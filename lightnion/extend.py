@@ -1,12 +1,16 @@
+import collections
+import asyncio
 import random
 import base64
+import queue
+import time
 import io
 
 import nacl.public
 
 import lightnion as lnn
 
-def circuit(state, descriptor):
+def _extend2(state, descriptor):
     onion_key = base64.b64decode(descriptor['ntor-onion-key'] + '====')
     eidentity = descriptor['identity']['master-key'] # (assuming ed25519 here)
     identity = base64.b64decode(descriptor['router']['identity'] + '====')
@@ -20,14 +24,16 @@ def circuit(state, descriptor):
 
     state = lnn.hop.send(state,
         lnn.cell.relay.cmd.RELAY_EXTEND2, payload.raw, stream_id=0)
+    return state, (eph_key, identity, onion_key)
 
-    state, cells = lnn.hop.recv(state, once=True)
+def _extended2(state, cells, keys):
+    eph_key, identity, onion_key = keys
     if not len(cells) == 1:
         raise RuntimeError('Expected exactly one cell, got: {}'.format(cells))
 
     if not cells[0].relay.cmd == lnn.cell.relay.cmd.RELAY_EXTENDED2:
         raise RuntimeError('Expected EXTENDED2, got {} here: {}'.format(
-            cells[0].relay.cmd, cell.relay.truncated))
+            cells[0].relay.cmd, cells[0].relay.truncated))
 
     payload = lnn.cell.relay.extended2.payload(cells[0].relay.data)
     if not payload.valid:
@@ -42,3 +48,218 @@ def circuit(state, descriptor):
 
     state.wrap(lnn.onion.state(state.link, extended))
     return state
+
+def circuit(state, descriptor):
+    state, keys = _extend2(state, descriptor)
+    state, cells = lnn.hop.recv(state, once=True)
+    return _extended2(state, cells, keys)
+
+async def circuit_async(state, descriptor):
+    '''Extend `state` circuit to the relay of `descriptor`, from an asyncio
+    event loop (see circuit and link.link_async).
+
+    :returns: the extended state
+    '''
+    state, keys = _extend2(state, descriptor)
+    await state.link.drain()
+
+    state, cells = await lnn.hop.recv_async(state, once=True)
+    return _extended2(state, cells, keys)
+
+class built(collections.namedtuple('built',
+        ['path', 'state', 'timings', 'error'])):
+    """Outcome of one circuit of build_circuits.
+
+    :param list path: descriptors of the relays, guard first.
+    :param state: an onion.state object, None if the building failed.
+    :param list timings: seconds spent on each hop built (CREATE2 first).
+    :param error: the RuntimeError that stopped the building, if any.
+    """
+    @property
+    def ok(self):
+        return self.error is None
+
+def _abandon(link, circuit):
+    # (tell the guard, then forget about the circuit)
+    if circuit.id in link.circuits:
+        link.unregister(circuit)
+    link.send(lnn.cell.destroy.pack(circuit.id,
+        lnn.cell.destroy.reason.FINISHED))
+
+class _builder:
+    """One circuit of build_circuits, built one round trip at a time."""
+    def __init__(self, link, path):
+        self.link = link
+        self.path = path
+        self.state = None
+        self.circuit = None
+        self.keys = None
+        self.timings = []
+        self.error = None
+        self.started = None
+
+    @property
+    def done(self):
+        return self.error is not None or len(self.timings) == len(self.path)
+
+    def result(self):
+        state = self.state if self.error is None else None
+        return built(self.path, state, self.timings, self.error)
+
+    def start(self):
+        descriptor = self.path[0]
+        identity = base64.b64decode(descriptor['router']['identity'] + '====')
+        onion_key = base64.b64decode(descriptor['ntor-onion-key'] + '====')
+        eph_key, payload = lnn.crypto.ntor.hand(identity, onion_key)
+
+        circuit_id, handshake = lnn.create.ntor_raw(self.link, payload)
+        self.keys = (eph_key, identity, onion_key)
+        self.started = time.perf_counter()
+
+        # (register a dummy circuit first to reuse the circuit API)
+        self.circuit = lnn.create.circuit(circuit_id, None)
+        self.link.register(self.circuit)
+        self.link.send(handshake)
+
+    def created(self, payload):
+        self.link.unregister(self.circuit)
+
+        cell = lnn.cell.created2.cell(payload)
+        if not cell.valid:
+            raise RuntimeError('Got invalid CREATED2 cell: {}'.format(cell.raw))
+
+        eph_key, identity, onion_key = self.keys
+        material = lnn.crypto.ntor.shake(eph_key, cell.created2.data,
+            identity, onion_key, length=92)
+        if material is None:
+            raise RuntimeError('Invalid CREATED2 handshake.')
+
+        self.circuit = lnn.create.circuit(self.circuit.id,
+            lnn.crypto.ntor.kdf(material))
+        self.link.register(self.circuit)
+        self.state = lnn.onion.state(self.link, self.circuit)
+        self.next()
+
+    def extended(self, cells):
+        self.state = _extended2(self.state, cells, self.keys)
+        self.next()
+
+    def next(self):
+        now = time.perf_counter()
+        self.timings.append(now - self.started)
+        self.started = now
+
+        if not self.done:
+            self.state, self.keys = _extend2(self.state,
+                self.path[len(self.timings)])
+
+    def poll(self):
+        """Move on if an answer is there, returns True if so."""
+        if self.state is None:
+            try:
+                payload = self.link.get(self.circuit, block=False)
+            except queue.Empty:
+                return False
+            except KeyError:
+                raise RuntimeError('Got DESTROY cell while creating circuit.')
+
+            self.created(payload)
+            return True
+
+        self.state, cells = lnn.hop.recv(self.state, block=False, once=True)
+        if len(cells) == 0:
+            return False
+
+        self.extended(cells)
+        return True
+
+    def fail(self, error):
+        self.error = error
+        if self.circuit is not None and not self.circuit.destroyed:
+            _abandon(self.link, self.circuit)
+
+    def ready(self):
+        # (called with link.condition held, see build_circuits)
+        if self.circuit.id not in self.link.circuits:
+            return True
+        return not self.circuit.queue.empty()
+
+def build_circuits(link, paths, concurrency=8):
+    """Build several circuits at once on `link`, pipelining the CREATE2 and
+    EXTEND2 round trips of up to `concurrency` circuits.
+
+    :param link: a link.link object, see: link.initiate
+    :param list paths: one list of descriptors per circuit, guard first.
+    :param int concurrency: circuits being built at once (default: 8).
+
+    :returns: a list of extend.built objects, in the order of `paths`
+
+    *Note: circuits that failed are destroyed, others are left to the caller.*
+    """
+    builders = [_builder(link, path) for path in paths]
+    waiting = collections.deque(builders)
+    active = []
+
+    while len(waiting) > 0 or len(active) > 0:
+        while len(waiting) > 0 and len(active) < concurrency:
+            builder = waiting.popleft()
+            try:
+                builder.start()
+            except RuntimeError as e:
+                builder.fail(e)
+                continue
+            active.append(builder)
+
+        progress = False
+        for builder in list(active):
+            try:
+                progress = builder.poll() or progress
+            except RuntimeError as e:
+                builder.fail(e)
+                progress = True
+
+            if builder.done:
+                active.remove(builder)
+
+        if progress or len(active) == 0:
+            continue
+
+        # (wait for an answer on any of the circuits being built)
+        with link.condition:
+            if link.error is not None:
+                raise link.error
+            link.condition.wait_for(
+                lambda: any([builder.ready() for builder in active]),
+                timeout=link.period)
+
+    return [builder.result() for builder in builders]
+
+async def build_circuits_async(link, paths, concurrency=8):
+    """Build several circuits at once on `link` from an asyncio event loop,
+    see build_circuits and link.link_async.
+
+    :returns: a list of extend.built objects, in the order of `paths`
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def build(path):
+        state = None
+        timings = []
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                state = await lnn.create.ntor_async(link, path[0])
+                timings.append(time.perf_counter() - started)
+
+                for descriptor in path[1:]:
+                    started = time.perf_counter()
+                    state = await circuit_async(state, descriptor)
+                    timings.append(time.perf_counter() - started)
+            except RuntimeError as e:
+                if state is not None and not state.circuit.destroyed:
+                    _abandon(link, state.circuit)
+                return built(path, None, timings, e)
+
+        return built(path, state, timings, None)
+
+    return await asyncio.gather(*[build(path) for path in paths])
@@ -1,70 +1,133 @@
+import collections
+import asyncio
 import zlib
 import time
 import queue
 
 import lightnion as lnn
 
-def recv(state, block=True, once=False, auto_sendme=True):
+def recv(state, block=True, once=False, auto_sendme=True, timeout=None):
     '''Receive one or more RELAY{_EARLY,} cells from `state` attached circuit.
 
     :param state: a state object (see onion.state)
     :param bool block: block while receiving? (default: True)
     :param bool block: attempt only receiving once? (default: False)
+    :param float timeout: seconds to block at most (default: None, forever)
 
     :returns: a tuple (updated state, received RELAY{_EARLY,} cells)
 
     Notes:
         - returns an updated state that *MUST* be used afterwards.
         - non-RELAY{_EARLY,} cells within the circuit *may be reordered.*
+        - all the cells already received are decrypted at once.
     '''
 
+    cells = []
     while True:
         try:
-            payload = state.link.get(circuit=state.circuit, block=block)
+            payload = state.link.get(circuit=state.circuit, block=block,
+                timeout=timeout)
         except queue.Empty:
-            return state, []
+            break
+        except KeyError:
+            raise _destroyed(state)
+
+        cell = _relay_cell(payload)
+        if cell is None:
+            state.link.put(state.circuit, payload)
+            continue
+
+        cells.append(cell)
+        if once:
+            break
+
+        # (then, take the cells already there)
+        block = False
+
+    return _peel(state, cells, auto_sendme)
+
+async def recv_async(state, block=True, once=False, auto_sendme=True):
+    '''Receive one or more RELAY{_EARLY,} cells from `state` attached circuit,
+    from an asyncio event loop (see recv and link.link_async).
+
+    :returns: a tuple (updated state, received RELAY{_EARLY,} cells)
+    '''
+
+    cells = []
+    others = []
+    while True:
+        try:
+            payload = await state.link.get_async(circuit=state.circuit,
+                block=block)
+        except queue.Empty:
+            break
         except KeyError:
-            raise RuntimeError('Circuit got destroyed, reason: {}'.format(
-                state.circuit.reason))
+            raise _destroyed(state)
 
-        header = lnn.cell.header(payload)
-        if header.cmd in [lnn.cell.cmd.RELAY, lnn.cell.cmd.RELAY_EARLY]:
+        cell = _relay_cell(payload)
+        if cell is None:
+            others.append(payload)
+            continue
+
+        cells.append(cell)
+        if once:
             break
 
+        # (then, take the cells already there)
+        block = False
+
+    # (non-RELAY{_EARLY,} cells are given back once we are done)
+    for payload in others:
         state.link.put(state.circuit, payload)
 
-    cell_type = lnn.cell.relay.cell
-    if header.cmd is lnn.cell.cmd.RELAY_EARLY:
-        cell_type = lnn.cell.relay_early.cell
+    return _peel(state, cells, auto_sendme)
 
-    cell = cell_type(payload)
-    #import pdb
-    #pdb.set_trace()
-    #if not cell.valid:
-    #    raise RuntimeError(
-    #        'Got invalid (encrypted) RELAY cell: {}'.format(cell.raw))
+def _destroyed(state):
+    return RuntimeError('Circuit got destroyed, reason: {}'.format(
+        state.circuit.reason))
 
-    state, cell = lnn.onion.peel(state, cell)
-    if not cell.valid:
-        raise RuntimeError(
-            'Got invalid (decrypted) RELAY cell: {}'.format(cell.raw))
+def _relay_cell(payload):
+    header = lnn.cell.header(payload)
+    if header.cmd is lnn.cell.cmd.RELAY:
+        return lnn.cell.relay.cell(payload)
+    if header.cmd is lnn.cell.cmd.RELAY_EARLY:
+        return lnn.cell.relay_early.cell(payload)
+    return None
+
+def _peel(state, cells, auto_sendme):
+    try:
+        state, cells = lnn.onion.peel_many(state, cells)
+    except lnn.onion.unrecognized as e:
+        pending = [bytes(cell.raw) for cell in e.pending]
+        if len(e.cells) == 0:
+            # (as with onion.peel, the unrecognized cell is dropped)
+            state.link.unget(state.circuit, pending[1:])
+            raise
+
+        # (the cells recognized are given, the next recv raises)
+        state.link.unget(state.circuit, pending)
+        cells = e.cells
+
+    for cell in cells:
+        if not cell.valid:
+            raise RuntimeError(
+                'Got invalid (decrypted) RELAY cell: {}'.format(cell.raw))
 
     if auto_sendme:
-        state = _auto_sendme(state, cell)
+        for cell in cells:
+            state = _auto_sendme(state, cell)
 
-    cells = [cell]
-    while not once:
-        state, new_cells = recv(state, block=False, once=True)
-        if len(new_cells) == 0:
-            break
-        cells += new_cells
     return state, cells
 
 # TODO: better sendme handling
 def _auto_sendme(state, cell):
+    state = _circuit_sendme(state, cell)
+    return _stream_sendme(state, cell)
+
+def _circuit_sendme(state, cell):
     if not cell.relay.cmd == lnn.cell.relay.cmd.RELAY_DATA:
         return state
-    link, circuit, flow = state.link, state.circuit, lnn.constants.flow
+    circuit, flow = state.circuit, lnn.constants.flow
 
     # Circuit-level sendme
     #
@@ -75,6 +138,12 @@ def _auto_sendme(state, cell):
     if circuit.window < flow.circuit.lowlimit:
         circuit.window += flow.circuit.increment
         state = send(state, lnn.cell.relay.cmd.RELAY_SENDME)
+    return state
+
+def _stream_sendme(state, cell):
+    if not cell.relay.cmd == lnn.cell.relay.cmd.RELAY_DATA:
+        return state
+    circuit, flow = state.circuit, lnn.constants.flow
 
     # Stream-level sendme
     #
@@ -117,17 +186,125 @@ def send(state, command, payload=b'', stream_id=0):
     state.link.send(cell)
     return state
 
+def send_many(state, command, payloads, stream_id=0):
+    '''Send several RELAY{_EARLY,} cells through `state` attached circuit.
+
+    :param state: a state object (see onion.state)
+    :param str command: RELAY{_EARLY,} cell command (see cell.relay.cmd)
+    :param list payloads: RELAY{_EARLY,} cell contents, one per cell
+    :param int stream_id: RELAY{_EARLY,} stream ID (default: 0)
+
+    :returns: an updated state
+
+    *Note: returns an updated state that *MUST* be used afterwards.*
+    '''
+
+    # We build our onions (at once)
+    state, cells = lnn.onion.build_many(state, command, payloads, stream_id)
+
+    # Then, we send the encrypted payloads.
+    for cell in cells:
+        state.link.send(cell)
+    return state
+
+async def send_async(state, command, payload=b'', stream_id=0):
+    '''Send one RELAY{_EARLY,} cell through `state` attached circuit, from
+    an asyncio event loop (see send and link.link_async).
+
+    :returns: an updated state
+    '''
+    state = send(state, command, payload, stream_id)
+    await state.link.drain()
+    return state
+
+async def send_many_async(state, command, payloads, stream_id=0):
+    '''Send several RELAY{_EARLY,} cells through `state` attached circuit,
+    from an asyncio event loop (see send_many and link.link_async).
+
+    :returns: an updated state
+    '''
+    state = send_many(state, command, payloads, stream_id)
+    await state.link.drain()
+    return state
+
+def recv_stream(state, stream_id, block=True, timeout=None):
+    '''Receive the RELAY{_EARLY,} cells of one stream from `state` attached
+    circuit, cells of other streams are kept for them (see state.streams).
+
+    :param state: a state object (see onion.state)
+    :param int stream_id: RELAY{_EARLY,} stream ID
+    :param bool block: block while receiving? (default: True)
+    :param float timeout: seconds to block at most (default: None, forever)
+
+    :returns: a tuple (updated state, received RELAY{_EARLY,} cells)
+
+    *Note: returns an updated state that *MUST* be used afterwards.*
+
+    Stream-level SENDME cells are only sent once the cells of their stream
+    are taken here: each stream buffers at most one window of cells.
+    '''
+    pending = state.streams.setdefault(stream_id, collections.deque())
+    if len(pending) == 0:
+        state, cells = recv(state, block=block, auto_sendme=False,
+            timeout=timeout)
+        state = _stream_store(state, cells)
+
+    return _stream_take(state, stream_id)
+
+async def recv_stream_async(state, stream_id, block=True):
+    '''Receive the RELAY{_EARLY,} cells of one stream from `state` attached
+    circuit, from an asyncio event loop (see recv_stream).
+
+    :returns: a tuple (updated state, received RELAY{_EARLY,} cells)
+    '''
+    pending = state.streams.setdefault(stream_id, collections.deque())
+    while len(pending) == 0:
+        state, cells = await recv_async(state, block=block, auto_sendme=False)
+        state = _stream_store(state, cells)
+        if not block:
+            break
+
+    return _stream_take(state, stream_id)
+
+# (one window of RELAY_DATA cells, plus the RELAY_END closing the stream)
+stream_buffer = lnn.constants.flow.stream.default + 1
+
+def _stream_store(state, cells):
+    for cell in cells:
+        state = _circuit_sendme(state, cell)
+
+        # TODO: proper support for incoming RELAY_SENDME cells
+        if (cell.relay.stream_id == 0
+                and cell.relay.cmd == lnn.cell.relay.cmd.RELAY_SENDME):
+            continue
+
+        pending = state.streams.setdefault(cell.relay.stream_id,
+            collections.deque())
+        if len(pending) >= stream_buffer:
+            raise RuntimeError('Stream {} got more than its window: {} cells'
+                ' already buffered.'.format(cell.relay.stream_id, len(pending)))
+        pending.append(cell)
+    return state
+
+def _stream_take(state, stream_id, count=None):
+    pending = state.streams.setdefault(stream_id, collections.deque())
+    if count is None:
+        cells = list(pending)
+        pending.clear()
+    else:
+        cells = [pending.popleft() for _ in range(min(count, len(pending)))]
+
+    # (the sender may go on once the cells are consumed)
+    for cell in cells:
+        state = _stream_sendme(state, cell)
+    return state, cells
+
 directory_request = '\r\n'.join((
       'GET {query} HTTP/1.0',
       'Accept-Encoding: {compression}',
     )) + '\r\n\r\n'
 
-def directory_query(
-        state,
-        query=None,
-        compression='deflate',
-        timeout=30,
-        **kwargs):
+def _directory_check(query, compression):
     if compression not in ['identity', 'deflate', 'gzip']:
         raise NotImplementedError(
             'Compression method "{}" not supported.'.format(compression))
@@ -136,93 +313,322 @@ def directory_query(
         query = '/tor/status-vote/current/consensus'
     if not query.startswith('/tor/') or any([c in query for c in ' \r\n']):
         raise RuntimeError('Invalid query: {}'.format(query))
+    return query
 
+def _directory_begin(state):
     state.circuit.last_stream_id += 1
     stream_id = state.circuit.last_stream_id
 
     state = send(
         state, lnn.cell.relay.cmd.RELAY_BEGIN_DIR, stream_id=stream_id)
-    state, cells = recv(state)
+    return state, stream_id
+
+def _directory_request(state, stream_id, query, compression):
+    pending = state.streams.setdefault(stream_id, collections.deque())
+    while len(pending) == 0:
+        state, cells = recv(state, auto_sendme=False)
+        state = _stream_store(state, cells)
+
+    # (only RELAY_CONNECTED is taken, the answer is read afterwards)
+    state, cells = _stream_take(state, stream_id, count=1)
+    return _directory_connected(state, stream_id, cells, query, compression)
 
+def _directory_connected(state, stream_id, cells, query, compression):
     if not cells[0].relay.cmd == lnn.cell.relay.cmd.RELAY_CONNECTED:
         raise RuntimeError('Expecting RELAY_CONNECTED after RELAY_BEGIN_DIR,'
             + ' got {} in cell:'.format(cells[0].relay.cmd, cells[0].raw))
 
-
     http = directory_request.format(query=query, compression=compression)
 
     http = bytes(http, 'utf8')
     width = lnn.cell.relay.payload_len
-    while len(http) > 0:
-        chunk, http = http[:width], http[width:]
-        state = send(state, lnn.cell.relay.cmd.RELAY_DATA, chunk,
-            stream_id=stream_id)
-
-    # TODO: proper support for RELAY_END reasons
-    state, cells = recv(state)
-    if lnn.cell.relay.cmd.RELAY_END not in [c.relay.cmd for c in cells]:
-        candidates = []
-        diff_time = time.time()
-        while True:
-            if time.time() - diff_time > timeout:
-                break
-
-            state, new_cells = recv(state, block=False)
-            candidates = [c.relay.cmd for c in new_cells]
-            cells += new_cells
+    chunks = [http[i:i + width] for i in range(0, len(http), width)]
+    state = send_many(state, lnn.cell.relay.cmd.RELAY_DATA, chunks,
+        stream_id=stream_id)
+    return state
 
-            if lnn.cell.relay.cmd.RELAY_END in candidates:
+class _directory_reader:
+    '''Turn the cells of a directory stream into its answer (HTTP headers
+    first, then decompressed content), see _directory_answer.
+    '''
+    def __init__(self, query, compression):
+        self.query = query
+        self.headers = b''
+        self.ended = False
+
+        self.decompressor = None
+        if compression in ['deflate', 'gzip']:
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+    def feed(self, cells):
+        # TODO: proper support for RELAY_END reasons
+        chunks = []
+        for cell in cells:
+            if cell.relay.cmd == lnn.cell.relay.cmd.RELAY_END:
+                self.ended = True
                 break
 
-            if len(candidates) > 0:
-                diff_time = time.time()
+            if not cell.relay.cmd == lnn.cell.relay.cmd.RELAY_DATA:
+                continue
+
+            data = cell.relay.data
+            if self.headers is not None:
+                self.headers += data
+                if b'\r\n\r\n' not in self.headers:
+                    continue
+
+                headers, data = self.headers.split(b'\r\n\r\n', 1)
+                if not headers.startswith(b'HTTP/1.0'):
+                    raise RuntimeError(
+                        'Unexpected answer to query "{}": {}'.format(
+                        self.query, headers))
+
+                chunks.append(headers + b'\r\n\r\n')
+                self.headers = None
+
+            if self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+            if len(data) > 0:
+                chunks.append(data)
+        return chunks
+
+    def close(self):
+        if self.headers is not None:
+            raise RuntimeError('Unexpected answer to query "{}": {}'.format(
+                self.query, self.headers))
+
+        if self.decompressor is not None:
+            data = self.decompressor.flush()
+            if len(data) > 0:
+                return [data]
+        return []
+
+def _directory_answer(state, stream_id, query, compression, timeout):
+    reader = _directory_reader(query, compression)
+
+    state, cells = recv_stream(state, stream_id, timeout=timeout)
+    diff_time = time.time()
+    while True:
+        yield from reader.feed(cells)
+        if reader.ended:
+            break
 
-        if time.time() - diff_time > timeout:
+        # (block on the link until new cells or the end of the timeout)
+        remaining = timeout - (time.time() - diff_time)
+        if remaining <= 0:
             raise RuntimeError(
                 'Timeout while expecting RELAY_END: {:.2f}s out of {}s'.format(
                 time.time() - diff_time, timeout))
 
-    # TODO: proper support for incoming RELAY_SENDME cells
-    cells = [c for c in cells if not (c.relay.stream_id == 0
-                and c.relay.cmd == lnn.cell.relay.cmd.RELAY_SENDME)]
+        state, cells = recv_stream(state, stream_id, timeout=remaining)
+        if len(cells) > 0:
+            diff_time = time.time()
 
-    # TODO: proper support for concurrent streams on the same circuit
-    if not all([c.relay.stream_id == stream_id for c in cells]):
-        raise RuntimeError('No proper support for multiple stream!')
+    # (the stream is closed, forget about it)
+    state.streams.pop(stream_id, None)
+    yield from reader.close()
 
-    content = b''
-    for cell in cells:
-        if not cell.relay.cmd == lnn.cell.relay.cmd.RELAY_DATA:
+def directory_stream(
+        state,
+        query=None,
+        compression='deflate',
+        timeout=30,
+        **kwargs):
+    '''Query the directory attached to `state` circuit, yields its answer
+    (HTTP headers first, then decompressed content) as cells arrive.
+
+    :param state: a state object (see onion.state)
+    :param str query: directory query (default: current consensus)
+    :param str compression: identity, deflate or gzip (default: deflate)
+    :param int timeout: seconds to wait for new cells (default: 30)
+
+    *Note: `state` is updated in place while iterating.*
+    '''
+    return directory_streams(state, [query], compression, timeout)[0]
+
+def directory_streams(
+        state,
+        queries,
+        compression='deflate',
+        timeout=30,
+        **kwargs):
+    '''Run several directory queries in parallel on `state` circuit, each
+    one on its own stream (see directory_stream).
+
+    All the streams are opened, then all the queries are sent, before any
+    answer is read: answers are downloaded at once, while being consumed
+    one after another.
+
+    :param state: a state object (see onion.state)
+    :param list queries: directory queries
+    :param str compression: identity, deflate or gzip (default: deflate)
+    :param int timeout: seconds to wait for new cells (default: 30)
+
+    :returns: a list of generators, see directory_stream
+
+    *Note: `state` is updated in place while iterating.*
+    '''
+    queries = [_directory_check(query, compression) for query in queries]
+
+    stream_ids = []
+    for _ in queries:
+        state, stream_id = _directory_begin(state)
+        stream_ids.append(stream_id)
+
+    for stream_id, query in zip(stream_ids, queries):
+        state = _directory_request(state, stream_id, query, compression)
+
+    return [_directory_answer(state, stream_id, query, compression, timeout)
+        for stream_id, query in zip(stream_ids, queries)]
+
+def directory_select(
+        state,
+        queries,
+        compression='deflate',
+        timeout=30,
+        **kwargs):
+    '''Run several directory queries in parallel on `state` circuit (see
+    directory_streams), yields the pieces of their answers from whichever
+    stream is ready, blocking on the link otherwise.
+
+    :param state: a state object (see onion.state)
+    :param list queries: directory queries
+    :param str compression: identity, deflate or gzip (default: deflate)
+    :param int timeout: seconds to wait for new cells (default: 30)
+
+    :returns: a generator of (index of the query, piece of its answer)
+
+    *Note: `state` is updated in place while iterating.*
+    '''
+    queries = [_directory_check(query, compression) for query in queries]
+
+    stream_ids = []
+    for _ in queries:
+        state, stream_id = _directory_begin(state)
+        stream_ids.append(stream_id)
+
+    readers = dict()
+    for index, (stream_id, query) in enumerate(zip(stream_ids, queries)):
+        state = _directory_request(state, stream_id, query, compression)
+        readers[stream_id] = (index, _directory_reader(query, compression))
+
+    diff_time = time.time()
+    while len(readers) > 0:
+        ready = False
+        for stream_id in list(readers):
+            state, cells = _stream_take(state, stream_id)
+            if len(cells) == 0:
+                continue
+
+            ready = True
+            index, reader = readers[stream_id]
+            for chunk in reader.feed(cells):
+                yield index, chunk
+
+            if reader.ended:
+                # (the stream is closed, forget about it)
+                del readers[stream_id]
+                state.streams.pop(stream_id, None)
+                for chunk in reader.close():
+                    yield index, chunk
+
+        if ready:
+            diff_time = time.time()
             continue
-        content += cell.relay.data
 
-    if compression in ['deflate', 'gzip']:
-        http_headers, compressed_data = content.split(b'\r\n\r\n', 1)
-        raw_data = zlib_decompress(compressed_data)
-        content = http_headers + b'\r\n\r\n' + raw_data
+        # (block on the link until new cells or the end of the timeout)
+        remaining = timeout - (time.time() - diff_time)
+        if remaining <= 0:
+            raise RuntimeError(
+                'Timeout while expecting RELAY_END: {:.2f}s out of {}s'.format(
+                time.time() - diff_time, timeout))
+
+        state, cells = recv(state, auto_sendme=False, timeout=remaining)
+        state = _stream_store(state, cells)
 
-    if not content.startswith(b'HTTP/1.0'):
-        raise RuntimeError('Unexpected answer to query "{}": {}'.format(query,
-            content))
+def directory_query(
+        state,
+        query=None,
+        compression='deflate',
+        timeout=30,
+        **kwargs):
+    '''Query the directory attached to `state` circuit (see directory_stream).
 
+    :returns: a tuple (updated state, full answer)
+    '''
+    content = b''.join(directory_stream(state, query, compression, timeout,
+        **kwargs))
     return state, content
 
-def zlib_decompress(compressed_data, min_bufsize=32):
-    data = b''
-    buff = b''
-    part = None
-    ilen = len(compressed_data)
-    olen = 0
-    zobj = zlib.decompressobj()
-    while part is None or len(part) > 0:
-        buff = zobj.unconsumed_tail
-        if len(buff) < 1:
-            nlen = max((len(data) + ilen) // 2, min_bufsize)
-            buff = compressed_data[olen:nlen]
-            if len(buff) < 1:
-                break
+async def _directory_wait_async(state, stream_id):
+    pending = state.streams.setdefault(stream_id, collections.deque())
+    while len(pending) == 0:
+        state, cells = await recv_async(state, auto_sendme=False)
+        state = _stream_store(state, cells)
+
+    # (only RELAY_CONNECTED is taken, see _directory_request)
+    return _stream_take(state, stream_id, count=1)
+
+async def directory_stream_async(
+        state,
+        query=None,
+        compression='deflate',
+        timeout=30,
+        **kwargs):
+    '''Query the directory attached to `state` circuit from an asyncio
+    event loop, yields its answer as cells arrive (see directory_stream).
+
+    :param state: a state object (see onion.state)
+    :param str query: directory query (default: current consensus)
+    :param str compression: identity, deflate or gzip (default: deflate)
+    :param int timeout: seconds to wait for new cells (default: 30)
+
+    *Note: `state` is updated in place while iterating.*
+    '''
+    query = _directory_check(query, compression)
+
+    state, stream_id = _directory_begin(state)
+    try:
+        state, cells = await asyncio.wait_for(
+            _directory_wait_async(state, stream_id), timeout)
+    except asyncio.TimeoutError:
+        raise RuntimeError(
+            'Timeout while expecting RELAY_CONNECTED: {}s'.format(timeout))
+    state = _directory_connected(state, stream_id, cells, query, compression)
+    await state.link.drain()
+
+    reader = _directory_reader(query, compression)
+    while not reader.ended:
+        try:
+            state, cells = await asyncio.wait_for(
+                recv_stream_async(state, stream_id), timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(
+                'Timeout while expecting RELAY_END: {}s'.format(timeout))
+
+        for chunk in reader.feed(cells):
+            yield chunk
+
+    # (the stream is closed, forget about it)
+    state.streams.pop(stream_id, None)
+    for chunk in reader.close():
+        yield chunk
+
+async def directory_query_async(
+        state,
+        query=None,
+        compression='deflate',
+        timeout=30,
+        **kwargs):
+    '''Query the directory attached to `state` circuit from an asyncio
+    event loop (see directory_stream_async).
+
+    :returns: a tuple (updated state, full answer)
+    '''
+    content = b''.join([chunk async for chunk in directory_stream_async(
+        state, query, compression, timeout, **kwargs)])
+    return state, content
 
-            olen += len(buff)
-        part = zobj.decompress(buff, zlib.MAX_WBITS | 32)
-        data += part
-    return data
+def zlib_decompress(compressed_data):
+    zobj = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    return zobj.decompress(compressed_data) + zobj.flush()
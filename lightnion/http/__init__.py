@@ -13,10 +13,7 @@ class channel(collections.namedtuple('channel',
     ['id', 'guard', 'middle', 'exit'])):
     pass
 
-def client(host, port=80, *, io, prefix='http', failures=5, **kwargs):
-    base_url = '{}://{}:{}{}'.format(prefix, host, port, lnn.proxy.base_url)
-
-    guard = None
+def get_guard(base_url, failures=5):
     try:
         code = 503
         fails = 0
@@ -34,37 +31,62 @@ def client(host, port=80, *, io, prefix='http', failures=5, **kwargs):
         if code == 503:
             raise RuntimeError('Too many failures!')
 
-        guard = json.loads(rq.text)
+        return json.loads(rq.text)
 
     except BaseException as e:
         raise RuntimeError(
             'Unable retrieve guard at endpoint {}, reason: {}'.format(
                 base_url + '/guard', e))
 
-    handshake, material, uid, path = (None, None, None, None)
-    try:
-        code = 503
-        fails = 0
-        for _ in range(failures):
-            handshake, material = ntor.hand(guard)
-            data = json.dumps(dict(ntor=handshake))
+def create_channel(base_url, failures=5):
+    code = 503
+    fails = 0
+    for _ in range(failures):
+        rq = requests.post(base_url + '/channels',
+            data=json.dumps(dict()), headers=headers)
+        if not rq.status_code in [201, 503]:
+            raise RuntimeError('Error code: {}'.format(rq.status_code))
 
-            rq = requests.post(base_url + '/channels',
-                data=data, headers=headers)
-            if not rq.status_code in [201, 503]:
-                raise RuntimeError('Error code: {}'.format(rq.status_code))
+        code = rq.status_code
+        if fails > failures or not code == 503:
+            break
 
-            code = rq.status_code
-            if fails > failures or not code == 503:
-                break
+        fails += 1
 
-            fails += 1
+    if code == 503:
+        raise RuntimeError('Too many failures!')
 
-        if code == 503:
-            raise RuntimeError('Too many failures!')
+    return json.loads(rq.text)
+
+def client(host, port=80, *, io, prefix='http', failures=5, guard=None,
+        oneshot=False, **kwargs):
+    base_url = '{}://{}:{}{}'.format(prefix, host, port, lnn.proxy.base_url)
 
-        data = json.loads(rq.text)
-        uid, handshake, path = data['id'], data['ntor'], data['path']
+    if guard is None:
+        guard = get_guard(base_url, failures)
+
+    # The CREATE2 cell is built here and sent as first cell of the channel.
+    handshake, material = ntor.hand(guard, encode=False)
+    create2 = lnn.create.ntor_raw2(lnn.proxy.fake_circuit_id, handshake)
+
+    uid, path, link = (None, None, None)
+    try:
+        if oneshot:
+            # (websocket io only: no POST, the proxy creates the channel when
+            #  the websocket opens and sends its information first)
+            io = io(endpoint=base_url + '/channels', **kwargs)
+            link = lnn.link.link(io, version='http')
+            link.reserve(lnn.proxy.fake_circuit_id)
+            link.send(create2)
+            data = io.channel_info()
+        else:
+            data = create_channel(base_url, failures)
+            io = io(endpoint=base_url + '/channels/' + data['id'], **kwargs)
+            link = lnn.link.link(io, version='http')
+            link.reserve(lnn.proxy.fake_circuit_id)
+            link.send(create2)
+
+        uid, path = data['id'], data['path']
 
     except BaseException as e:
         raise RuntimeError(
@@ -73,14 +95,13 @@ def client(host, port=80, *, io, prefix='http', failures=5, **kwargs):
 
     state = None
     try:
+        handshake = lnn.create.ntor_handshake(link,
+            lnn.proxy.fake_circuit_id, None)
         try:
-            handshake = ntor.shake(handshake, material)
+            handshake = ntor.shake(handshake, material, decode=False)
         except TypeError:
             raise RuntimeError('Invalid ntor cryptographic material?')
 
-        io = io(endpoint=base_url + '/channels/' + uid, **kwargs)
-        link = lnn.link.link(io, version='http')
-
         circuit = lnn.create.circuit(lnn.proxy.fake_circuit_id, handshake)
         link.register(circuit)
 
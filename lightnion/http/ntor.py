@@ -14,8 +14,9 @@ def hand(guard, encode=True):
         payload = str(base64.b64encode(payload), 'utf8')
     return payload, (onion_key, ephemeral_key, identity)
 
-def shake(payload, material):
-    payload = base64.b64decode(payload)
+def shake(payload, material, decode=True):
+    if decode:
+        payload = base64.b64decode(payload)
     onion_key, ephemeral_key, identity = material
 
     material = lnn.crypto.ntor.shake(ephemeral_key, payload,
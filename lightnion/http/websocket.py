@@ -3,18 +3,27 @@ import threading
 import logging
 import asyncio
 import queue
+import json
+
+import lightnion as lnn
+import lightnion.utils
 
 from .. import http
 from .. import proxy
 
 async def incoming(websocket, worker):
-    cell = None
+    cells = []
     while True:
         try:
-            if cell is None:
-                cell = await websocket.recv()
-            worker.recv_queue.put_nowait(cell)
-            cell = None
+            if len(cells) == 0:
+                frame = await websocket.recv()
+                if isinstance(frame, str): # (one-shot channel information)
+                    worker.info.put_nowait(json.loads(frame))
+                    continue
+                cells = worker.split(frame)
+            while len(cells) > 0:
+                worker.recv_queue.put_nowait(cells[0])
+                cells.pop(0)
 
             await asyncio.sleep(0)
             continue
@@ -24,13 +33,13 @@ async def incoming(websocket, worker):
         await asyncio.sleep(worker.period)
 
 async def outcoming(websocket, worker):
-    cell = None
+    frame = None
     while True:
         try:
-            if cell is None:
-                cell = worker.send_queue.get_nowait()
-            await websocket.send(cell)
-            cell = None
+            if frame is None:
+                frame = worker.frame()
+            await websocket.send(frame)
+            frame = None
 
             await asyncio.sleep(0)
             continue
@@ -51,22 +60,37 @@ async def channel_handler(websocket, worker):
     worker.dead = True
 
 async def client(worker):
-    async with websockets.connect(worker.endpoint) as websocket:
+    subprotocols = None
+    if worker.multicell:
+        subprotocols = [proxy.multicell_subprotocol]
+
+    async with websockets.connect(worker.endpoint,
+            subprotocols=subprotocols) as websocket:
+        # (the proxy may not support multi-cell frames)
+        worker.multicell = websocket.subprotocol == proxy.multicell_subprotocol
         await channel_handler(websocket, worker)
 
 class worker(threading.Thread):
-    def __init__(self, endpoint, period, max_queue=2048):
+    def __init__(self, endpoint, period, max_queue=2048, multicell=False,
+            frame_size=16384):
         super().__init__()
         self.endpoint = endpoint
         self.period = period
         max_queue = max_queue // 2
 
+        self.multicell = multicell
+        self.frame_size = frame_size
+        self.buffer = lnn.utils.cell_buffer()
+
         self.send_queue = queue.Queue(max_queue)
         self.recv_queue = queue.Queue(max_queue)
 
         self.send_async = asyncio.Queue(max_queue)
         self.recv_async = asyncio.Queue(max_queue)
 
+        # Channel information sent by the proxy to one-shot websockets.
+        self.info = queue.Queue(1)
+
         self.tasks = []
         self.dead = False
 
@@ -94,6 +118,30 @@ class worker(threading.Thread):
         payload = self.recv_queue.get(block=block)
         return payload
 
+    def split(self, frame):
+        if not self.multicell:
+            return [frame]
+
+        self.buffer.feed(frame)
+        return [bytes(cell) for cell in self.buffer.cells()]
+
+    def frame(self):
+        cell = self.send_queue.get_nowait()
+        if not self.multicell:
+            return cell
+
+        cells = [lnn.utils.cell_pad_null(cell)]
+        size = len(cells[0])
+        while size < self.frame_size:
+            try:
+                cell = self.send_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            cells.append(lnn.utils.cell_pad_null(cell))
+            size += len(cells[-1])
+        return b''.join(cells)
+
     def run(self):
         logging.getLogger(websockets.__name__).setLevel(logging.ERROR)
         asyncio.set_event_loop(asyncio.new_event_loop())
@@ -103,11 +151,13 @@ class worker(threading.Thread):
 class io:
     _join_timeout = 3
 
-    def __init__(self, endpoint, period=0.1, daemon=True, max_queue=2048):
+    def __init__(self, endpoint, period=0.1, daemon=True, max_queue=2048,
+            multicell=False, same_port=False):
         endpoint = endpoint.replace('http', 'ws')
-        endpoint = endpoint.replace(':4990/', ':8765/') # TODO: work same port
+        if not same_port: # (proxies also serve channels on their HTTP port)
+            endpoint = endpoint.replace(':4990/', ':8765/')
 
-        self.worker = worker(endpoint, period, max_queue)
+        self.worker = worker(endpoint, period, max_queue, multicell)
         if daemon:
             self.worker.daemon = True
 
@@ -120,6 +170,9 @@ class io:
     def recv(self, block=True):
         return self.worker.recv(block)
 
+    def channel_info(self, timeout=None):
+        return self.worker.info.get(timeout=timeout)
+
     def send(self, payload, block=True):
         self.worker.send(payload, block=block)
 
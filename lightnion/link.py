@@ -1,6 +1,9 @@
+import threading
 import logging
+import asyncio
 import socket
 import queue
+import time
 import ssl
 
 import lightnion as lnn
@@ -22,21 +25,61 @@ class link:
       True
       >>> link.close()
     """
-    def __init__(self, io, version, circuits=[0], max_queue=2048):
-        self.max_queue = 2048
+    def __init__(self, io, version, circuits=[0], max_queue=2048,
+            period=0.1):
+        self.max_queue = max_queue
         self.version = version
         self.last_id = 0
         self.io = io
 
+        # Cells are dispatched to their circuit queue by a separate thread,
+        # the total number of queued cells is kept up to date as we go.
+        self.condition = threading.Condition()
+        self.period = period
+        self.pending = 0
+        self.error = None
+
+        # (cells received before their circuit got registered, see create,
+        #  only kept for circuit IDs handed out but not registered yet)
+        self.reserved = set()
+        self.orphans = dict()
+        self.orphaned = 0
+
         self.circuits = dict()
         self.register(lnn.create.circuit(0, None))
 
-    def pull(self, block=True):
-        try:
-            payload = self.io.recv(block=block)
-        except queue.Empty:
-            return False
+        # (link_async reads its cells from the event loop instead)
+        self.dispatcher = None
+        if io is not None:
+            self.dispatcher = threading.Thread(target=self._dispatch,
+                name='lightnion-link', daemon=True)
+            self.dispatcher.start()
 
+    def _dispatch(self):
+        while not self.io.dead:
+            try:
+                payload = self.io.recv(block=True)
+            except queue.Empty:
+                continue
+            except BaseException as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                try:
+                    self._deliver(payload)
+                except RuntimeError as e:
+                    self.error = e
+                    return
+                finally:
+                    self.condition.notify_all()
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def _deliver(self, payload):
         # We know that receiver.get() will give you a cell with a well-formed
         # header, thus we do not validate it one more time.
         #
@@ -44,8 +87,21 @@ class link:
         #
         header = lnn.cell.header(payload)
         if not header.circuit_id in self.circuits:
-            raise RuntimeError('Got circuit {} outside {}, cell: {}'.format(
-                header.circuit_id, list(self.circuits), payload))
+            # (late cells of unregistered or destroyed circuits)
+            if header.circuit_id not in self.reserved:
+                logging.debug('Dropped cell of unknown circuit {}.'.format(
+                    header.circuit_id))
+                return
+
+            if self.orphaned >= self.max_queue:
+                logging.warning('Dropped early cell of circuit {}: {} early '
+                    'cells already queued.'.format(header.circuit_id,
+                    self.orphaned))
+                return
+
+            self.orphans.setdefault(header.circuit_id, []).append(payload)
+            self.orphaned += 1
+            return
 
         # TODO: property handle DESTROY cells
         circuit = self.circuits[header.circuit_id]
@@ -55,22 +111,21 @@ class link:
                 raise RuntimeError('Got invalid DESTROY cell: {}'.format(
                     cell.truncated))
 
-            self.put(circuit, payload)
+            self._put(circuit, payload)
             circuit.destroyed = True
             circuit.reason = cell.reason
-            self.unregister(circuit)
+            self._unregister(circuit)
             logging.debug('Circuit {} got destroyed, reason: {}'.format(
                 circuit.id, circuit.reason))
-            return False
+            return
 
-        self.put(circuit, payload)
-        return True
+        self._put(circuit, payload)
 
-    def put(self, circuit, payload):
-        circuits_size = sum([c.queue.qsize() for _, c in self.circuits.items()])
-        if circuits_size > self.max_queue:
+    def _put(self, circuit, payload):
+        # (circuit queues hold max_queue cells, never let a put_nowait fail)
+        if self.pending >= self.max_queue:
             raise RuntimeError(
-                'Link circuit queues are full: {}'.format(circuits_size))
+                'Link circuit queues are full: {}'.format(self.pending))
 
         if circuit.id not in self.circuits:
             raise RuntimeError('Got circuit_id {} outside {}, cell: {}'.format(
@@ -81,44 +136,282 @@ class link:
         except AttributeError:
             pass
 
-        self.circuits[circuit.id].put(payload)
-
-    def get(self, circuit, block=True):
-        while block and not self.io.dead:
-            try:
-                return self.circuits[circuit.id].get(block=False)
-            except queue.Empty:
-                pass
+        self.circuits[circuit.id].queue.put_nowait(payload)
+        self.pending += 1
 
-            self.pull()
-            while self.pull(block=False):
-                pass
-        else:
-            if not self.io.dead:
-                while self.pull(block=False):
+    def put(self, circuit, payload):
+        with self.condition:
+            self._put(circuit, payload)
+            self.condition.notify_all()
+
+    def unget(self, circuit, payloads):
+        # (cells taken by get but not used yet, given back in front)
+        with self.condition:
+            if circuit.id not in self.circuits:
+                return
+
+            circuit_queue = self.circuits[circuit.id].queue
+            with circuit_queue.mutex:
+                circuit_queue.queue.extendleft(reversed(payloads))
+            self.pending += len(payloads)
+            self.condition.notify_all()
+
+    def get(self, circuit, block=True, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    raise self.error
+
+                try:
+                    payload = self.circuits[circuit.id].queue.get_nowait()
+                    self.pending -= 1
+                    return payload
+                except queue.Empty:
                     pass
-                return self.circuits[circuit.id].get(block=False)
-            raise RuntimeError('Seems that link.io is dead!')
+
+                if self.io.dead:
+                    raise RuntimeError('Seems that link.io is dead!')
+                if not block:
+                    raise queue.Empty
+
+                # (wake up from time to time to notice a dead link.io)
+                period = self.period
+                if deadline is not None:
+                    period = min(period, deadline - time.monotonic())
+                    if period <= 0:
+                        raise queue.Empty
+                self.condition.wait(period)
 
     def register(self, circuit):
-        if circuit.id in self.circuits:
-            raise RuntimeError('Circuit {} already registered.'.format(
-                circuit.id))
+        with self.condition:
+            if circuit.id in self.circuits:
+                raise RuntimeError('Circuit {} already registered.'.format(
+                    circuit.id))
 
-        circuit.queue = queue.Queue(maxsize=self.max_queue)
-        self.circuits[circuit.id] = circuit
+            circuit.queue = queue.Queue(maxsize=self.max_queue)
+            self.circuits[circuit.id] = circuit
+            self.reserved.discard(circuit.id)
+
+            for payload in self.orphans.pop(circuit.id, []):
+                self.orphaned -= 1
+                self._deliver(payload)
+            self.condition.notify_all()
+
+    def reserve(self, circuit_id):
+        with self.condition:
+            self.reserved.add(circuit_id)
+
+    def _unregister(self, circuit):
+        circuit = self.circuits.pop(circuit.id)
+        self.pending -= circuit.queue.qsize()
 
     def unregister(self, circuit):
-        del self.circuits[circuit.id]
+        with self.condition:
+            self._unregister(circuit)
 
     def recv(self, block=True):
-        return self.io.recv(block=block)
+        raise RuntimeError('Cells are read by the link dispatcher, use get.')
 
     def send(self, cell, block=True):
         self.io.send(cell, block=block)
 
     def close(self):
         self.io.close()
+        with self.condition:
+            self.condition.notify_all()
+
+class link_async(link):
+    """An established Tor link driven by an asyncio event loop: cells are
+    read by a task of the loop, no thread is needed per link.
+
+    :param str address: remote relay address (default: 127.0.0.1).
+    :param int port: remote relay ORPort (default: 9050).
+    :param list versions: target link versions (default: [4, 5]).
+
+    Usage::
+
+      >>> import lightnion as lnn
+      >>> async with lnn.link.initiate_async('127.0.0.1', 5000) as link:
+      ...     state = await lnn.create.fast_async(link)
+      ...     state = await lnn.extend.circuit_async(state, descriptor)
+      ...     state, answer = await lnn.hop.directory_query_async(state)
+
+    *Note: the methods of link.link are still available, but the blocking
+    ones (get) must not be used from the event loop.*
+    """
+    def __init__(self, address='127.0.0.1', port=9050, versions=[4, 5],
+            max_queue=2048, buffer_size=65536):
+        self.address = address
+        self.port = port
+        self.versions = versions
+        self.buffer_size = buffer_size
+
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.dead = False
+
+        # (futures of the get_async calls waiting, per circuit)
+        self.waiters = dict()
+
+        super().__init__(None, None, max_queue=max_queue)
+
+    async def __aenter__(self):
+        return await self.initiate()
+
+    async def __aexit__(self, *exc_info):
+        await self.close_async()
+
+    async def initiate(self):
+        """Establish the link, see link.initiate for the expected transcript.
+
+        :returns: the link itself
+        """
+        self.reader, self.writer = await asyncio.open_connection(
+            self.address, self.port, ssl=_context())
+
+        # VERSIONS handshake
+        self.writer.write(lnn.cell.versions.pack(self.versions).raw)
+        vercell = await lnn.cell.versions.recv_async(self.reader)
+        self.version = _pick_version(vercell, self.versions)
+
+        # Get CERTS, AUTH_CHALLENGE and NETINFO cells afterwards
+        buffer = lnn.utils.cell_buffer()
+        cells = []
+        while len(cells) < 3:
+            data = await self.reader.read(self.buffer_size)
+            if not data:
+                raise RuntimeError('Link closed during handshake.')
+
+            buffer.feed(data)
+            cells += [bytes(cell) for cell in buffer.cells()]
+
+        certs_cell = lnn.cell.certs.cell(cells[0])
+        auth_cell = lnn.cell.challenge.cell(cells[1])
+        netinfo_cell = lnn.cell.netinfo.cell(cells[2])
+
+        # Sanity checks
+        _check_handshake(certs_cell, auth_cell, netinfo_cell)
+
+        # Send our NETINFO to say "we don't want to authenticate"
+        await self.send_async(lnn.cell.netinfo.pack(self.address))
+
+        # (cells received along with NETINFO are handled right away)
+        with self.condition:
+            for payload in cells[3:]:
+                self._deliver(payload)
+
+        self.task = asyncio.get_running_loop().create_task(
+            self._read(buffer))
+        return self
+
+    async def _read(self, buffer):
+        try:
+            while True:
+                data = await self.reader.read(self.buffer_size)
+                if not data:
+                    break
+
+                buffer.feed(data)
+                with self.condition:
+                    for cell in buffer.cells():
+                        self._deliver(bytes(cell))
+        except asyncio.CancelledError:
+            pass
+        except (OSError, RuntimeError) as e:
+            self.error = e
+        finally:
+            self.dead = True
+            for circuit_id in list(self.waiters):
+                self._wake(circuit_id)
+
+    def _wake(self, circuit_id):
+        # (all of them try again, the ones left without cell wait again)
+        for waiter in self.waiters.pop(circuit_id, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _put(self, circuit, payload):
+        super()._put(circuit, payload)
+        self._wake(circuit.id)
+
+    def _unregister(self, circuit):
+        super()._unregister(circuit)
+        self._wake(circuit.id)
+
+    def unget(self, circuit, payloads):
+        super().unget(circuit, payloads)
+        self._wake(circuit.id)
+
+    async def get_async(self, circuit, block=True):
+        while True:
+            if self.error is not None:
+                raise self.error
+
+            try:
+                payload = self.circuits[circuit.id].queue.get_nowait()
+                self.pending -= 1
+                return payload
+            except queue.Empty:
+                pass
+
+            if self.dead:
+                raise RuntimeError('Seems that the link is dead!')
+            if not block:
+                raise queue.Empty
+
+            waiter = asyncio.get_running_loop().create_future()
+            waiters = self.waiters.setdefault(circuit.id, [])
+            waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if len(waiters) == 0 and self.waiters.get(circuit.id) is waiters:
+                    del self.waiters[circuit.id]
+
+    async def register_async(self, circuit):
+        self.register(circuit)
+
+    async def unregister_async(self, circuit):
+        self.unregister(circuit)
+
+    def recv(self, block=True):
+        raise RuntimeError('Cells are read by link_async itself.')
+
+    def send(self, cell, block=True):
+        if self.dead:
+            raise RuntimeError('Seems that the link is dead!')
+        self.writer.write(lnn.cell.pad(cell))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def send_async(self, cell):
+        self.send(cell)
+        await self.writer.drain()
+
+    def close(self):
+        self.dead = True
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def close_async(self):
+        self.close()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.writer is not None:
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
 
 def negotiate_version(peer, versions, *, as_initiator):
     """Performs a VERSIONS negotiation
@@ -130,7 +423,13 @@ def negotiate_version(peer, versions, *, as_initiator):
     if as_initiator:
         lnn.cell.versions.send(peer, lnn.cell.versions.pack(versions))
     vercell = lnn.cell.versions.recv(peer)
+    version = _pick_version(vercell, versions)
 
+    if not as_initiator:
+        lnn.cell.versions.send(peer, lnn.cell.versions.pack(versions))
+    return version
+
+def _pick_version(vercell, versions):
     common_versions = list(set(vercell.versions).intersection(versions))
     if len(common_versions) < 1:
         raise RuntimeError('No common supported versions: {} and {}'.format(
@@ -138,13 +437,26 @@ def negotiate_version(peer, versions, *, as_initiator):
 
     version = max(common_versions)
     if version < 4:
-        raise RuntimeError('No support for version 3 or lower, got {}').format(
-            version)
-
-    if not as_initiator:
-        lnn.cell.versions.send(peer, lnn.cell.versions.pack(versions))
+        raise RuntimeError('No support for version 3 or lower, got {}'.format(
+            version))
     return version
 
+def _check_handshake(certs_cell, auth_cell, netinfo_cell):
+    if not certs_cell.valid:
+        raise RuntimeError('Invalid CERTS cell: {}'.format(certs_cell.raw))
+    if not auth_cell.valid:
+        raise RuntimeError('Invalid AUTH_CHALLENGE cell:{}'.format(
+            auth_cell.raw))
+    if not netinfo_cell.valid:
+        raise RuntimeError('Invalid NETINFO cell: {}'.format(netinfo_cell.raw))
+
+def _context():
+    ctxt = ssl.SSLContext(ssl.PROTOCOL_TLS)
+
+    # https://trac.torproject.org/projects/tor/ticket/28616
+    ctxt.options |= ssl.OP_NO_TLSv1_3
+    return ctxt
+
 def initiate(address='127.0.0.1', port=9050, versions=[4, 5]):
     """Establish a link with the "in-protocol" (v3) handshake as initiator
 
@@ -186,10 +498,7 @@ def initiate(address='127.0.0.1', port=9050, versions=[4, 5]):
 
     # Setup context
     peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ctxt = ssl.SSLContext(ssl.PROTOCOL_TLS)
-
-    # https://trac.torproject.org/projects/tor/ticket/28616
-    ctxt.options |= ssl.OP_NO_TLSv1_3
+    ctxt = _context()
 
     # Establish connection
     peer = ctxt.wrap_socket(peer)
@@ -207,14 +516,25 @@ def initiate(address='127.0.0.1', port=9050, versions=[4, 5]):
     netinfo_cell = lnn.cell.netinfo.cell(peer.recv())
 
     # Sanity checks
-    if not certs_cell.valid:
-        raise RuntimeError('Invalid CERTS cell: {}'.format(certs_cell.raw))
-    if not auth_cell.valid:
-        raise RuntimeError('Invalid AUTH_CHALLENGE cell:{}'.format(
-            auth_cell.raw))
-    if not netinfo_cell.valid:
-        raise RuntimeError('Invalid NETINFO cell: {}'.format(netinfo_cell.raw))
+    _check_handshake(certs_cell, auth_cell, netinfo_cell)
 
     # Send our NETINFO to say "we don't want to authenticate"
     peer.send(lnn.cell.netinfo.pack(address))
     return link(peer, version)
+
+def initiate_async(address='127.0.0.1', port=9050, versions=[4, 5]):
+    """Establish a link from an asyncio event loop (see initiate), to be used
+    as an asynchronous context manager or awaited through its initiate().
+
+    Usage::
+
+      >>> async with lnn.link.initiate_async('127.0.0.1', 5000) as link:
+      ...     state = await lnn.create.fast_async(link)
+
+    :param str address: remote relay address (default: 127.0.0.1).
+    :param int port: remote relay ORPort (default: 9050).
+    :param list versions: target link versions (default: [4, 5]).
+
+    :returns: a link.link_async object (not established yet)
+    """
+    return link_async(address, port, versions)
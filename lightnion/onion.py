@@ -1,9 +1,46 @@
 import cryptography
 import hashlib
-import copy
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import algorithms, modes, Cipher
 
 import lightnion as lnn
 
+class _ctr:
+    '''AES128-CTR keystream (IV=0) that keeps track of its position.
+
+    Unlike cryptography's cipher contexts, it can be rewound (see
+    state.rollback) without having to clone anything beforehand.
+
+    *Note: should not be used explicitly.*
+    '''
+
+    block_len = algorithms.AES.block_size // 8
+
+    def __init__(self, key, offset=0):
+        self.key = key
+        self.seek(offset)
+
+    def seek(self, offset):
+        '''Move to a given position (in bytes) within the keystream.'''
+        block, skip = divmod(offset, self.block_len)
+
+        self._context = Cipher(algorithms.AES(self.key),
+            modes.CTR(block.to_bytes(self.block_len, 'big')),
+            default_backend()).encryptor()
+        if skip > 0:
+            self._context.update(bytes(skip))
+        self.offset = offset
+
+    def rewind(self, length):
+        '''Move `length` bytes backward within the keystream.'''
+        self.seek(self.offset - length)
+
+    def update(self, data):
+        self.offset += len(data)
+        return self._context.update(data)
+
+
 class state:
     '''Handle Tor onion-encryption cryptographic states.
 
@@ -34,6 +71,9 @@ class state:
         self._inner = None
         self.early_count = early_count
 
+        # RELAY cells received, per stream ID (see hop.recv_stream)
+        self.streams = dict()
+
         self._last_material = None
         self._reset_digest(circuit.material)
         self._reset_encryption(circuit.material)
@@ -95,22 +135,10 @@ class state:
             raise RuntimeError('Unsafe! Do NOT reset w/ same material!')
         self._last_material = material
 
-        from cryptography.hazmat.backends import default_backend
-        from cryptography.hazmat.primitives.ciphers import (
-            algorithms, modes, Cipher
-        )
-
-        # Tor uses AES128-CTR with IV=0 as stream cipher
-        nonce_size = algorithms.AES.block_size // 8
-        zeroed_ctr = modes.CTR(b'\x00' * nonce_size)
-
-        # Initiate forward/backward encryption/decryption (as OP) TODO: add OR
-        self.forward_encryptor = Cipher(
-                algorithms.AES(material.forward_key),
-                zeroed_ctr, default_backend()).encryptor()
-        self.backward_decryptor = Cipher(
-                algorithms.AES(material.backward_key),
-                zeroed_ctr, default_backend()).decryptor()
+        # Tor uses AES128-CTR with IV=0 as stream cipher, initiate
+        # forward/backward encryption/decryption (as OP) TODO: add OR
+        self.forward_encryptor = _ctr(material.forward_key)
+        self.backward_decryptor = _ctr(material.backward_key)
 
     def _reset_digest(self, material):
         '''Seed stateful 'running digests' used to authenticate payloads.
@@ -122,32 +150,45 @@ class state:
         self.forward_digest = hashlib.sha1(material.forward_digest)
         self.backward_digest = hashlib.sha1(material.backward_digest)
 
-    def _clone(self):
-        '''Non-recursive clone of current cryptographic state.
+    def _layers(self):
+        '''List of the layers of the onion, from the outermost one.'''
+        layers = [self]
+        while layers[-1]._inner is not None:
+            layers.append(layers[-1]._inner)
+        return layers
 
-        Whenever it is required to rollback after an error, you can use this
-        function to give yourself a clone of the current state.
+    def checkpoint(self):
+        '''Snapshot of the current cryptographic state (all layers).
 
-        *Note: does not clone inner cryptographic states.*
+        States are updated in place: whenever it is required to rollback
+        after an error, take a checkpoint beforehand and give it to
+        state.rollback afterwards.
         '''
+        layers = []
+        for layer in self._layers():
+            layers.append((layer,
+                layer.forward_encryptor.offset,
+                layer.backward_decryptor.offset,
+                layer.forward_digest.copy(),
+                layer.backward_digest.copy()))
 
-        child = state(self.link, self.circuit)
-
-        # Clone digest state (use of hashlib's native hash copy)
-        child.forward_digest = self.forward_digest.copy()
-        child.backward_digest = self.backward_digest.copy()
+        return (self.early_count, layers)
 
-        # Clone encryption state (use of python's ad-hoc copy)
-        child.forward_encryptor = copy.copy(self.forward_encryptor)
-        child.backward_decryptor = copy.copy(self.backward_decryptor)
+    def rollback(self, checkpoint):
+        '''Restore a cryptographic state saved by state.checkpoint.'''
+        early_count, layers = checkpoint
 
-        # Don't forget to propagate the RELAY_EARLY count
-        child._early_count = self._early_count
+        for layer, forward, backward, forward_digest, backward_digest in layers:
+            if layer.forward_encryptor.offset != forward:
+                layer.forward_encryptor.seek(forward)
+            if layer.backward_decryptor.offset != backward:
+                layer.backward_decryptor.seek(backward)
 
-        # (note: we don't recursively clone inner layers of state)
-        child._inner = self._inner
+            # (copies, the checkpoint can be used again)
+            layer.forward_digest = forward_digest.copy()
+            layer.backward_digest = backward_digest.copy()
 
-        return child
+        self._layers()[-1]._early_count = early_count
 
 def core(state, command, payload=b'', stream_id=0):
     '''Build a RELAY{_EARLY,} cell as an onion core (plaintext w/ `state`)
@@ -161,12 +202,11 @@ def core(state, command, payload=b'', stream_id=0):
 
     *Note: should not be called explicitly.*
     '''
-    rollback = state._clone()
 
     # Send RELAY_EARLY cells first
     relay_pack = lnn.cell.relay.pack
-    if rollback.early_count > 0:
-        rollback.early_count -= 1
+    early = state.early_count > 0
+    if early:
         relay_pack = lnn.cell.relay_early.pack
 
     # Compute the cell with a zeroed 'digest' field.
@@ -177,17 +217,21 @@ def core(state, command, payload=b'', stream_id=0):
         stream_id=stream_id,
         digest=b'\x00\x00\x00\x00')
 
+    # (the state is only updated once the cell is built)
+    if early:
+        state.early_count -= 1
+
     # Update the "running digest"
-    rollback.forward_digest.update(cell.relay.raw)
+    state.forward_digest.update(cell.relay.raw)
 
     # Write the "running digest"
-    full_digest = rollback.forward_digest.digest()
+    full_digest = state.forward_digest.digest()
     cell.relay.digest = full_digest[:cell.relay._view.digest.width()]
 
     # Encrypt the to-be-encrypted parts & build final cell
-    cell.relay.raw = rollback.forward_encryptor.update(cell.relay.raw)
+    cell.relay.raw = state.forward_encryptor.update(cell.relay.raw)
 
-    return rollback, cell
+    return state, cell
 
 def build(state, command, payload=b'', stream_id=0):
     '''Build a RELAY{_EARLY,} cell.
@@ -201,17 +245,70 @@ def build(state, command, payload=b'', stream_id=0):
 
     *Note: returns an updated state that MUST be used afterwards.*
     '''
-    if state.depth == 0:
-        return core(state, command, payload, stream_id)
-    rollback = state._clone()
+    layers = state._layers()
 
     # Retrieve the inner layer of the onion
-    rollback._inner, cell = build(rollback._inner, command, payload, stream_id)
+    _, cell = core(layers[-1], command, payload, stream_id)
+
+    # Wraps the layer with our outer layers of encryption
+    for layer in reversed(layers[:-1]):
+        cell.relay.raw = layer.forward_encryptor.update(cell.relay.raw)
+
+    return state, cell
+
+def build_many(state, command, payloads, stream_id=0):
+    '''Build several RELAY{_EARLY,} cells at once.
+
+    Running digests are computed per cell, but each layer of encryption is
+    applied to all the cells with a single cipher update.
+
+    :param state: a state object (see onion.state)
+    :param str command: RELAY{_EARLY,} cell command (see cell.relay.cmd)
+    :param list payloads: RELAY{_EARLY,} cell contents, one per cell
+    :param int stream_id: RELAY{_EARLY,} stream ID (default: 0)
+
+    :returns: a tuple (updated state, list of cells)
+
+    *Note: returns an updated state that MUST be used afterwards.*
+    '''
+    layers = state._layers()
+    inner = layers[-1]
+
+    cells = []
+    for payload in payloads:
+        relay_pack = lnn.cell.relay.pack
+        if inner.early_count - len(cells) > 0:
+            relay_pack = lnn.cell.relay_early.pack
+
+        cells.append(relay_pack(
+            circuit_id=state.circuit.id,
+            cmd=command,
+            data=payload,
+            stream_id=stream_id,
+            digest=b'\x00\x00\x00\x00'))
+
+    if len(cells) == 0:
+        return state, cells
+
+    # (the state is only updated once the cells are built)
+    inner.early_count -= min(inner.early_count, len(cells))
+
+    # Update & write the "running digest" of each cell
+    for cell in cells:
+        inner.forward_digest.update(cell.relay.raw)
+        full_digest = inner.forward_digest.digest()
+        cell.relay.digest = full_digest[:cell.relay._view.digest.width()]
 
-    # Wraps the layer with our outer layer of encryption
-    cell.relay.raw = rollback.forward_encryptor.update(cell.relay.raw)
+    # Encrypt the to-be-encrypted parts, from the inner layer of the onion
+    data = b''.join([cell.relay.raw for cell in cells])
+    for layer in reversed(layers):
+        data = layer.forward_encryptor.update(data)
 
-    return rollback, cell
+    width = len(data) // len(cells)
+    for index, cell in enumerate(cells):
+        cell.relay.raw = data[index * width:(index + 1) * width]
+
+    return state, cells
 
 def recognize(state, cell, backward=True):
     '''Attempt to recognize a RELAY{_EARLY,} cell.
@@ -224,7 +321,6 @@ def recognize(state, cell, backward=True):
 
     *Note: returns an updated state that MUST be used afterwards.*
     '''
-    rollback = state._clone()
 
     # We expect the recognized field to be zeroed upon successful decryption
     if not cell.relay.recognized == b'\x00\x00':
@@ -234,8 +330,9 @@ def recognize(state, cell, backward=True):
     cell_digest = cell.relay.digest
     cell.relay.digest = b'\x00\x00\x00\x00'
 
-    # Update the digest state accordingly (backward or forward)
-    digest = rollback.backward_digest if backward else rollback.forward_digest
+    # Update a copy of the digest state accordingly (backward or forward)
+    digest = state.backward_digest if backward else state.forward_digest
+    digest = digest.copy()
     digest.update(cell.relay.raw)
 
     # Check if the computed digest match the cell digest
@@ -243,7 +340,11 @@ def recognize(state, cell, backward=True):
         return state, False
 
     # Update state iff the digests matched
-    return rollback, True
+    if backward:
+        state.backward_digest = digest
+    else:
+        state.forward_digest = digest
+    return state, True
 
 def peel(state, cell):
     '''Decrypt a RELAY{_EARLY,} cell using provided `state`.
@@ -255,16 +356,74 @@ def peel(state, cell):
 
     *Note: returns an updated state that MUST be used afterwards.*
     '''
-    rollback = state._clone()
+    layers = state._layers()
+
+    for layer in layers:
+        cell.relay.raw = layer.backward_decryptor.update(cell.relay.raw)
+
+    _, recognized = recognize(layers[-1], cell)
+    if not recognized:
+        # (rewind the keystreams, the state is left untouched)
+        for layer in layers:
+            layer.backward_decryptor.rewind(len(cell.relay.raw))
+
+        raise RuntimeError(
+            'Got an unrecognized RELAY cell: {}'.format(cell.raw))
+
+    return state, cell
+
+class unrecognized(RuntimeError):
+    '''Raised by peel_many when a cell of the batch is not recognized.
+
+    :param cells: cells recognized before the failing one (decrypted)
+    :param pending: the failing cell then the following ones (encrypted)
 
-    cell.relay.raw = rollback.backward_decryptor.update(cell.relay.raw)
-    if rollback.depth == 0:
-        rollback, recognized = recognize(rollback, cell)
+    *Note: the state is left as if only `cells` had been peeled.*
+    '''
+    def __init__(self, cells, pending):
+        super().__init__('Got an unrecognized RELAY cell: {}'.format(
+            pending[0].raw))
+        self.cells = cells
+        self.pending = pending
+
+def peel_many(state, cells):
+    '''Decrypt several RELAY{_EARLY,} cells at once using provided `state`.
+
+    Each layer of encryption is removed from all the cells with a single
+    cipher update, then cells are recognized one by one.
+
+    :param state: a state object (see onion.state)
+    :param list cells: RELAY{_EARLY,} cell objects (see cell.relay.cell)
+
+    :returns: a tuple (updated state, list of decrypted cells)
+
+    *Note: returns an updated state that MUST be used afterwards, raises
+    onion.unrecognized if a cell is not recognized.*
+    '''
+    if len(cells) == 0:
+        return state, cells
+
+    layers = state._layers()
+    inner = layers[-1]
+
+    encrypted = [cell.relay.raw for cell in cells]
+    data = b''.join(encrypted)
+    for layer in layers:
+        data = layer.backward_decryptor.update(data)
+
+    width = len(data) // len(cells)
+    for index, cell in enumerate(cells):
+        cell.relay.raw = data[index * width:(index + 1) * width]
+
+        _, recognized = recognize(inner, cell)
         if not recognized:
-            raise RuntimeError(
-                'Got an unrecognized RELAY cell: {}'.format(cell.raw))
+            # (rewind the keystreams from the failing cell onwards, the
+            #  cells recognized so far are kept)
+            for layer in layers:
+                layer.backward_decryptor.rewind(len(data) - index * width)
 
-        return rollback, cell
+            for other, raw in zip(cells[index:], encrypted[index:]):
+                other.relay.raw = raw
+            raise unrecognized(cells[:index], cells[index:])
 
-    rollback._inner, cell = peel(rollback._inner, cell)
-    return rollback, cell
+    return state, cells
@@ -3,4 +3,7 @@ fake_circuit_id = 0x80000000
 api_version = 0.1
 base_url = '/lightnion/api/v{}'.format(api_version)
 
-from . import parts, auth, jobs, link
+# Websocket subprotocol to pack several cells per frame (opt-in).
+multicell_subprotocol = 'lightnion-multicell'
+
+from . import parts, trace, metrics, scheduler, timers, auth, workers, jobs, link
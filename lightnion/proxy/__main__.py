@@ -50,6 +50,25 @@ if __name__ == '__main__':
     parser.add_argument('-d', required=False, default='7000',
         metavar='dir_port', help='Dir port for consensus retrieval.'
         + ' (default: 7000)')
+    parser.add_argument('--flush-delay', type=int, required=False, default=0,
+        metavar='usec', help='Wait up to usec microseconds for more cells'
+        + ' before writing an incomplete batch to the guard. (default: 0)')
+    parser.add_argument('--overflow', required=False, default='destroy',
+        choices=['destroy', 'drop'], help='What to do with cells for a client'
+        + ' that does not keep up with its circuit. (default: destroy)')
+    parser.add_argument('--trace-cells', type=int, required=False, default=0,
+        metavar='n', help='Log one relayed cell out of n. (default: 0, off)')
+    parser.add_argument('--ws-port', type=int, required=False, default=8765,
+        metavar='port', help='Serve channel websockets on this dedicated'
+        + ' port (the fast path). They are always served on the HTTP port'
+        + ' too, as a slower fallback (about half the cells/s with one cell'
+        + ' per frame); 0 opts in to that fallback only. (default: 8765)')
+    parser.add_argument('--workers', type=int, required=False, default=1,
+        metavar='n', help='Run n processes sharing the ports, each one with'
+        + ' its own guard link. (default: 1)')
+    parser.add_argument('--worker-ports', type=int, required=False, default=15000,
+        metavar='port', help='First of the private ports (2 per worker) used'
+        + ' between workers on localhost. (default: 15000)')
     parser.add_argument('-v', action='count',
                         help='Verbose output (up to -vvv)')
     parser.add_argument('--compute-path', action='store_true',
@@ -78,10 +97,18 @@ if __name__ == '__main__':
 
     argv.d = _validate_port(argv.d)
 
+    if argv.trace_cells > 0:
+        lightnion.proxy.trace.enable(argv.trace_cells)
+
     lightnion.proxy.forward.main(
         port=argv.p,
         slave_node=argv.s,
         dir_port=argv.d,
         control_port=argv.c,
         compute_path=argv.compute_path,
-        auth_dir=argv.auth_dirpkey if argv.auth_enabled else None)
+        auth_dir=argv.auth_dirpkey if argv.auth_enabled else None,
+        flush_delay=argv.flush_delay / 1e6,
+        overflow=argv.overflow,
+        ws_port=argv.ws_port or None,
+        workers=argv.workers,
+        worker_ports=argv.worker_ports)
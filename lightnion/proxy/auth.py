@@ -19,7 +19,10 @@ class material(collections.namedtuple('material', ['pkey', 'secret'])):
         return str(suffix.replace(b'=', b''), 'utf8')
 
     def perform(self, client, data):
-        data = bytes(json.dumps(data), 'utf8')
+        # (data may already be serialized, see parts.json_cache)
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        data = bytes(data, 'utf8')
         client = base64.b64decode(client)
 
         material, msg = lnn.crypto.ntor.server(self.pkey, self.secret,
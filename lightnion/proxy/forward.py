@@ -1,6 +1,7 @@
 import asyncio
 import base64
 import logging
+import json
 import signal
 import string
 import sys
@@ -38,7 +39,8 @@ logger.addHandler(handler)
 
 
 class clerk():
-    def __init__(self, slave_node, control_port, dir_port, compute_path, auth_dir=None):
+    def __init__(self, slave_node, control_port, dir_port, compute_path, auth_dir=None, flush_delay=0, overflow='destroy', worker=None,
+            ws_port=8765):
         #super().__init__()
         logging.info('Bootstrapping clerk.')
         self.crypto = lnn.proxy.parts.crypto()
@@ -66,6 +68,7 @@ class clerk():
         self.descriptors_raw = None
         self.mic_consensus_raw = None
         self.mic_descriptors_raw = None
+        self.consensus_valid_after = None
 
         #self.consm = None
         #self.descm = None
@@ -74,6 +77,9 @@ class clerk():
 
         self.timer_consensus = None
 
+        # JSON of the guard and path descriptors sent to clients.
+        self.json_cache = lnn.proxy.parts.json_cache()
+
         self.guard_node = None
 
         self.control_port = control_port
@@ -81,6 +87,19 @@ class clerk():
         self.slave_node = slave_node
         self.compute_path = compute_path
 
+        # Time allowed to the link to batch cells together.
+        self.flush_delay = flush_delay
+
+        # What to do when a client does not keep up with its circuit.
+        self.overflow = overflow
+
+        # Worker of a multi-process proxy (None if single process).
+        self.worker = worker
+
+        # Dedicated websocket port, the fast path (channels are also served on
+        # the HTTP port, a slower fallback for deployments with one port).
+        self.ws_port = ws_port
+
         self.link = None
         self.channel_manager = None
         self.websocket_manager = None
@@ -89,13 +108,30 @@ class clerk():
     def prepare(self):
         guard = self.get_guard()
 
-        self.link = lnn.proxy.link.Link(guard)
-        self.channel_manager = lnn.proxy.jobs.ChannelManager()
-        self.websocket_manager = lnn.proxy.jobs.WebsocketManager()
+        self.link = lnn.proxy.link.Link(guard, flush_delay=self.flush_delay)
+        crypto = None
+        if self.worker is not None:
+            crypto = self.worker.crypto
+
+        self.channel_manager = lnn.proxy.jobs.ChannelManager(overflow=self.overflow, crypto=crypto)
+        self.websocket_manager = lnn.proxy.jobs.WebsocketManager(port=self.ws_port, worker=self.worker)
 
         self.link.set_channel_manager(self.channel_manager)
         self.channel_manager.set_link(self.link)
         self.websocket_manager.set_channel_manager(self.channel_manager)
+        self.websocket_manager.set_channel_factory(self.create_channel)
+
+        lnn.proxy.metrics.channels.set_function(
+            lambda: len(self.channel_manager.channels))
+        lnn.proxy.metrics.link_queue.set_function(
+            lambda: self.link.to_send.qsize())
+        lnn.proxy.metrics.link_circuit_queue.set_function(
+            lambda: {(cid,): depth
+                for cid, depth in self.link.to_send.depths().items()})
+        lnn.proxy.metrics.channel_queue.set_function(
+            lambda: {(cid,): channel.to_send.qsize()
+                for cid, channel in list(self.channel_manager.channels.items())})
+        lnn.proxy.metrics.consensus_age.set_function(self.consensus_age)
 
 
     def retrieve_consensus(self):
@@ -109,6 +145,7 @@ class clerk():
         host = self.slave_node[0]
         port = self.dir_port
 
+        start = time.perf_counter()
 
         # retrieve consensus and descriptors
         if self.compute_path:
@@ -117,6 +154,7 @@ class clerk():
             self.consensus = cons
             self.signing_keys = sg_keys
             self.descriptors = desc
+            self.json_cache.clear()
 
             #self.consm,sg_keysm = lnn.consensus.download_direct(self.slave_node[0], self.dir_port)
             #self.descm = lnn.descriptors.download_direct(self.slave_node[0], self.dir_port, self.consm, flavor='microdesc')
@@ -133,7 +171,11 @@ class clerk():
         digests = lnn.consensus.extract_nodes_digests_micro(self.mic_consensus_raw)
         self.mic_descriptors_raw = lnn.descriptors.download_raw_by_digests_micro(host, port, digests)
 
+        lnn.proxy.metrics.consensus_refresh.observe(time.perf_counter() - start)
+
         try:
+            self.consensus_valid_after = lnn.consensus.extract_date(self.consensus_raw, 'valid-after')
+
             # Compute delay until retrival of the next consensus.
             fresh_until = lnn.consensus.extract_date(self.consensus_raw, 'fresh-until')
             now = datetime.utcnow()
@@ -168,6 +210,39 @@ class clerk():
             time.sleep(1)
 
 
+    def create_channel(self, select_path, auth=None):
+        """
+        Create a channel, for POST /channels or a one-shot websocket.
+        :param select_path: whether the client selects its own path.
+        :param auth: client authentication material (if enabled).
+        :return: token of the channel, information sent to the client (JSON)
+        """
+        if auth is not None and self.auth is None:
+            raise RuntimeError('Authentication is not enabled.')
+
+        if not select_path:
+            self.wait_for_consensus()
+
+        with lnn.proxy.metrics.channel_create.time():
+            ckt_info = self.channel_manager.create_channel(self.consensus, self.descriptors, select_path)
+
+        token = ckt_info['id']
+        ckt_info = self.json_cache.dumps(ckt_info)
+        if auth is not None:
+            ckt_info = json.dumps(self.auth.perform(auth, ckt_info))
+        return token, ckt_info
+
+
+    def consensus_age(self):
+        """
+        :return: seconds elapsed since the current consensus became valid.
+        """
+        if self.consensus_valid_after is None:
+            return None
+
+        return (datetime.utcnow() - self.consensus_valid_after).total_seconds()
+
+
     def get_descriptor_unflavoured(self, router):
         """Retrieve a descriptor.
         :param router: Router from which we want the descriptor.
@@ -296,11 +371,8 @@ async def create_channel():
     Create a channel.
     """
     payload = await quart.request.get_json()
-    #if not payload or not 'ntor' in payload:
-    #    quart.abort(400)
 
     logging.info('Create new channel.')
-    #ntor = payload['ntor']
 
     auth = None
     if 'auth' in payload:
@@ -313,32 +385,70 @@ async def create_channel():
         if payload['select_path'] == "true":
             select_path = True
 
-    if not select_path:
-        app.clerk.wait_for_consensus()
-
     try:
-        #data = app.clerk.create.perform(data)
-        ckt_info = app.clerk.channel_manager.create_channel( app.clerk.consensus, app.clerk.descriptors, select_path)
-        if auth is not None:
-            # TODO the proxy pack the ntor key in a tor cell, this can be done client side.
-            ckt_info = app.clerk.auth.perform(auth,ckt_info)
+        _, ckt_info = app.clerk.create_channel(select_path, auth)
 
-        response = quart.jsonify(ckt_info)
-        return response, 201 # Created
+        return quart.Response(ckt_info, status=201, content_type='application/json') # Created
 
     except Exception as e:
         logging.exception(e)
         quart.abort(503)
 
 
+@app.route(url + '/metrics')
+async def get_metrics():
+    """
+    Retrieve proxy metrics (Prometheus text format).
+    """
+    body = lnn.proxy.metrics.render()
+    return quart.Response(body, status=200, content_type=lnn.proxy.metrics.content_type)
+
+
+@app.websocket(url + '/channels')
+async def channel_websocket_oneshot():
+    """
+    Create a channel and open its websocket at once (see WebsocketManager).
+    """
+    path = quart.websocket.path
+    query = quart.websocket.query_string.decode('ascii', 'replace')
+    if query:
+        path += '?' + query
+
+    ws = lnn.proxy.jobs.QuartWebsocket(quart.websocket._get_current_object())
+    await ws.accept()
+    await app.clerk.websocket_manager.handle(ws, path)
+
+
+@app.websocket(url + '/channels/<uid>')
+async def channel_websocket(uid):
+    """
+    Channel websocket, on the same port as the API (see WebsocketManager):
+    a fallback for clients that cannot reach the dedicated websocket port,
+    slower than it (frames go through hypercorn and Quart).
+    :param uid: channel identifier
+    """
+    ws = lnn.proxy.jobs.QuartWebsocket(quart.websocket._get_current_object())
+    await ws.accept()
+    await app.clerk.websocket_manager.handle(ws, quart.websocket.path)
+
+
 @app.route(url + '/channels/<uid>', methods=['DELETE'])
 async def delete_channel(uid):
     """
     Delete a channel.
     :param uid: channel identifier
     """
+    worker = app.clerk.worker
+    if worker is not None:
+        owner = worker.owner(uid)
+        if owner is not None and owner != worker.id:
+            status = await worker.forward_delete(quart.request.path, owner)
+            return quart.jsonify({}), status
+
     try:
         channel = app.clerk.channel_manager.get_channel_by_token(uid)
+    except lnn.proxy.jobs.TooManyInvalidTokensException:
+        quart.abort(429)
     except Exception as e:
         logging.exception(e)
         quart.abort(404)
@@ -373,16 +483,28 @@ async def loop_signal_handler(signum, loop):
     loop.stop()
 
 
-def main(port, slave_node, control_port, dir_port, compute_path, auth_dir=None):
+def main(port, slave_node, control_port, dir_port, compute_path, auth_dir=None, flush_delay=0, overflow='destroy',
+        workers=1, worker_ports=15000, worker=None, ws_port=8765):
     """
     Entry point
+    :param workers: number of processes sharing the ports (each one with its own guard link).
+    :param worker_ports: first of the private (localhost) ports used between workers.
+    :param worker: worker run by this process (set by workers.spawn).
+    :param ws_port: dedicated websocket port (None to only use the slower
+                    HTTP port fallback).
     """
 
+    if worker is None and workers > 1:
+        lnn.proxy.workers.spawn(workers, worker_ports, main, dict(port=port, slave_node=slave_node,
+            control_port=control_port, dir_port=dir_port, compute_path=compute_path, auth_dir=auth_dir,
+            flush_delay=flush_delay, overflow=overflow, ws_port=ws_port))
+        return
+
     #if static_files is not None:
     #    from werkzeug import SharedDataMiddleware
     #    app.wsgi_app = SharedDataMiddleware(app.wsgi_app, static_files)
 
-    app.clerk = clerk(slave_node, control_port, dir_port, compute_path, auth_dir)
+    app.clerk = clerk(slave_node, control_port, dir_port, compute_path, auth_dir, flush_delay, overflow, worker, ws_port)
     logging.info('Bootstrapping HTTP server.')
 
     logging.getLogger(websockets.__name__).setLevel(logging.INFO)
@@ -398,9 +520,14 @@ def main(port, slave_node, control_port, dir_port, compute_path, auth_dir=None):
 
     try:
         loop.create_task(app.clerk.link.connection)
-        loop.create_task(app.clerk.websocket_manager.serve(loop))
+        loop.create_task(app.clerk.websocket_manager.serve())
+        loop.create_task(app.clerk.channel_manager.reap())
 
-        app.run(host='0.0.0.0', port=port, debug=debug, loop=loop, use_reloader=False)
+        if worker is None:
+            app.run(host='0.0.0.0', port=port, debug=debug, loop=loop, use_reloader=False)
+        else:
+            loop.create_task(worker.serve_http(app, '0.0.0.0', port))
+            loop.run_forever()
     except Exception:
         pass
     finally:
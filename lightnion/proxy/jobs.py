@@ -1,3 +1,4 @@
+import urllib.parse
 import logging
 import hashlib
 import base64
@@ -6,7 +7,7 @@ import websockets
 import asyncio
 
 import lightnion as lnn
-from . import parts, base_url, fake_circuit_id
+from . import parts, trace, metrics, timers, base_url, fake_circuit_id, multicell_subprotocol
 import lightnion.path_selection
 import lightnion.utils
 
@@ -15,6 +16,10 @@ class InvalidTokenException(Exception):
     def __init__(self, token):
         super().__init__('Value {} is not a valid token.'.format(token))
 
+class TooManyInvalidTokensException(Exception):
+    def __init__(self):
+        super().__init__('Too many invalid tokens, try again later.')
+
 class CircuitDoesNotExistException(Exception):
     def __init__(self, cid):
         super().__init__('Circuit id {} does not exist.'.format(cid))
@@ -37,19 +42,27 @@ class Channel:
     """
     Channel
     """
-    def __init__(self, token, cid):
+    def __init__(self, token, cid, max_queue=2048):
         """
         Channel constructor.
         :param token: Token identifyint the channel.
         :param cid: Circuit id corresponding to the channel.
+        :param max_queue: number of cells buffered for the client.
         """
         self.token = token
         self.cid = cid
 
-        self.to_send = asyncio.Queue(2048)
+        self.to_send = asyncio.Queue(max_queue)
 
         self.destroyed = asyncio.Event()
 
+        # Time without activity until the channel expires.
+        self.timeout = None
+
+        # Share of the link traffic taken by (and refused to) this channel.
+        self.cells_recv = 0
+        self.cells_dropped = 0
+
 
 class ChannelManager:
     """
@@ -59,13 +72,51 @@ class ChannelManager:
     # Cryptographic tools to generate tokens.
     crypto = parts.crypto()
 
-    def __init__(self):
+    # What to do with a cell for a client whose queue is full.
+    overflow_policies = ('destroy', 'drop')
+
+    def __init__(self, overflow='destroy', channel_queue=2048, open_timeout=60, grace=5,
+            max_tokens=65536, invalid_tokens=(100, 1000), crypto=None):
         """
         Channel manager constructor
-        """
+        :param overflow: policy when a client does not keep up with its
+                         circuit, either 'destroy' the circuit or 'drop' cells.
+        :param channel_queue: number of cells buffered per channel.
+        :param open_timeout: time (in seconds) given to a client to open the
+                             websocket of a new channel.
+        :param grace: time (in seconds) a destroyed channel is kept for its
+                      websocket to be closed.
+        :param max_tokens: number of tokens looked up without decryption.
+        :param invalid_tokens: (rate per second, burst) of token lookups that
+                               may fail before lookups are refused.
+        :param crypto: token generator (shared key of the workers), defaults
+                       to the one of the class.
+        """
+        if overflow not in self.overflow_policies:
+            raise ValueError('Invalid overflow policy: {}'.format(overflow))
+
+        if crypto is not None:
+            self.crypto = crypto
+
         # channels identified by a token
         self.channels = dict()
 
+        # Tokens issued by create_channel, only decrypted if not found here.
+        self.tokens = dict()
+        self.max_tokens = max_tokens
+        self.invalid_tokens = parts.token_bucket(*invalid_tokens)
+
+        self.overflow = overflow
+        self.channel_queue = channel_queue
+
+        # Cells received from the link for all channels.
+        self.cells_recv = 0
+
+        # Channels left unused expire, see reap().
+        self.timers = timers.TimerWheel()
+        self.open_timeout = open_timeout
+        self.grace = grace
+
         # link and main token set later
         self.link = None
         self.maintoken = None
@@ -80,7 +131,7 @@ class ChannelManager:
 
         if cid is None:
             logging.debug('ChanMgr: Invalid token: {}'.format(token))
-            raise InvalidTokenException()
+            raise InvalidTokenException(token)
 
         return cid
 
@@ -142,32 +193,28 @@ class ChannelManager:
 
     def create_channel(self, consensus, descriptors, select_path):
         """
-        Create a new channel.
-        :param ntor: First part of the ntor handshake provided by the client.
+        Create a new channel, the client then sends its CREATE2 cell as the
+        first cell of the websocket.
         :param consensus: The current consensus.
         :param descriptors: A collection of the current descriptors.
+        :param select_path: whether the client selects its own path.
         :return: Response to be send to the client
         """
-
-        # TODO: Currently, the ntor is provided by the client to be packaged
-        #       in the proxy and send back to the client to be send again to
-        #       the websocket. This need to be simplified.
-
         if self.link is None:
             raise LinkNotInitializedException()
 
-        #ntor_bin = base64.b64decode(ntor)
-
         cid = self.link.gen_cid()
         token = self.gen_token_from_cid(cid)
 
-        #cell = lnn.create.ntor_raw2(cid, ntor_bin)
-        #cell = base64.b64encode(cell).decode('utf-8')
-
-        self.channels[cid] = Channel(token, cid)
+        self.channels[cid] = Channel(token, cid, self.channel_queue)
+        if len(self.tokens) < self.max_tokens:
+            self.tokens[token] = self.channels[cid]
+        self.channels[cid].timeout = self.open_timeout
+        self.timers.arm(cid, self.open_timeout)
 
         if not select_path:
-            (middle, exit) = lnn.path_selection.select_end_path_from_consensus(consensus, descriptors, self.link.guard)
+            with metrics.path_selection.time():
+                (middle, exit) = lnn.path_selection.select_end_path_from_consensus(consensus, descriptors, self.link.guard)
             logging.warning('Middle {}'.format(middle['router']['nickname']))
             logging.warning('Exit {}'.format(exit['router']['nickname']))
             response = {'id': token, 'path': [middle, exit], 'guard': self.link.guard}
@@ -185,6 +232,9 @@ class ChannelManager:
         """
         if channel.cid in self.channels.keys():
             del self.channels[channel.cid]
+            self.tokens.pop(channel.token, None)
+            self.timers.cancel(channel.cid)
+            self.link.to_send.forget(channel.cid)
             logging.debug('ChanMgr: Channel {} with token {} deleted.'.format(channel.cid, channel.token))
 
 
@@ -205,10 +255,119 @@ class ChannelManager:
 
         # Destroy the channel.
         channel.destroyed.set()
+        self.timers.arm(channel.cid, self.grace)
 
         logging.debug('ChanMgr: Prepare to delete circuit {} from client.'.format(cid))
 
 
+    def _destroy_circuit_nowait(self, channel, reason):
+        """
+        Destroy a circuit from the client side without waiting for the link.
+        :param channel: Channel handling the circuit to be destroyed.
+        :param reason: reason given to the relay in the DESTROY cell.
+        """
+
+        cell = lnn.cell.destroy.pack(channel.cid, reason)
+        cell_padded = lnn.utils.cell_pad_null(cell.raw)
+
+        try:
+            self.link.to_send.put_nowait(cell_padded)
+        except asyncio.QueueFull:
+            # (never block the link reader, the cell is queued later on)
+            asyncio.ensure_future(self.link.to_send.put(cell_padded))
+
+        channel.destroyed.set()
+        self.timers.arm(channel.cid, self.grace)
+
+        logging.debug('ChanMgr: Prepare to delete circuit %d, reason: %s.', channel.cid, reason)
+
+
+    def _overflow(self, channel):
+        """
+        Apply the overflow policy to a channel whose queue is full.
+        :param channel: Channel that does not keep up with its circuit.
+        """
+
+        channel.cells_dropped += 1
+        metrics.overflow_cells.labels(self.overflow).inc()
+
+        if self.overflow == 'destroy':
+            logging.warning('ChanMgr: Channel %d is too slow, destroy its circuit.', channel.cid)
+            self._destroy_circuit_nowait(channel, lnn.cell.destroy.reason.RESOURCELIMIT)
+            metrics.overflow_channels.inc()
+        else:
+            logging.debug('ChanMgr: Channel %d is too slow, drop a cell.', channel.cid)
+
+
+    def open_channel(self, channel, timeout):
+        """
+        Notify that the client of a channel connected to its websocket.
+        :param channel: Channel opened by its client.
+        :param timeout: time (in seconds) without activity until the
+                        channel expires.
+        """
+        if channel.destroyed.is_set():
+            return
+
+        channel.timeout = timeout
+        self.timers.arm(channel.cid, timeout)
+
+
+    def touch(self, channel):
+        """
+        Notify some activity on a channel, postpone its expiration.
+        :param channel: Channel with activity.
+        """
+        if not channel.destroyed.is_set():
+            self.timers.touch(channel.cid, channel.timeout)
+
+
+    def close_channel(self, channel):
+        """
+        The client of a channel left: destroy its circuit (if not already
+        done) and delete the channel.
+        :param channel: Channel whose websocket is closed.
+        """
+        if channel.cid not in self.channels:
+            return
+
+        if not channel.destroyed.is_set():
+            self._destroy_circuit_nowait(channel, lnn.cell.destroy.reason.REQUESTED)
+
+        self.delete_channel(channel)
+
+
+    def _expire(self, cid):
+        """
+        Destroy the circuit of an expired channel (if needed) and delete it.
+        :param cid: circuit id of the channel.
+        """
+        channel = self.channels.get(cid)
+        if channel is None:
+            return
+
+        if not channel.destroyed.is_set():
+            logging.info('ChanMgr: Channel %d expired.', cid)
+            self._destroy_circuit_nowait(channel, lnn.cell.destroy.reason.FINISHED)
+            metrics.expired_channels.inc()
+
+        self.delete_channel(channel)
+
+
+    async def reap(self):
+        """
+        Coroutine
+        Periodically delete the channels that expired: never opened by their
+        client, without activity, or destroyed but left behind.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.timers.resolution)
+
+            for cid in self.timers.advance(loop.time()):
+                self._expire(cid)
+
+
     async def destroy_circuit_from_link(self, channel):
         """
         Destroy a circuit corresponding to a channel as if the order was comming from the link side.
@@ -217,6 +376,7 @@ class ChannelManager:
 
         # Destroy the channel.
         channel.destroyed.set()
+        self.timers.arm(channel.cid, self.grace)
 
         logging.debug('ChanMgr: Prepare to delete channel {} from link.'.format(channel.cid))
 
@@ -227,7 +387,19 @@ class ChannelManager:
         :param token: Token identifying the channel.
         """
 
-        cid = self._cid_from_token(token)
+        channel = self.tokens.get(token)
+        if channel is not None:
+            return channel
+
+        # Decrypt unknown tokens, unless too many of them were invalid.
+        if not self.invalid_tokens.available():
+            raise TooManyInvalidTokensException()
+
+        try:
+            cid = self._cid_from_token(token)
+        except InvalidTokenException:
+            self.invalid_tokens.consume()
+            raise
 
         if cid not in self.channels.keys():
             raise ChannelDoesNotExistException(token)
@@ -240,24 +412,24 @@ class ChannelManager:
         Scedule the data to be send to the correct channel.
         :param cell: cell to be send.
         """
-        logging.debug('ChanMgr: Begin adding data to sending queue of channel {}.'.format(cid))
+        logging.debug('ChanMgr: Begin adding data to sending queue of channel %d.', cid)
         
         if cid not in self.channels.keys():
-            logging.warning('ChanMgr: Channel {} does not exists.'.format(cid))
+            logging.warning('ChanMgr: Channel %d does not exists.', cid)
             return
             #raise CircuitDoesNotExistException(cid)
 
         channel = self.channels[cid]
 
         if channel.destroyed.is_set():
-            logging.warning('ChanMgr: Channel {} is destroyed.'.format(cid))
+            logging.warning('ChanMgr: Channel %d is destroyed.', cid)
             return
             #raise CircuitDoesNotExistException(cid)
 
         # If the cell command to delete the circuit,
-        header = lnn.cell.header(cell)
-        if header.cmd is lnn.cell.cmd.DESTROY:
-            cell_validation = lnn.cell.destroy.cell(cell)
+        cmd = lnn.utils.cell_get_cmd(cell)
+        if cmd == int(lnn.cell.cmd.DESTROY):
+            cell_validation = lnn.cell.destroy.cell(bytes(cell))
             logging.warning('ChanMgr: DESTROY cell received for channel {}, reason: {}.'.format(cid, cell_validation.reason))
             if not cell_validation.valid:
                 logging.debug('ChanMgr: Invalid DESTROY in channel {}.'.format(cid))
@@ -267,37 +439,116 @@ class ChannelManager:
 
             return
 
-        cell_padded = lnn.cell.pad(cell)
+        # (cells are sliced by the link reader, their header is already checked)
+        cell_padded = lnn.utils.cell_pad_null(cell)
+
+        # Never wait for a client here: the link reader is shared by all channels.
+        self.cells_recv += 1
+        channel.cells_recv += 1
+        self.touch(channel)
+        try:
+            channel.to_send.put_nowait(cell_padded)
+        except asyncio.QueueFull:
+            self._overflow(channel)
+            return
+
+        logging.debug('ChanMgr: Data added to sending queue of channel %d.', channel.cid)
+
+
+
+def _select_subprotocol(ws, subprotocols):
+    """
+    Accept multi-cell frames if requested, plain websockets otherwise.
+    """
+    if multicell_subprotocol in subprotocols:
+        return multicell_subprotocol
+    return None
+
+
+class QuartWebsocket:
+    """
+    Gives a Quart websocket the interface of a connection of the websockets
+    library, so that WebsocketManager serves the channels on the HTTP port.
+    """
 
-        await channel.to_send.put(cell_padded)
+    def __init__(self, websocket):
+        """
+        :param websocket: Quart websocket (quart.websocket._get_current_object()).
+        """
+        self.websocket = websocket
+        self.subprotocol = None
+        self.closed = False
+
+    async def accept(self):
+        """
+        Accept the connection, with multi-cell frames if requested.
+        """
+        if multicell_subprotocol in self.websocket.requested_subprotocols:
+            self.subprotocol = multicell_subprotocol
+        await self.websocket.accept(subprotocol=self.subprotocol)
+
+    async def recv(self):
+        if self.closed:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        return await self.websocket.receive()
 
-        logging.debug('ChanMgr: Data added to sending queue of channel {}.'.format(channel.cid))
+    async def send(self, message):
+        await self.websocket.send(message)
 
+    async def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            await self.websocket.close(code)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        return await self.recv()
 
 
 class WebsocketManager:
     prefix = base_url + '/channels/'
     prefix_len = len(prefix)
 
-    def __init__(self, host='0.0.0.0', port=8765, timeout=60):
+    # Websockets opened here create their channel (no POST /channels needed).
+    oneshot_path = base_url + '/channels'
+
+    def __init__(self, host='0.0.0.0', port=8765, timeout=60, frame_size=16384, frame_delay=0, worker=None):
         """
         Websocket server
         :param host: host on which the websocket need to run.
-        :param port: port on which the websocket is listening.
+        :param port: port on which the websocket is listening (None to only
+                     serve channels through the HTTP server, see handle).
         :param timeout: timeout before closing the connection.
+        :param frame_size: number of bytes packed in a multi-cell frame.
+        :param frame_delay: time (in seconds) waited for more cells before
+                            sending an incomplete multi-cell frame.
+        :param worker: worker sharing the port with others (see workers.Worker).
         """
 
-        # Time witout activity until channel is deleted.
+        # Time witout activity until channel is deleted (see ChannelManager.reap).
         self.timeout = timeout
 
-        # The channel manager is set later
+        # Caps of frames sent to clients using the multi-cell subprotocol.
+        self.frame_size = frame_size
+        self.frame_delay = frame_delay
+
+        # The channel manager (and factory) are set later
         self.channel_manager = None
+        self.channel_factory = None
 
         # The websocket server
         self.host = host
         self.port = port
         self.server = None
 
+        # Connections for channels of other workers are relayed to them.
+        self.worker = worker
+        self.private_server = None
+
         self.cell_sent = 0
         self.cell_recv = 0
 
@@ -305,19 +556,28 @@ class WebsocketManager:
         logging.debug('WsServ: Websocket server prepared ({}:{})'.format(host, port))
 
 
-    async def serve(self, loop):
+    async def serve(self):
         """
-        Create and start a websocket server, then wait for it to close.        
-        :param host: host on which the websocket need to run.
-        :param port: port on which the websocket is listening.
+        Create and start the websocket servers (see self.host and self.port).
         """
-        self.server = await websockets.serve(self._handler, self.host, self.port, loop=loop, compression=None)
+        # (without port, channels are only served on the HTTP port, see handle)
+        if self.port and self.worker is None:
+            self.server = await websockets.serve(self._serve, self.host, self.port, compression=None,
+                select_subprotocol=_select_subprotocol)
+        elif self.port:
+            self.server = await websockets.serve(self._serve, self.host, self.port, compression=None,
+                select_subprotocol=_select_subprotocol, reuse_port=True)
+
+        if self.worker is not None:
+            self.private_server = await websockets.serve(self._serve, '127.0.0.1', self.worker.websocket_port(),
+                compression=None, select_subprotocol=_select_subprotocol)
 
 
     async def stop(self):
-        if self.server is not None:
-            self.server.close()
-        await self.server.wait_closed()
+        for server in [self.server, self.private_server]:
+            if server is not None:
+                server.close()
+                await server.wait_closed()
         logging.debug('WsServ: Websocket server closed.')
 
 
@@ -330,6 +590,44 @@ class WebsocketManager:
         logging.debug('WsServ: Channel manager set.')
 
 
+    def set_channel_factory(self, channel_factory):
+        """
+        Set the function creating channels for one-shot websockets.
+        :param channel_factory: called with (select_path, auth), returns the
+                                token of the channel and the information
+                                sent to the client (JSON, as in POST /channels).
+        """
+        self.channel_factory = channel_factory
+
+
+    async def _open(self, ws, query):
+        """
+        Create the channel of a one-shot websocket, its information is sent
+        to the client as a first text message.
+        :param ws: The websocket used to communicate with the client.
+        :param query: query string of the websocket path.
+        :return: the channel, None if it was not created.
+        """
+        if self.channel_factory is None:
+            logging.warning('WsServ: One-shot websockets are not enabled.')
+            return None
+
+        # (base64 auth material is often sent as is, keep its '+' intact)
+        query = urllib.parse.parse_qs(query.replace('+', '%2B'))
+        select_path = query.get('select_path', ['false'])[0] == 'true'
+        auth = query.get('auth', [None])[0]
+
+        try:
+            token, response = self.channel_factory(select_path, auth)
+            channel = self.channel_manager.get_channel_by_token(token)
+        except Exception as e:
+            logging.exception(e)
+            return None
+
+        await ws.send(response)
+        return channel
+
+
     async def _recv(self, ws, channel):
         """
         Handler to receive a message from the client via the websocket.
@@ -337,14 +635,17 @@ class WebsocketManager:
         :param channel: Channel correspondind to the client from which data is recieved.
         """
 
-        while not ws.closed:
+        while True:
             try:
                 cell = await ws.recv()
 
                 self.cell_recv += 1
-                logging.info('cell {} recv by wbskt: {}'.format(self.cell_recv, cell[:20].hex()))
-                logging.debug('WsServ: Recieved cell from channel {}: {}... {} bytes.'.format(channel.cid, cell[:20], len(cell)))
+                metrics.client_recv_cells.inc()
+                metrics.client_recv_bytes.inc(len(cell))
+                if trace.period:
+                    trace.cell('recv by wbskt', self.cell_recv, cell)
 
+                self.channel_manager.touch(channel)
                 await self.channel_manager.link.schedule_to_send(cell, channel)
 
             except websockets.exceptions.ConnectionClosedError:
@@ -356,6 +657,43 @@ class WebsocketManager:
                 return
 
 
+    async def _recv_multicell(self, ws, channel):
+        """
+        Handler to receive frames containing several cells from the client.
+        :param ws: websocket used to communicate with the client.
+        :param channel: Channel correspondind to the client from which data is recieved.
+        """
+
+        buffer = lnn.utils.cell_buffer()
+        while True:
+            try:
+                frame = await ws.recv()
+                metrics.client_recv_bytes.inc(len(frame))
+
+                self.channel_manager.touch(channel)
+
+                buffer.feed(frame)
+                for cell in buffer.cells():
+                    self.cell_recv += 1
+                    metrics.client_recv_cells.inc()
+                    if trace.period:
+                        trace.cell('recv by wbskt', self.cell_recv, cell)
+
+                    await self.channel_manager.link.schedule_to_send(cell, channel)
+
+            except (lnn.utils.InvalidCellHeaderException, lnn.utils.InvalidCellLengthException):
+                logging.warning('WsServ: Channel %d sent an invalid frame.', channel.cid)
+                return
+
+            except websockets.exceptions.ConnectionClosedError:
+                logging.exception('Websocket connection closed.')
+                return
+
+            except websockets.exceptions.ConnectionClosedOK:
+                logging.info('Websocket connection closed.')
+                return
+
+
     async def _send(self, ws, channel):
         """
         Handler to send a message to the client via the websocket.
@@ -363,34 +701,49 @@ class WebsocketManager:
         :param channel: Channel from which data is sent.
         """
 
-        while not ws.closed:
+        while True:
             try:
                 cell = await channel.to_send.get()
 
-                cell = lnn.cell.pad(cell)
+                cell = lnn.utils.cell_pad_null(cell)
                 await ws.send(cell)
 
                 self.cell_sent += 1
-                logging.info('cell {} sent to wbskt: {}'.format(self.cell_sent, cell[:20].hex()))
-
-                logging.debug('WsServ: Sent data to channel {}: {}... {} bytes.'.format(channel.cid, cell[:20], len(cell)))
+                metrics.client_sent_cells.inc()
+                metrics.client_sent_bytes.inc(len(cell))
+                if trace.period:
+                    trace.cell('sent to wbskt', self.cell_sent, cell)
 
-            except websockets.exceptions.ConnectionClosed as err:
-                logging.exception()
+            except websockets.exceptions.ConnectionClosed:
+                logging.exception('Websocket connection closed.')
                 return
 
 
-    async def _timeout(self, ws, channel):
+    async def _send_multicell(self, ws, channel):
         """
-        Handler to send termination cells in case of a timeout.
+        Handler to send frames containing several cells to the client.
         :param ws: The websocket used to communicate with the client.
         :param channel: Channel from which data is sent.
         """
-        await asyncio.sleep(self.timeout)
 
-        logging.debug('WsServ: Channel {} timed out.'.format(channel.cid))
+        while True:
+            try:
+                cells = await parts.drain(channel.to_send, self.frame_size, self.frame_delay)
+
+                cells = [lnn.utils.cell_pad_null(cell) for cell in cells]
+                frame = b''.join(cells)
+                await ws.send(frame)
 
-        await self.channel_manager.destroy_circuit_from_client(channel)
+                if trace.period:
+                    for count, cell in enumerate(cells, self.cell_sent + 1):
+                        trace.cell('sent to wbskt', count, cell)
+                self.cell_sent += len(cells)
+                metrics.client_sent_cells.inc(len(cells))
+                metrics.client_sent_bytes.inc(len(frame))
+
+            except websockets.exceptions.ConnectionClosed:
+                logging.exception('Websocket connection closed.')
+                return
 
 
     async def _destroy(self, ws, channel):
@@ -404,6 +757,23 @@ class WebsocketManager:
         await channel.destroyed.wait()
 
 
+    async def _serve(self, ws):
+        """
+        Connection handler of the websocket servers.
+        :param ws: The websocket used to communicate with the client.
+        """
+        await self._handler(ws, ws.request.path)
+
+
+    async def handle(self, ws, path):
+        """
+        Serve a websocket accepted by another server (see QuartWebsocket).
+        :param ws: The websocket used to communicate with the client.
+        :param path: Path used by the client.
+        """
+        await self._handler(ws, path)
+
+
     async def _handler(self, ws, path):
         """
         Handler to process a IO on the websocket or on the link.
@@ -411,28 +781,60 @@ class WebsocketManager:
         :param path: Path used by the client.
         """
 
-        if not path.startswith(WebsocketManager.prefix):
+        path, _, query = path.partition('?')
+        if path == WebsocketManager.oneshot_path:
+            channel = await self._open(ws, query)
+            if channel is None:
+                await ws.close()
+                return
+
+        elif not path.startswith(WebsocketManager.prefix):
             logging.warning('WsServ: Attempted to connect to websocket with an invalid prefix {}.'.format(path))
             return
 
-        token = path[WebsocketManager.prefix_len:]
+        else:
+            token = path[WebsocketManager.prefix_len:]
 
-        logging.debug('WsServ: Begin handler for channel id by token {}.'.format(token))
+            logging.debug('WsServ: Begin handler for channel id by token {}.'.format(token))
 
-        try:
-            channel = self.channel_manager.get_channel_by_token(token)
-        except Exception:
-            logging.warning('WsServ: Attempted to connect to websocket with an invalid token {}.'.format(token))
-            return
+            if self.worker is not None:
+                owner = self.worker.owner(token)
+                if owner is not None and owner != self.worker.id:
+                    logging.debug('WsServ: Relay token %s to worker %d.', token, owner)
+                    await self.worker.relay_websocket(ws, path, owner)
+                    return
+
+            try:
+                channel = self.channel_manager.get_channel_by_token(token)
+            except Exception:
+                logging.warning('WsServ: Attempted to connect to websocket with an invalid token {}.'.format(token))
+                return
+
+        # Clients opt in for multi-cell frames with a websocket subprotocol.
+        recv, send = self._recv, self._send
+        if ws.subprotocol == multicell_subprotocol:
+            recv, send = self._recv_multicell, self._send_multicell
+            logging.debug('WsServ: Channel %d uses multi-cell frames.', channel.cid)
+
+        # From now on, the channel expires when idle (instead of unopened).
+        self.channel_manager.open_channel(channel, self.timeout)
 
         tasks = [
             asyncio.create_task(self._destroy(ws, channel)),
-            #asyncio.create_task(self._timeout(ws, channel)),
-            asyncio.create_task(self._recv(ws, channel)),
-            asyncio.create_task(self._send(ws, channel))
+            asyncio.create_task(recv(ws, channel)),
+            asyncio.create_task(send(ws, channel))
         ]
 
-        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Cancel tasks which are still pending (also if the server
+            # cancels this handler, as Quart does on disconnection).
+            for task in tasks:
+                if not (task.cancelled() or task.done()):
+                    task.cancel()
+
+            self.channel_manager.close_channel(channel)
 
         #while not ws.closed:
         #    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
@@ -465,14 +867,6 @@ class WebsocketManager:
         #        logging.debug('WsServ: New send task created for channel {}.'.format(channel.cid))
 
         # The channel is destroyed, and the connection needs to be closed.
-
-        # Cancel tasks which are still pending.
-        for task in tasks:
-            if not (task.cancelled() or task.done()):
-                task.cancel()
-
-        # Delete the channel and close the websocket.
-        self.channel_manager.delete_channel(channel)
         await ws.close()
 
         logging.debug('WsServ: End handler for channel {}.'.format(channel.cid))
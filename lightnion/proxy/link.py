@@ -7,6 +7,7 @@ import lightnion as lnn
 import lightnion.cell
 import lightnion.utils
 from lightnion.proxy import fake_circuit_id
+from . import parts, trace, metrics, scheduler
 
 
 class InvalidCellHeaderException(Exception):
@@ -31,21 +32,31 @@ class NoSupportedVersionException(Exception):
     pass
 
 class Link:
-    def __init__(self, guard, versions=(4,5)):
+    def __init__(self, guard, versions=(4,5), batch_size=32768, flush_delay=0, debug=False):
         """
         Handler for communications between the proxy and a guard relay.
         :param guard: guard tor relay with with to establish a link.
         :param versions: versions supported by the proxy
+        :param batch_size: number of bytes written to the relay at once.
+        :param flush_delay: time (in seconds) waited for more cells before
+                            sending an incomplete batch (0 means no wait).
+        :param debug: check that the cell slicing does not mangle the data.
         """
 
         host = guard['router']['address']
         port = guard['router']['orport']
 
-        # Queue containing cells to be send to the tor relay.
-        self.to_send = asyncio.Queue(16384)
+        # Queue containing cells to be send to the tor relay, circuits are
+        # served in turn so that a bulk upload does not starve the others.
+        self.to_send = scheduler.CircuitScheduler(16384)
+
+        # Cells are written by batches of (at most) batch_size bytes.
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
 
         # Buffer containing beginning of potential imcomplete cell.
-        self.buffer = b''
+        self.buffer = lnn.utils.cell_buffer()
+        self.debug = debug
 
         # The link is bound to a specific guard node.
         self.guard = guard
@@ -104,24 +115,35 @@ class Link:
         :param channel: channel from which the cell is sent.
         """
 
+        # The link is shared by all channels: never forward a cell the guard
+        # would reject (unknown command, bad length or truncated header). Only
+        # the link handshake uses variable-length cells, so clients may not.
+        try:
+            cell_len = lnn.utils.cell_length(cell_raw)
+        except (lnn.utils.InvalidCellHeaderException, lnn.utils.InvalidCellLengthException):
+            cell_len = None
+
+        if (cell_len is None or len(cell_raw) > cell_len
+                or lnn.utils.cell_is_variable_length(cell_raw[4])):
+            logging.warning('Link: Channel %d attempted to send an invalid cell.', channel.cid)
+            return
+
         # Set correct circuit id.
-        cell = lnn.cell.header_view.write(cell_raw, circuit_id=channel.cid)
-        #cell = lnn.utils.cell_set_cid(cell_raw, channel.cid)
+        cell = bytearray(cell_raw)
+        lnn.utils.cell_set_cid_inplace(cell, channel.cid)
 
-        header = lnn.cell.header(cell)
-        #cmd = lnn.utils.cell_get_cmd(cell)
+        cmd = lnn.utils.cell_get_cmd(cell)
         #if cmd == 3:
         #    cell = lnn.utils.cell_pad_rnd(cell)
         #else:
         #    cell = lnn.utils.cell_pad_null(cell)
 
-        #if cmd == 4:
-        if header.cmd is lnn.cell.cmd.DESTROY:
-            logging.debug('Link: channel {} asks for the circuit to be destroyed.'.format(channel.cid))
-            cell_validation = lnn.cell.destroy.cell(cell)
+        if cmd == int(lnn.cell.cmd.DESTROY):
+            logging.debug('Link: channel %d asks for the circuit to be destroyed.', channel.cid)
+            cell_validation = lnn.cell.destroy.cell(bytes(cell))
             #if not lnn.utils.cell_is_valid(cell):
             if not cell_validation.valid:
-                logging.debug('Link: Channel {} attempted to send an invalid cell.'.format(channel.cid))
+                logging.debug('Link: Channel %d attempted to send an invalid cell.', channel.cid)
                 return
                 #raise InvalidDestroyCellException()
 
@@ -129,11 +151,11 @@ class Link:
             if not channel.destroyed.is_set():
                 channel.destroyed.set()
 
-        cell_padded = lnn.cell.pad(cell)
+        cell_padded = lnn.utils.cell_pad_null(cell)
 
         await self.to_send.put(cell_padded)
         #await self.to_send.put(cell)
-        logging.debug('Link: Scheduled data from channel {} to be send.'.format(channel.cid))
+        logging.debug('Link: Scheduled data from channel %d to be send.', channel.cid)
 
 
     async def _handle_tor_cmd_cell(self, cell):
@@ -148,54 +170,49 @@ class Link:
 
         while not reader.at_eof():
             data = await reader.read(65536)
+            metrics.relay_recv_bytes.inc(len(data))
 
-            data = self.buffer + data
+            if self.debug:
+                data_initial = bytes(self.buffer.pending) + data
+                data_cells = []
 
-            data_initial = data
+            self.buffer.feed(data)
 
             # Let the channel manager do the multiplexing.
             #logging.debug('Link: Received data\n{}'.format(data))
 
-            (cell, data) = lnn.utils.cell_slice_old(data)
+            for cell in self.buffer.cells():
+                # (the only copy of the cell, the buffer is reused afterwards)
+                cell = bytearray(cell)
 
-            data_cells = b''
-            cells = []
+                if self.debug:
+                    data_cells.append(bytes(cell))
 
-            while cell is not None:
-
-                data_cells += cell
-                cells.append(cell)
-
-                logging.debug('Link: Spliced a cell. {}... {} bytes.'.format(cell[:20], len(cell)))
                 # Analyse header to select correct channel.
-                header = lnn.cell.header(cell)
-                cid = header.circuit_id
-                #cid = lnn.utils.cell_get_cid(cell)
+                cid, _ = lnn.utils.cell_header_unpack(cell)
 
                 if cid == 0:
                     await self._handle_tor_cmd_cell(cell)
                 else:
-                    # Replace the real circuit id by a dummy one.
-                    cell_mut = lnn.cell.header_view.write(cell, circuit_id=fake_circuit_id)
-                    #cell_mut = lnn.utils.cell_set_cid(cell, fake_circuit_id)
-
                     self.cell_recv += 1
-                    logging.info('cell {} recv by relay: {}'.format(self.cell_recv, cell[:20].hex()))
-                    await self.channel_manager.schedule_to_send(cell_mut, cid)
-
-                (cell, data) = lnn.utils.cell_slice_old(data)
+                    metrics.relay_recv_cells.inc()
+                    if trace.period:
+                        trace.cell('recv by relay', self.cell_recv, cell)
 
-            data_cells = data_cells + data
+                    # Replace the real circuit id by a dummy one.
+                    lnn.utils.cell_set_cid_inplace(cell, fake_circuit_id)
+                    await self.channel_manager.schedule_to_send(cell, cid)
 
-            if data_cells != data_initial:
-                logging.warning('CELL SLICING MANGLE THE DATA')
-                logging.warning('INITIAL:\n{}'.format(data_initial.hex()))
-                logging.warning('CELLS:\n{}'.format(data_cells.hex()))
-                logging.warning('PREV BUFFER:\n{}'.format(self.buffer.hex()))
-                logging.warning('NEXT BUFFER:\n{}'.format(data.hex()))
+            if self.debug:
+                # At the end we keep the beginning of the next cell.
+                data_next = bytes(self.buffer.pending)
+                data_cells = b''.join(data_cells) + data_next
 
-            # At the end we keep the beginning of the next cell.
-            self.buffer = data
+                if data_cells != data_initial:
+                    logging.warning('CELL SLICING MANGLE THE DATA')
+                    logging.warning('INITIAL:\n{}'.format(data_initial.hex()))
+                    logging.warning('CELLS:\n{}'.format(data_cells.hex()))
+                    logging.warning('NEXT BUFFER:\n{}'.format(data_next.hex()))
 
 
     async def _send(self, writer):
@@ -204,14 +221,21 @@ class Link:
         :param reader: asyncio StreamWriter
         """
         while not writer.is_closing():
-            cell = await self.to_send.get()
+            # Everything queued is written at once and drained once.
+            cells = await parts.drain(self.to_send, self.batch_size, self.flush_delay)
 
-            writer.write(cell)
+            data = b''.join(cells)
+            writer.write(data)
             await writer.drain()
-            logging.debug('Link: Sent cell: {}... {} bytes.'.format(cell[:20], len(cell)))
 
-            self.cell_sent += 1
-            logging.info('cell {} sent to relay: {}'.format(self.cell_sent, cell[:20].hex()))
+            metrics.relay_sent_cells.inc(len(cells))
+            metrics.relay_sent_bytes.inc(len(data))
+            logging.debug('Link: Sent %d cells.', len(cells))
+
+            if trace.period:
+                for count, cell in enumerate(cells, self.cell_sent + 1):
+                    trace.cell('sent to relay', count, cell)
+            self.cell_sent += len(cells)
             #await asyncio.sleep(0.01)
 
 
@@ -335,27 +359,28 @@ class Link:
 
         self.version = await self._negociate_version(reader, writer, versions)
 
-        # Tor handshake
-        cells_raw = await reader.read(65536)
+        # Tor handshake (the cells may come in several reads, what remains
+        # afterwards is kept in the buffer for self._recv)
+        handshake = []
+        while len(handshake) < 3:
+            data = await reader.read(65536)
+            if len(data) == 0:
+                raise ConnectionError('Link: Connection closed during handshake.')
 
-        #logging.debug('Link: Received handshake cells:\n{}'.format(cells_raw))
+            self.buffer.feed(data)
+            for cell in self.buffer.cells():
+                handshake.append(bytes(cell))
+                if len(handshake) == 3:
+                    break
 
-        (cell, cells_raw) = lnn.utils.cell_slice(cells_raw)
-        #certs_cell = lnn.cell.certs.cell(cell)
-        certs_cell = cell
-        #logging.debug('Link: Certs cell:\n{}... {} bytes.'.format(certs_cell.raw[:20], len(certs_cell.raw)))
+        certs_cell, auth_cell, netinfo_cell = handshake
+        #certs_cell = lnn.cell.certs.cell(certs_cell)
         logging.debug('Link: Certs cell: {}... {} bytes.'.format(certs_cell[:20], len(certs_cell)))
 
-        (cell, cells_raw) = lnn.utils.cell_slice(cells_raw)
-        #auth_cell = lnn.cell.challenge.cell(cell)
-        auth_cell = cell
-        #logging.debug('Link: Auth cell:\n{}... {} bytes.'.format(auth_cell.raw[:20], len(auth_cell.raw)))
+        #auth_cell = lnn.cell.challenge.cell(auth_cell)
         logging.debug('Link: Auth cell: {}... {} bytes.'.format(auth_cell[:20], len(auth_cell)))
 
-        (cell, cells_raw) = lnn.utils.cell_slice(cells_raw)
-        #netinfo_cell = lnn.cell.netinfo.cell(cell)
-        netinfo_cell = cell
-        #logging.debug('Link: Netinfo cell:\n{}... {} bytes.'.format(netinfo_cell.raw[:20], len(netinfo_cell.raw)))
+        #netinfo_cell = lnn.cell.netinfo.cell(netinfo_cell)
         logging.debug('Link: Netinfo cell: {}... {} bytes.'.format(netinfo_cell[:20], len(netinfo_cell)))
 
         # Validation of handshake cells given by the relay.
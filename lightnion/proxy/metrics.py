@@ -0,0 +1,261 @@
+import bisect
+import time
+
+# Prometheus text exposition format, version 0.0.4
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Every series defined below, in exposition order.
+registry = []
+
+default_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+
+    if len(pairs) == 0:
+        return ''
+
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _series:
+    """
+    Base of the metric families, subclasses define kind, _child() (new
+    series of one set of label values) and samples() (list of (suffix,
+    label values, extra label, value) to export).
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        A metric family, optionally split by labels.
+        :param name: name of the metric.
+        :param documentation: help text of the metric.
+        :param labels: names of the labels of the metric.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self._children = dict()
+
+        registry.append(self)
+
+    def _register_default(self):
+        # (series without labels are exported even before being used)
+        if len(self.labelnames) == 0:
+            self.labels()
+
+    def labels(self, *values):
+        """
+        Get (or create) the series with the given label values.
+        :param values: label values, in the order of the label names.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError('Expected labels {}, got {}.'.format(self.labelnames, values))
+
+        values = tuple(str(value) for value in values)
+        if values not in self._children:
+            self._children[values] = self._child()
+        return self._children[values]
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.kind)]
+
+        for suffix, values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                _format_labels(self.labelnames, values, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class _value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class counter(_series):
+    kind = 'counter'
+    _child = _value
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._register_default()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return [('_total', values, None, child.value)
+            for values, child in self._children.items()]
+
+
+class gauge(_series):
+    kind = 'gauge'
+    _child = _value
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        """
+        A metric that can go up and down.
+        :param function: if given, called at each scrape, returns either a
+                         value or a dict {label values: value}.
+        """
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return [('', values, None, child.value)
+                for values, child in self._children.items()]
+
+        try:
+            values = self.function()
+        except Exception:
+            return []
+
+        if values is None:
+            return []
+
+        if not isinstance(values, dict):
+            return [('', (), None, values)]
+        return [('', tuple(str(v) for v in key), None, value)
+            for key, value in values.items()]
+
+
+class _buckets:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _timer:
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.target.observe(time.perf_counter() - self.start)
+
+
+class histogram(_series):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        """
+        A metric that counts observations in buckets.
+        :param buckets: upper bounds of the buckets (+Inf is implicit).
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._register_default()
+
+    def _child(self):
+        return _buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        """
+        Context manager observing the time spent in its block.
+        """
+        return _timer(self)
+
+    def samples(self):
+        results = []
+        for values, child in self._children.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                total += count
+                results.append(('_bucket', values, ('le', _format_value(bound)), total))
+            results.append(('_sum', values, None, child.sum))
+            results.append(('_count', values, None, total))
+        return results
+
+
+def render():
+    """
+    :return: all series in the Prometheus text format.
+    """
+    return '\n'.join(series.render() for series in registry) + '\n'
+
+
+# Data plane, "relay" is the guard link and "client" the websockets.
+cells = counter('lightnion_proxy_cells',
+    'Cells relayed by the proxy.', ['peer', 'direction'])
+traffic = counter('lightnion_proxy_bytes',
+    'Bytes relayed by the proxy.', ['peer', 'direction'])
+
+relay_recv_cells = cells.labels('relay', 'in')
+relay_sent_cells = cells.labels('relay', 'out')
+client_recv_cells = cells.labels('client', 'in')
+client_sent_cells = cells.labels('client', 'out')
+
+relay_recv_bytes = traffic.labels('relay', 'in')
+relay_sent_bytes = traffic.labels('relay', 'out')
+client_recv_bytes = traffic.labels('client', 'in')
+client_sent_bytes = traffic.labels('client', 'out')
+
+# Channels and queues (computed at scrape time).
+channels = gauge('lightnion_proxy_channels',
+    'Channels currently managed by the proxy.')
+link_queue = gauge('lightnion_proxy_link_queue_cells',
+    'Cells waiting to be sent to the guard relay.')
+link_circuit_queue = gauge('lightnion_proxy_link_circuit_queue_cells',
+    'Cells waiting to be sent to the guard relay, per circuit.', ['circuit'])
+channel_queue = gauge('lightnion_proxy_channel_queue_cells',
+    'Cells waiting to be sent to a client, per circuit.', ['circuit'])
+overflow_cells = counter('lightnion_proxy_overflow_cells',
+    'Cells refused to clients whose queue is full, per overflow policy.', ['policy'])
+overflow_channels = counter('lightnion_proxy_overflow_channels',
+    'Circuits destroyed because their client did not keep up.')
+expired_channels = counter('lightnion_proxy_expired_channels',
+    'Circuits destroyed because their channel was left unused.')
+
+# Control plane.
+channel_create = histogram('lightnion_proxy_channel_create_seconds',
+    'Time spent creating a channel (POST /channels).')
+path_selection = histogram('lightnion_proxy_path_selection_seconds',
+    'Time spent selecting a path for a new channel.')
+consensus_refresh = histogram('lightnion_proxy_consensus_refresh_seconds',
+    'Time spent retrieving the consensus and descriptors.')
+consensus_age = gauge('lightnion_proxy_consensus_age_seconds',
+    'Time elapsed since the valid-after date of the current consensus.')
@@ -1,5 +1,8 @@
 import secrets
+import asyncio
 import base64
+import json
+import time
 
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM as gcm
 from cryptography.exceptions import InvalidTag
@@ -7,31 +10,76 @@ from cryptography.exceptions import InvalidTag
 import lightnion as lnn
 
 class crypto:
-    def __init__(self):
-        self.binding = secrets.token_bytes(32)
-        self.gcm = gcm(gcm.generate_key(bit_length=128))
+    # Tokens are base64 (without padding) of a worker id, a nonce, a circuit
+    # id and a tag (34 bytes).
+    token_len = 46
+
+    def __init__(self, key=None, binding=None, worker=0):
+        """
+        Channel token generator.
+        :param key: AES-GCM key, shared by the workers of a proxy.
+        :param binding: associated data, shared by the workers of a proxy.
+        :param worker: id of the worker issuing the tokens.
+        """
+        if key is None:
+            key = gcm.generate_key(bit_length=128)
+        if binding is None:
+            binding = secrets.token_bytes(32)
+
+        self.binding = binding
+        self.gcm = gcm(key)
+        self.worker = worker
 
     def compute_token(self, circuit_id, binding):
         circuit_id = lnn.cell.view.uint(4).write(b'', circuit_id)
+        worker = self.worker.to_bytes(2, byteorder='big')
 
         nonce = secrets.token_bytes(12)
-        token = self.gcm.encrypt(nonce, circuit_id, self.binding + binding)
-        token = base64.urlsafe_b64encode(nonce + token)
+        token = self.gcm.encrypt(nonce, circuit_id, self.binding + worker + binding)
+        token = base64.urlsafe_b64encode(worker + nonce + token)
         return str(token.replace(b'=', b''), 'utf8')
 
-    def decrypt_token(self, token, binding):
+    def _decode_token(self, token):
         try:
             if not isinstance(token, str):
                 token = str(token, 'utf8')
+
+            # (cheap check before decoding anything)
+            token = token.rstrip('=')
+            if len(token) != self.token_len:
+                return None
+
             token = base64.urlsafe_b64decode(token + '====')
         except BaseException:
             return None
 
-        if len(token) != 32:
+        if len(token) != 34:
+            return None
+        return token
+
+    def token_worker(self, token):
+        """
+        Read the id of the worker that issued a token, without checking it.
+        :param token: token to read.
+        :return: worker id, None if the token is malformed.
+        """
+        token = self._decode_token(token)
+        if token is None:
             return None
 
-        binding = self.binding + binding
-        nonce, token = token[:12], token[12:]
+        return int.from_bytes(token[:2], byteorder='big')
+
+    def decrypt_token(self, token, binding):
+        token = self._decode_token(token)
+        if token is None:
+            return None
+
+        # (only the issuing worker knows the binding of the token)
+        worker, nonce, token = token[:2], token[2:14], token[14:]
+        if int.from_bytes(worker, byteorder='big') != self.worker:
+            return None
+
+        binding = self.binding + worker + binding
         try:
             circuit_id = self.gcm.decrypt(nonce, token, binding)
         except InvalidTag:
@@ -41,3 +89,124 @@ class crypto:
             return None
 
         return int.from_bytes(circuit_id, byteorder='big')
+
+
+class json_cache:
+    """
+    JSON fragments of the descriptors sent to clients (the guard and the
+    path of each channel), serialized once per descriptor instead of once
+    per response. Descriptors are identified by their digest, thus the
+    cache only needs to be cleared to free memory at each consensus.
+    """
+    def __init__(self):
+        self.fragments = dict()
+
+    def clear(self):
+        self.fragments = dict()
+
+    def fragment(self, descriptor):
+        """
+        :param descriptor: descriptor (with a digest field).
+        :return: JSON of the descriptor.
+        """
+        key = descriptor['digest']
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            fragment = json.dumps(descriptor)
+            self.fragments[key] = fragment
+        return fragment
+
+    def _dumps(self, value):
+        if isinstance(value, dict) and 'digest' in value:
+            return self.fragment(value)
+        if isinstance(value, (list, tuple)):
+            return '[' + ', '.join(self._dumps(v) for v in value) + ']'
+        return json.dumps(value)
+
+    def dumps(self, data):
+        """
+        Serialize a dictionary, using the cached fragments of its descriptors.
+        :param data: dictionary to serialize (ex. answer of create_channel).
+        :return: JSON of the dictionary.
+        """
+        return '{' + ', '.join('{}: {}'.format(json.dumps(key), self._dumps(value))
+            for key, value in data.items()) + '}'
+
+
+class token_bucket:
+    def __init__(self, rate, burst):
+        """
+        Token bucket rate limiter.
+        :param rate: tokens added per second.
+        :param burst: maximum number of tokens in the bucket.
+        """
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self):
+        """
+        :return: True if at least one token is available.
+        """
+        if self.tokens < 1:
+            self._refill()
+        return self.tokens >= 1
+
+    def consume(self):
+        """
+        Take a token if available.
+        :return: True if a token was taken.
+        """
+        if not self.available():
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+async def drain(queue, max_bytes, max_delay=0):
+    """
+    Coroutine
+    Wait for a first cell, then take every cell already queued until a byte
+    budget is reached, so that they can be written at once.
+    :param queue: asyncio.Queue containing cells.
+    :param max_bytes: byte budget of a batch (the last cell may exceed it).
+    :param max_delay: time (in seconds) allowed to wait for more cells before
+                      flushing an incomplete batch (0 means never wait).
+    :return: list of cells
+    """
+    cells = [await queue.get()]
+    size = len(cells[0])
+
+    deadline = None
+    while size < max_bytes:
+        try:
+            cell = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            if max_delay <= 0:
+                break
+
+            loop = asyncio.get_running_loop()
+            if deadline is None:
+                deadline = loop.time() + max_delay
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                cell = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+        cells.append(cell)
+        size += len(cell)
+
+    return cells
@@ -0,0 +1,202 @@
+import collections
+import asyncio
+
+import lightnion as lnn
+import lightnion.utils
+
+
+class CircuitScheduler:
+    """
+    Queue of cells to be sent to the tor relay, shared fairly by circuits.
+
+    Each circuit gets its own FIFO and circuits are served by deficit
+    round-robin: at its turn, a circuit may send up to `quantum` bytes
+    (times its weight) before the next circuit is served. A circuit that
+    uploads a lot thus no longer delays cells of interactive circuits.
+    Cells without circuit (circuit id 0) are always sent first.
+
+    Provides the subset of asyncio.Queue used by the proxy, so it can be
+    used in place of one (see Link.to_send and parts.drain).
+    """
+
+    def __init__(self, maxsize=16384, quantum=lnn.constants.full_cell_len):
+        """
+        Scheduler constructor.
+        :param maxsize: total number of cells that can be queued.
+        :param quantum: bytes a circuit may send at each turn.
+        """
+        self.maxsize = maxsize
+        self.quantum = quantum
+
+        # cells queued for each circuit
+        self._queues = dict()
+        self._deficits = dict()
+        self._weights = dict()
+
+        # circuits with pending cells, in round-robin order
+        self._active = collections.deque()
+        self._turn = None
+
+        self._size = 0
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+
+
+    def qsize(self):
+        return self._size
+
+
+    def empty(self):
+        return self._size == 0
+
+
+    def full(self):
+        return self._size >= self.maxsize
+
+
+    def depths(self):
+        """
+        :return: number of queued cells per circuit.
+        """
+        return {cid: len(queue) for cid, queue in self._queues.items()}
+
+
+    def set_weight(self, cid, weight):
+        """
+        Give a circuit more (or less) bandwidth than the others.
+        :param cid: circuit id.
+        :param weight: number of quanta given to the circuit at each turn.
+        """
+        if weight <= 0:
+            raise ValueError('Invalid weight: {}'.format(weight))
+
+        if weight == 1:
+            self._weights.pop(cid, None)
+        else:
+            self._weights[cid] = weight
+
+
+    def forget(self, cid):
+        """
+        Drop the scheduling parameters of a circuit (queued cells are kept).
+        :param cid: circuit id.
+        """
+        self._weights.pop(cid, None)
+
+
+    @staticmethod
+    def _wakeup_next(waiters):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+
+    async def _wait(self, waiters, blocked):
+        while blocked():
+            waiter = asyncio.get_running_loop().create_future()
+            waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                waiter.cancel()
+                try:
+                    waiters.remove(waiter)
+                except ValueError:
+                    pass
+                # (pass our wake up along if we got one while cancelled)
+                if not blocked() and not waiter.cancelled():
+                    self._wakeup_next(waiters)
+                raise
+
+
+    def put_nowait(self, cell):
+        """
+        Queue a cell on its circuit.
+        :param cell: cell to be sent.
+        """
+        if self.full():
+            raise asyncio.QueueFull
+
+        cid = lnn.utils.cell_header_unpack(cell)[0]
+
+        queue = self._queues.get(cid)
+        if queue is None:
+            queue = collections.deque()
+            self._queues[cid] = queue
+            self._deficits[cid] = 0
+            if cid != 0:
+                self._active.append(cid)
+
+        queue.append(cell)
+        self._size += 1
+
+        self._wakeup_next(self._getters)
+
+
+    async def put(self, cell):
+        """
+        Coroutine
+        Queue a cell on its circuit, wait for room if needed.
+        :param cell: cell to be sent.
+        """
+        await self._wait(self._putters, self.full)
+        self.put_nowait(cell)
+
+
+    def _pop(self, cid):
+        queue = self._queues[cid]
+        cell = queue.popleft()
+        self._deficits[cid] -= len(cell)
+
+        if len(queue) == 0:
+            # (an idle circuit does not keep its unused credit)
+            del self._queues[cid]
+            del self._deficits[cid]
+            if cid != 0:
+                self._active.popleft()
+                self._turn = None
+
+        return cell
+
+
+    def get_nowait(self):
+        """
+        Take the next cell to be sent.
+        :return: cell
+        """
+        if self._size == 0:
+            raise asyncio.QueueEmpty
+
+        if 0 in self._queues:
+            cell = self._pop(0)
+        else:
+            while True:
+                cid = self._active[0]
+                if self._turn != cid:
+                    self._turn = cid
+                    self._deficits[cid] += self.quantum * self._weights.get(cid, 1)
+
+                if self._deficits[cid] >= len(self._queues[cid][0]):
+                    break
+
+                # The circuit used its credit, next one.
+                self._active.rotate(-1)
+                self._turn = None
+
+            cell = self._pop(cid)
+
+        self._size -= 1
+        self._wakeup_next(self._putters)
+        return cell
+
+
+    async def get(self):
+        """
+        Coroutine
+        Take the next cell to be sent, wait for one if needed.
+        :return: cell
+        """
+        await self._wait(self._getters, self.empty)
+        return self.get_nowait()
@@ -0,0 +1,135 @@
+import time
+
+
+class _timer:
+    __slots__ = ('deadline', 'tick')
+
+    def __init__(self, deadline, tick):
+        self.deadline = deadline
+        self.tick = tick
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel, used to expire many timers that are often reset.
+
+    Timers are stored in `slots` buckets of `resolution` seconds each.
+    Arming a timer is O(1), resetting it on activity is a single store as
+    the timer is left in its bucket: when the bucket is reached, timers
+    that were pushed back meanwhile are moved to their new bucket instead
+    of expiring.
+
+    The wheel only moves forward when advance() is called, and uses the
+    time of the last call as its (coarse) clock.
+    """
+
+    def __init__(self, resolution=1, slots=64):
+        """
+        Timer wheel constructor.
+        :param resolution: duration (in seconds) of a tick.
+        :param slots: number of buckets, timers further than slots ticks
+                      away are checked once per revolution.
+        """
+        self.resolution = resolution
+        self.slots = slots
+
+        self.now = time.monotonic()
+        self._tick = self._tick_of(self.now)
+
+        self._timers = dict()
+        self._buckets = [dict() for _ in range(slots)]
+
+
+    def __len__(self):
+        return len(self._timers)
+
+
+    def __contains__(self, key):
+        return key in self._timers
+
+
+    def _tick_of(self, deadline):
+        return int(deadline // self.resolution)
+
+
+    def _place(self, key, timer):
+        # (never place a timer in the past, it would wait a whole revolution)
+        timer.tick = max(self._tick_of(timer.deadline), self._tick + 1)
+        self._buckets[timer.tick % self.slots][key] = timer.tick
+
+
+    def arm(self, key, delay):
+        """
+        Start (or restart) a timer.
+        :param key: identifier of the timer.
+        :param delay: time (in seconds) until the timer expires.
+        """
+        deadline = self.now + delay
+
+        timer = self._timers.get(key)
+        if timer is None:
+            timer = _timer(deadline, None)
+            self._timers[key] = timer
+            self._place(key, timer)
+            return
+
+        timer.deadline = deadline
+        if self._tick_of(deadline) < timer.tick:
+            # (an earlier deadline is not caught by the lazy reset)
+            self._place(key, timer)
+
+
+    def touch(self, key, delay):
+        """
+        Push back an armed timer, do nothing if the timer is not armed.
+        :param key: identifier of the timer.
+        :param delay: time (in seconds) until the timer expires.
+        """
+        timer = self._timers.get(key)
+        if timer is not None:
+            deadline = self.now + delay
+            if deadline > timer.deadline:
+                timer.deadline = deadline
+
+
+    def cancel(self, key):
+        """
+        Stop a timer, do nothing if the timer is not armed.
+        :param key: identifier of the timer.
+        """
+        # (its bucket entry is discarded when reached)
+        self._timers.pop(key, None)
+
+
+    def advance(self, now=None):
+        """
+        Move the wheel up to the given time.
+        :param now: current time, defaults to time.monotonic().
+        :return: list of the keys of the expired timers.
+        """
+        if now is None:
+            now = time.monotonic()
+        self.now = max(self.now, now)
+
+        expired = []
+        last = self._tick_of(self.now)
+        while self._tick < last:
+            self._tick += 1
+
+            bucket = self._buckets[self._tick % self.slots]
+            for key, tick in list(bucket.items()):
+                if tick > self._tick:
+                    continue # (next revolution)
+                del bucket[key]
+
+                timer = self._timers.get(key)
+                if timer is None or timer.tick != tick:
+                    continue # (cancelled or moved)
+
+                if timer.deadline <= self.now:
+                    del self._timers[key]
+                    expired.append(key)
+                else:
+                    self._place(key, timer)
+
+        return expired
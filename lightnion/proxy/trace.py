@@ -0,0 +1,63 @@
+import logging
+
+# Per-cell events are logged here, independently of the proxy verbosity.
+logger = logging.getLogger('lightnion.proxy.trace')
+
+# Trace one cell out of `period` cells (0 disables per-cell tracing).
+#
+# Call sites on the data path only check this value before doing anything,
+# thus tracing costs a single attribute lookup per cell when disabled:
+#
+#   if trace.period:
+#       trace.cell('sent to relay', count, cell)
+#
+period = 0
+
+
+class hexdump:
+    """
+    Hexadecimal representation of the beginning of a cell, only computed if
+    the record is actually formatted by a handler.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, cell, size=20):
+        # (copied, as the cell may be a view of a buffer reused afterwards)
+        self.data = bytes(cell[:size])
+
+    def __str__(self):
+        return self.data.hex()
+
+
+def enable(every=1, level=logging.INFO):
+    """
+    Enable the sampled per-cell trace.
+    :param every: trace one cell out of every cells.
+    :param level: level of the trace logger.
+    """
+    global period
+
+    if every < 1:
+        raise ValueError('Invalid trace period: {}'.format(every))
+
+    logger.setLevel(level)
+    period = every
+
+
+def disable():
+    """
+    Disable the per-cell trace.
+    """
+    global period
+    period = 0
+
+
+def cell(event, count, cell):
+    """
+    Trace a cell if it is part of the sample.
+    :param event: what happens to the cell (ex. 'recv by relay').
+    :param count: number of cells that went through the same event.
+    :param cell: the cell itself.
+    """
+    if count % period == 0:
+        logger.info('cell %d %s: %s (%d bytes)', count, event, hexdump(cell), len(cell))
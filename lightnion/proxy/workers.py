@@ -0,0 +1,186 @@
+import multiprocessing
+import secrets
+import logging
+import asyncio
+import signal
+import socket
+
+import websockets
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM as gcm
+
+from . import parts
+
+
+def reuse_port_socket(host, port):
+    """
+    Create a listening socket that other workers can bind as well, the
+    kernel then spreads the incoming connections among them.
+    :param host: address to listen on.
+    :param port: port to listen on.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Worker:
+    """
+    One of several proxy processes sharing the same public ports.
+
+    Each worker has its own guard link and channels. Tokens carry the id of
+    the worker that issued them (under a key shared by all workers), so
+    that a worker can hand requests for other channels to their owner
+    through its private ports (on localhost).
+    """
+
+    def __init__(self, wid, count, base_port, key, binding):
+        """
+        Worker description.
+        :param wid: id of the worker (0 to count - 1).
+        :param count: number of workers.
+        :param base_port: first private port, each worker uses two of them.
+        :param key: AES-GCM key shared by the workers.
+        :param binding: token binding shared by the workers.
+        """
+        self.id = wid
+        self.count = count
+        self.base_port = base_port
+
+        self.crypto = parts.crypto(key, binding, wid)
+
+    def http_port(self, wid=None):
+        """
+        :param wid: worker id (defaults to this worker).
+        :return: private HTTP port of the worker.
+        """
+        return self.base_port + 2 * (self.id if wid is None else wid)
+
+    def websocket_port(self, wid=None):
+        """
+        :param wid: worker id (defaults to this worker).
+        :return: private websocket port of the worker.
+        """
+        return self.http_port(wid) + 1
+
+    def owner(self, token):
+        """
+        :param token: channel token.
+        :return: id of the worker owning the channel, None if the token is
+                 malformed.
+        """
+        wid = self.crypto.token_worker(token)
+        if wid is None or wid >= self.count:
+            return None
+        return wid
+
+    async def serve_http(self, app, host, port):
+        """
+        Coroutine
+        Serve the application on the shared public port and on the private
+        HTTP port of the worker.
+        """
+        import hypercorn.asyncio
+        import hypercorn.config
+
+        sock = reuse_port_socket(host, port)
+
+        config = hypercorn.config.Config()
+        config.bind = ['fd://{}'.format(sock.fileno()),
+            '127.0.0.1:{}'.format(self.http_port())]
+        await hypercorn.asyncio.serve(app, config)
+
+    async def relay_websocket(self, ws, path, wid):
+        """
+        Coroutine
+        Relay a websocket connection to the worker owning its channel.
+        :param ws: websocket opened by the client.
+        :param path: path requested by the client.
+        :param wid: id of the owner.
+        """
+        uri = 'ws://127.0.0.1:{}{}'.format(self.websocket_port(wid), path)
+        subprotocols = None
+        if ws.subprotocol is not None:
+            subprotocols = [ws.subprotocol]
+
+        async def pipe(source, destination):
+            async for message in source:
+                await destination.send(message)
+
+        try:
+            async with websockets.connect(uri, subprotocols=subprotocols,
+                    compression=None, max_size=None) as peer:
+                tasks = [
+                    asyncio.create_task(pipe(ws, peer)),
+                    asyncio.create_task(pipe(peer, ws))]
+
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            logging.warning('Worker %d: Relay to worker %d failed: %s', self.id, wid, e)
+
+    async def forward_delete(self, path, wid):
+        """
+        Coroutine
+        Forward a DELETE request to the worker owning its channel.
+        :param path: path of the request.
+        :param wid: id of the owner.
+        :return: HTTP status code answered by the owner.
+        """
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.http_port(wid))
+        except OSError as e:
+            logging.warning('Worker %d: Forward to worker %d failed: %s', self.id, wid, e)
+            return 502
+
+        try:
+            writer.write('DELETE {} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: 0\r\n'
+                'Connection: close\r\n\r\n'.format(path).encode('ascii'))
+            await writer.drain()
+
+            status = await reader.readline()
+            return int(status.split()[1])
+        except (OSError, ValueError, IndexError):
+            return 502
+        finally:
+            writer.close()
+
+
+def spawn(count, base_port, target, kwargs):
+    """
+    Run several workers, each one calling target(worker=..., **kwargs) in
+    its own process, and wait for them.
+    :param count: number of workers.
+    :param base_port: first private port of the workers.
+    :param target: entry point of the workers.
+    :param kwargs: arguments given to the entry point.
+    """
+    key = gcm.generate_key(bit_length=128)
+    binding = secrets.token_bytes(32)
+
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for wid in range(count):
+        worker = Worker(wid, count, base_port, key, binding)
+        process = context.Process(target=target, kwargs=dict(kwargs, worker=worker),
+            name='lightnion-worker-{}'.format(wid))
+        process.start()
+        processes.append(process)
+        logging.info('Worker %d started (pid %d).', wid, process.pid)
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    for s in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(s, stop)
+
+    for process in processes:
+        process.join()
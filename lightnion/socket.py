@@ -1,5 +1,7 @@
 import lightnion as lnn
+import lightnion.utils
 
+import selectors
 import threading
 import socket
 import queue
@@ -42,65 +44,42 @@ class _stat_peer:
     def close(self):
         return self.peer.close()
 
-def cell_slice(payload, once=False):
-    cell_header = lnn.cell.header(payload)
-    if len(payload) < cell_header.width: # (payload too small, need data)
-        return [], payload, True
-
-    if not cell_header.valid:
-        raise RuntimeError('Invalid cell header: {}'.format(cell_header.raw))
-
-    length = cell_header.width + lnn.constants.payload_len
-    if not cell_header.cmd.is_fixed:
-        cell_header = lnn.cell.header_variable(payload)
-        if len(payload) < cell_header.width: # (payload too small, need data)
-            return [], payload, True
-
-        if not cell_header.valid:
-            raise RuntimeError(
-                'Invalid variable cell header: {}'.format(cell_header.raw))
-
-        length = cell_header.width + cell_header.length
-
-    if length > lnn.constants.max_payload_len:
-        raise RuntimeError('Invalid cell length: {}'.format(length))
-
-    if len(payload) < length:
-        return [], payload, True
-
-    cells = [payload[:length]]
-    payload = payload[length:]
-    celling = False
-
-    if once:
-        return cells, payload, celling
-
-    while not celling and len(payload) > 0:
-        new_cells, payload, celling = cell_slice(payload, once=True)
-        cells += new_cells
-    return cells, payload, celling
-
 class worker(threading.Thread):
-    def __init__(self, peer, max_fails=32, max_queue=2048, buffer_size=4096):
+    """Move cells between a (TLS) socket and queues, waking up only when the
+    socket is ready or when cells are queued to be sent (see selectors).
+    """
+    def __init__(self, peer, max_queue=2048, buffer_size=65536):
         super().__init__()
 
         self.buffer_size = buffer_size
         self.max_queue = max_queue
-        self.max_fails = max_fails
         self.peer = peer
 
         self.cell_queue = queue.Queue(max_queue)
         self.send_queue = queue.Queue(max_queue)
-        self.recv_queue = queue.Queue(max_queue)
+        self.buffer = lnn.utils.cell_buffer()
         self.sending = b''
-        self.recving = b''
-        self.celling = False
-        self.fails = 0
         self.dead = False
 
+        # (send() and close() write into waker to interrupt select())
+        self.waiter, self.waker = socket.socketpair()
+        self.waiter.setblocking(False)
+        self.waker.setblocking(False)
+
+        self.events = selectors.EVENT_READ
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.peer, self.events)
+        self.selector.register(self.waiter, selectors.EVENT_READ)
+
+    def wake(self):
+        try:
+            self.waker.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass # (already awake, or closed)
+
     def close(self):
-        self.peer.close()
         self.dead = True
+        self.wake()
 
     def die(self, e):
         if self.dead:
@@ -111,61 +90,75 @@ class worker(threading.Thread):
 
     def send(self, cell, block=True):
         self.send_queue.put(lnn.cell.pad(cell), block=block)
+        self.wake()
 
     def recv(self, block=True):
         return self.cell_queue.get(block=block)
 
-    def main(self):
-        if self.fails > self.max_fails:
-            cells, _, _ = cell_slice(self.recving)
-            for cell in cells:
-                self.cell_queue.put(cell)
-            self.die(RuntimeError('Too many fails, is the socket dead?'))
-
-        try:
-            if len(self.sending) < 1:
-                self.sending = self.send_queue.get(block=False)
-        except queue.Empty:
-            pass
-
-        try:
-            if len(self.sending) > 0:
+    def flush(self):
+        # (write all the queued cells at once)
+        cells = [self.sending]
+        while True:
+            try:
+                cells.append(self.send_queue.get_nowait())
+            except queue.Empty:
+                break
+        self.sending = b''.join(cells)
+
+        while len(self.sending) > 0:
+            try:
                 nbytes = self.peer.send(self.sending)
-                self.fails = self.fails + 1 if nbytes == 0 else 0
-                self.sending = self.sending[nbytes:]
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError,
+                    BlockingIOError):
+                break
+            self.sending = self.sending[nbytes:]
+
+        # (wait for the socket to be writable only if needed)
+        events = selectors.EVENT_READ
+        if len(self.sending) > 0:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.selector.modify(self.peer, events)
+            self.events = events
+
+    def fill(self):
+        while True:
+            try:
+                payload = self.peer.recv(self.buffer_size)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError,
+                    BlockingIOError):
+                break
+
+            if len(payload) == 0: # (connection closed by peer)
+                self.close()
                 return
-        except (socket.timeout, ssl.SSLError, BlockingIOError):
-            pass
 
-        try:
-            payload = self.peer.recv(self.buffer_size)
-            self.fails = self.fails + 1 if len(payload) == 0 else 0
-            self.recv_queue.put(payload)
-            if self.recv_queue.qsize() < self.max_queue // 4:
-                return
-        except (socket.timeout, ssl.SSLError, BlockingIOError):
-            pass
-
-        try:
-            if ((len(self.recving) < 1 or self.celling)
-                and len(self.recving) <= lnn.constants.max_payload_len):
-                self.recving += self.recv_queue.get(block=False)
-                self.celling = False
-        except queue.Empty:
-            pass
-
-        if len(self.recving) > 0 and not self.celling:
-            cells, self.recving, self.celling = cell_slice(self.recving)
-            for cell in cells:
-                self.cell_queue.put(cell)
+            self.buffer.feed(payload)
+            for cell in self.buffer.cells():
+                self.cell_queue.put(bytes(cell))
 
     def run(self):
+        self.peer.setblocking(False)
         try:
             while not self.dead:
-                self.main()
+                for key, events in self.selector.select():
+                    if key.fileobj is self.waiter:
+                        try:
+                            self.waiter.recv(self.buffer_size)
+                        except BlockingIOError:
+                            pass
+                    elif events & selectors.EVENT_READ:
+                        self.fill()
+
+                if not self.dead:
+                    self.flush()
             self.dead = True
         except BaseException as e:
             self.die(e)
+        finally:
+            self.selector.close()
+            self.waiter.close()
+            self.waker.close()
 
 class io:
     _join_timeout = 3
@@ -173,14 +166,11 @@ class io:
     def __init__(self,
             peer,
             daemon=True,
-            period=0.01,
-            max_fails=32,
             max_queue=2048,
-            buffer_size=4096):
-        peer.settimeout(period)
+            buffer_size=65536):
         # peer = _stat_peer(peer) # uncomment for extra statistics
 
-        self.worker = worker(peer, max_fails, max_queue, buffer_size)
+        self.worker = worker(peer, max_queue, buffer_size)
         if daemon:
             self.worker.daemon = True
 
@@ -205,7 +195,7 @@ class io:
         return self.peer.get_channel_binding()
 
     def close(self):
-        self.peer.close()
-
         self.worker.close()
         self.worker.join(self._join_timeout)
+
+        self.peer.close()
@@ -0,0 +1,39 @@
+import os
+import zlib
+
+import lightnion as lnn
+
+_fixture = os.path.join(os.path.dirname(__file__), '..', '..', 'js-client',
+    'demo', 'descriptors_2019-01-10')
+
+
+def _answer(count=50):
+    with open(_fixture, 'rb') as f:
+        descriptors = f.read().replace(b'@type server-descriptor 1.0\n', b'')
+
+    # (only the first descriptors, the reference parser is slow)
+    end = 0
+    for _ in range(count):
+        end = descriptors.index(b'\nrouter ', end + 1)
+    return b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n' + descriptors[:end + 1]
+
+
+def test_incremental_parser_matches_parse_descriptors():
+    answer = _answer()
+    expected, remaining = lnn.descriptors.parse_descriptors(answer, 'unflavored')
+    assert remaining == b''
+
+    parser = lnn.descriptors.incremental_parser('unflavored')
+    descriptors = []
+    width = lnn.cell.relay.payload_len
+    for offset in range(0, len(answer), width):
+        descriptors += parser.feed(answer[offset:offset + width])
+    descriptors += parser.close()
+
+    assert descriptors == expected['descriptors']
+    assert parser.http == expected['http']
+
+
+def test_zlib_decompress():
+    data = _answer(5)
+    assert lnn.hop.zlib_decompress(zlib.compress(data)) == data
@@ -0,0 +1,67 @@
+import threading
+import asyncio
+import base64
+import time
+import os
+
+import lightnion as lnn
+
+
+def _relay(**kwargs):
+    from benchmark import fake_relay
+
+    ready = []
+
+    async def serve():
+        relay = fake_relay.relay(**kwargs)
+        await relay.start()
+        ready.append(relay)
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    while len(ready) == 0:
+        time.sleep(0.01)
+    return ready[0]
+
+
+def _paths(relay, count):
+    paths = [[relay.guard] for _ in range(count)]
+
+    # (wrong onion key, the relay answers with a DESTROY cell)
+    onion_key = str(base64.b64encode(os.urandom(32)), 'utf8')
+    paths[1] = [dict(relay.guard, **{'ntor-onion-key': onion_key})]
+    return paths
+
+
+def test_build_circuits_pipelines_round_trips():
+    relay = _relay(delay=0.05)
+    link = lnn.link.initiate(relay.host, relay.port)
+
+    start = time.perf_counter()
+    results = lnn.extend.build_circuits(link, _paths(relay, 20), concurrency=10)
+    elapsed = time.perf_counter() - start
+
+    assert [result.ok for result in results] == [True, False] + [True] * 18
+    assert len(set([result.state.circuit.id for result in results
+        if result.ok])) == 19
+    assert all([len(result.timings) == 1 for result in results if result.ok])
+    assert results[1].state is None
+    assert len(link.circuits) == 1 + 19
+
+    # (two batches of round trips instead of twenty)
+    assert elapsed < 20 * 0.05 / 2
+    link.close()
+
+
+def test_build_circuits_async():
+    relay = _relay()
+
+    async def scenario():
+        async with lnn.link.initiate_async(relay.host, relay.port) as link:
+            results = await lnn.extend.build_circuits_async(link,
+                _paths(relay, 20), concurrency=4)
+            assert [result.ok for result in results] == (
+                [True, False] + [True] * 18)
+            assert len(link.circuits) == 1 + 19
+
+    asyncio.run(scenario())
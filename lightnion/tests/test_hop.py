@@ -0,0 +1,200 @@
+import asyncio
+import queue
+import time
+import zlib
+
+import pytest
+
+import lightnion as lnn
+
+from .test_onion import _states
+
+
+class _link:
+    def __init__(self):
+        self.cells = queue.Queue()
+        self.sent = []
+
+    def get(self, circuit, block=True, timeout=None):
+        return self.cells.get(block=block, timeout=timeout)
+
+    def put(self, circuit, payload):
+        self.cells.put(payload)
+
+    def unget(self, circuit, payloads):
+        with self.cells.mutex:
+            self.cells.queue.extendleft(reversed(payloads))
+
+    def send(self, cell):
+        self.sent.append(cell)
+
+
+def _circuit(depth=3):
+    client, relay = _states(depth)
+    link = _link()
+    for layer in client._layers():
+        layer.link = link
+
+    def push(command, payload=b'', stream_id=0):
+        _, cell = lnn.onion.build(relay, command, payload, stream_id)
+        link.cells.put(bytes(cell.raw))
+
+    return client, push
+
+
+def _answer(body):
+    return b'HTTP/1.0 200 OK\r\n\r\n' + zlib.compress(body)
+
+
+def test_parallel_directory_streams():
+    client, push = _circuit()
+    bodies = [b'first' * 2000, b'second' * 3000]
+    answers = [_answer(body) for body in bodies]
+
+    width = lnn.cell.relay.payload_len - 11
+    for stream_id in (1, 2):
+        push(lnn.cell.relay.cmd.RELAY_CONNECTED, stream_id=stream_id)
+
+    # (answers interleaved on the circuit)
+    for offset in range(0, max([len(a) for a in answers]), width):
+        for stream_id, answer in [(2, answers[1]), (1, answers[0])]:
+            if offset < len(answer):
+                push(lnn.cell.relay.cmd.RELAY_DATA,
+                    answer[offset:offset + width], stream_id)
+    for stream_id in (2, 1):
+        push(lnn.cell.relay.cmd.RELAY_END, b'\x06', stream_id)
+
+    streams = lnn.hop.directory_streams(client, ['/tor/first', '/tor/second'])
+    contents = [b''.join(stream) for stream in streams]
+
+    assert contents == [b'HTTP/1.0 200 OK\r\n\r\n' + body for body in bodies]
+    assert client.streams == dict()
+
+
+def test_directory_stream_blocks_until_timeout():
+    client, push = _circuit()
+    push(lnn.cell.relay.cmd.RELAY_CONNECTED, stream_id=1)
+    push(lnn.cell.relay.cmd.RELAY_DATA, b'HTTP/1.0 200 OK\r\n\r\n', 1)
+
+    start, cpu = time.time(), time.process_time()
+    with pytest.raises(RuntimeError):
+        b''.join(lnn.hop.directory_stream(client, '/tor/stalled',
+            compression='identity', timeout=0.5))
+
+    # (no RELAY_END: waits on the link, without spinning meanwhile)
+    assert time.time() - start >= 0.5
+    assert time.process_time() - cpu < 0.25
+
+
+def test_recv_keeps_cells_before_an_unrecognized_one():
+    client, push = _circuit()
+    _, other = _states(3)
+
+    push(lnn.cell.relay.cmd.RELAY_DATA, b'first', 1)
+    _, garbage = lnn.onion.build(other, lnn.cell.relay.cmd.RELAY_DATA, b'', 1)
+    client.link.cells.put(bytes(garbage.raw))
+    push(lnn.cell.relay.cmd.RELAY_DATA, b'after', 1)
+
+    _, cells = lnn.hop.recv(client, auto_sendme=False)
+    assert [cell.relay.data for cell in cells] == [b'first']
+
+    with pytest.raises(RuntimeError):
+        lnn.hop.recv(client, auto_sendme=False)
+
+    _, cells = lnn.hop.recv(client, auto_sendme=False)
+    assert [cell.relay.data for cell in cells] == [b'after']
+
+
+def test_async_directory_query():
+    client, push = _circuit()
+    link = client.link
+
+    async def get_async(circuit, block=True):
+        return link.get(circuit, block=False)
+
+    async def drain():
+        pass
+
+    link.get_async = get_async
+    link.drain = drain
+
+    body = b'answer' * 3000
+    answer = _answer(body)
+    width = lnn.cell.relay.payload_len - 11
+
+    push(lnn.cell.relay.cmd.RELAY_CONNECTED, stream_id=1)
+    for offset in range(0, len(answer), width):
+        push(lnn.cell.relay.cmd.RELAY_DATA, answer[offset:offset + width], 1)
+    push(lnn.cell.relay.cmd.RELAY_END, b'\x06', 1)
+
+    client, content = asyncio.run(
+        lnn.hop.directory_query_async(client, '/tor/answer'))
+
+    assert content == b'HTTP/1.0 200 OK\r\n\r\n' + body
+    assert client.streams == dict()
+
+
+def test_directory_select_reads_ready_streams():
+    client, push = _circuit()
+    bodies = [b'first' * 2000, b'second' * 3000]
+    answers = [_answer(body) for body in bodies]
+
+    width = lnn.cell.relay.payload_len - 11
+    for stream_id in (1, 2):
+        push(lnn.cell.relay.cmd.RELAY_CONNECTED, stream_id=stream_id)
+
+    # (the second answer first, the first one only then)
+    for stream_id, answer in [(2, answers[1]), (1, answers[0])]:
+        for offset in range(0, len(answer), width):
+            push(lnn.cell.relay.cmd.RELAY_DATA,
+                answer[offset:offset + width], stream_id)
+        push(lnn.cell.relay.cmd.RELAY_END, b'\x06', stream_id)
+
+    pieces = list(lnn.hop.directory_select(client,
+        ['/tor/first', '/tor/second']))
+    contents = [b''.join([chunk for index, chunk in pieces if index == i])
+        for i in range(2)]
+
+    assert contents == [b'HTTP/1.0 200 OK\r\n\r\n' + body for body in bodies]
+    assert client.streams == dict()
+
+
+def test_stream_sendme_once_consumed():
+    client, push = _circuit()
+    link = client.link
+    width = lnn.cell.relay.payload_len - 11
+
+    for stream_id in (1, 2):
+        push(lnn.cell.relay.cmd.RELAY_CONNECTED, stream_id=stream_id)
+    push(lnn.cell.relay.cmd.RELAY_DATA, _answer(b'first'), 1)
+    push(lnn.cell.relay.cmd.RELAY_END, b'\x06', 1)
+
+    answer = b'HTTP/1.0 200 OK\r\n\r\n' + bytes(width * 60)
+    for offset in range(0, len(answer), width):
+        push(lnn.cell.relay.cmd.RELAY_DATA, answer[offset:offset + width], 2)
+    push(lnn.cell.relay.cmd.RELAY_END, b'\x06', 2)
+
+    first, second = lnn.hop.directory_streams(client,
+        ['/tor/first', '/tor/second'], compression='identity')
+
+    # (BEGIN_DIR and requests only: the cells of the second stream wait)
+    assert b''.join(first).endswith(zlib.compress(b'first'))
+    assert len(link.sent) == 4
+
+    assert b''.join(second) == answer
+    assert len(link.sent) == 4 + 1
+
+
+def test_stream_buffer_is_bounded():
+    client, push = _circuit()
+    width = lnn.cell.relay.payload_len - 11
+
+    for stream_id in (1, 2):
+        push(lnn.cell.relay.cmd.RELAY_CONNECTED, stream_id=stream_id)
+    for _ in range(lnn.hop.stream_buffer + 1):
+        push(lnn.cell.relay.cmd.RELAY_DATA, bytes(width), 2)
+
+    with pytest.raises(RuntimeError):
+        first, second = lnn.hop.directory_streams(client,
+            ['/tor/first', '/tor/second'], timeout=1)
+        b''.join(first)
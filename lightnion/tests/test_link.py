@@ -0,0 +1,190 @@
+import threading
+import base64
+import asyncio
+import queue
+import time
+import os
+
+import pytest
+
+import lightnion as lnn
+
+
+class _io:
+    def __init__(self):
+        self.cells = queue.Queue()
+        self.sent = []
+        self.dead = False
+
+    def recv(self, block=True):
+        return self.cells.get(block=block)
+
+    def send(self, cell, block=True):
+        self.sent.append(cell)
+
+    def close(self):
+        self.dead = True
+
+
+def _cell(circuit_id, cmd=3):
+    return circuit_id.to_bytes(4, 'big') + bytes([cmd]) + os.urandom(509)
+
+
+def _wait(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_cells_are_dispatched_per_circuit():
+    io = _io()
+    link = lnn.link.link(io, 5)
+    circuits = [lnn.create.circuit(0x80000001 + i, None) for i in range(3)]
+    for circuit in circuits:
+        link.register(circuit)
+
+    cells = [_cell(c.id) for c in reversed(circuits)]
+    for cell in cells:
+        io.cells.put(cell)
+
+    for circuit, cell in zip(reversed(circuits), cells):
+        assert link.get(circuit) == cell
+    assert link.pending == 0
+
+    with pytest.raises(queue.Empty):
+        link.get(circuits[0], block=False)
+
+    start = time.time()
+    with pytest.raises(queue.Empty):
+        link.get(circuits[0], timeout=0.2)
+    assert time.time() - start >= 0.2
+
+    # (get() waits for the dispatcher)
+    cell = _cell(circuits[1].id)
+    threading.Timer(0.05, io.cells.put, [cell]).start()
+    assert link.get(circuits[1]) == cell
+
+    link.close()
+    with pytest.raises(RuntimeError):
+        link.get(circuits[1])
+
+
+def test_early_cells_and_destroy():
+    io = _io()
+    link = lnn.link.link(io, 5)
+    circuit = lnn.create.circuit(0x80000001, None)
+    link.reserve(circuit.id)
+
+    # (answers may be dispatched before their circuit gets registered)
+    created = _cell(circuit.id, int(lnn.cell.cmd.CREATED_FAST))
+    io.cells.put(created)
+    _wait(lambda: link.orphaned == 1)
+
+    link.register(circuit)
+    assert link.get(circuit) == created
+
+    destroy = lnn.cell.pad(circuit.id.to_bytes(4, 'big')
+        + bytes([int(lnn.cell.cmd.DESTROY), 9]))
+    io.cells.put(destroy)
+    _wait(lambda: circuit.destroyed)
+
+    assert circuit.reason is lnn.cell.destroy.reason.FINISHED
+    assert link.pending == 0
+    with pytest.raises(KeyError):
+        link.get(circuit)
+
+
+def test_late_cells_are_dropped():
+    io = _io()
+    link = lnn.link.link(io, 5)
+    circuits = [lnn.create.circuit(0x80000001 + i, None) for i in range(2)]
+    for circuit in circuits:
+        link.register(circuit)
+
+    # (cells still sent by the relay after unregister() or DESTROY)
+    link.unregister(circuits[0])
+    io.cells.put(lnn.cell.pad(circuits[1].id.to_bytes(4, 'big')
+        + bytes([int(lnn.cell.cmd.DESTROY), 9])))
+    _wait(lambda: circuits[1].destroyed)
+
+    for _ in range(link.max_queue + 1):
+        for circuit in circuits:
+            io.cells.put(_cell(circuit.id))
+
+    marker = lnn.create.circuit(0x80000010, None)
+    link.register(marker)
+    io.cells.put(_cell(marker.id))
+    link.get(marker)
+
+    assert link.error is None and link.dispatcher.is_alive()
+    assert link.pending == 0 and link.orphaned == 0
+    assert link.orphans == dict()
+
+
+def test_full_circuit_queue_fails_the_link():
+    io = _io()
+    link = lnn.link.link(io, 5, max_queue=4)
+    circuit = lnn.create.circuit(0x80000001, None)
+    link.register(circuit)
+
+    # (one circuit holding all the pending cells)
+    for _ in range(link.max_queue + 1):
+        io.cells.put(_cell(circuit.id))
+    link.dispatcher.join(timeout=2)
+
+    assert not link.dispatcher.is_alive()
+    assert link.pending == link.max_queue
+    with pytest.raises(RuntimeError):
+        link.get(circuit, timeout=1)
+
+    # (the dispatcher is the only reader of link.io)
+    with pytest.raises(RuntimeError):
+        link.recv()
+
+
+def test_async_link_against_fake_relay():
+    from benchmark import fake_relay
+
+    async def scenario():
+        relay = fake_relay.relay()
+        await relay.start()
+        try:
+            async with lnn.link.initiate_async(relay.host, relay.port) as link:
+                assert link.version == 5
+
+                # (many circuits at once, on the same event loop)
+                states = await asyncio.gather(
+                    lnn.create.fast_async(link),
+                    *[lnn.create.ntor_async(link, relay.guard)
+                        for _ in range(32)])
+                assert len(relay.circuits) == 33
+
+                # (echoed RELAY cells reach their own circuit)
+                for state in states:
+                    await link.send_async(_cell(state.circuit.id))
+                for state in reversed(states):
+                    cell = await link.get_async(state.circuit)
+                    assert lnn.cell.header(cell).circuit_id == state.circuit.id
+                assert link.pending == 0
+
+                # (several readers of the same circuit are all served)
+                circuit = states[0].circuit
+                readers = [asyncio.ensure_future(link.get_async(circuit))
+                    for _ in range(3)]
+                await asyncio.sleep(0.01)
+                for _ in readers:
+                    await link.send_async(_cell(circuit.id))
+                cells = await asyncio.wait_for(asyncio.gather(*readers), 2)
+                assert len(set(cells)) == 3 and link.pending == 0
+
+                # (wrong onion key, the relay answers with a DESTROY cell)
+                onion_key = str(base64.b64encode(os.urandom(32)), 'utf8')
+                guard = dict(relay.guard, **{'ntor-onion-key': onion_key})
+                with pytest.raises(RuntimeError):
+                    await lnn.create.ntor_async(link, guard)
+
+            assert link.dead
+        finally:
+            await relay.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,126 @@
+import collections
+import secrets
+
+import pytest
+
+import lightnion as lnn
+
+
+class _link:
+    pass
+
+
+_material = collections.namedtuple('material', ['forward_key', 'backward_key',
+    'forward_digest', 'backward_digest'])
+
+
+def _states(depth, seeds=None):
+    if seeds is None:
+        seeds = [secrets.token_bytes(32) for _ in range(depth)]
+
+    # (relay side: forward and backward swapped, as seen by the relays)
+    client, relay = None, None
+    for seed in seeds:
+        material = lnn.crypto.kdf_tor(seed)
+        mirror = _material(material.backward_key, material.forward_key,
+            material.backward_digest, material.forward_digest)
+
+        circuit = lnn.create.circuit(0x80000001, material)
+        layer = lnn.onion.state(_link(), circuit)
+        if client is None:
+            client = layer
+        else:
+            client.wrap(layer)
+
+        layer = lnn.onion.state(_link(), lnn.create.circuit(0x80000001, mirror))
+        if relay is None:
+            relay = layer
+        else:
+            relay.wrap(layer)
+
+    return client, relay
+
+
+def _backward(relay, payload):
+    _, cell = lnn.onion.build(relay, lnn.cell.relay.cmd.RELAY_DATA, payload, 1)
+    return lnn.cell.relay.cell(cell.raw)
+
+
+@pytest.mark.parametrize('depth', [1, 2, 3])
+def test_build_and_peel_in_place(depth):
+    client, relay = _states(depth)
+
+    for index in range(12):
+        payload = b'cell %d' % index
+        state, cell = lnn.onion.build(client, lnn.cell.relay.cmd.RELAY_DATA, payload, 1)
+        assert state is client
+
+        state, cell = lnn.onion.peel(client, _backward(relay, payload))
+        assert state is client
+        assert cell.relay.data == payload
+
+    assert client.early_count == 0
+
+
+def test_unrecognized_cell_leaves_state_untouched():
+    client, relay = _states(3)
+    _, other = _states(3)
+
+    with pytest.raises(RuntimeError):
+        lnn.onion.peel(client, _backward(other, b'garbage'))
+
+    _, cell = lnn.onion.peel(client, _backward(relay, b'payload'))
+    assert cell.relay.data == b'payload'
+
+
+def test_checkpoint_and_rollback():
+    client, relay = _states(2)
+    checkpoint = client.checkpoint()
+
+    _, first = lnn.onion.build(client, lnn.cell.relay.cmd.RELAY_DATA, b'data', 1)
+    lnn.onion.peel(client, _backward(relay, b'data'))
+
+    client.rollback(checkpoint)
+    assert client.early_count == 8
+
+    _, again = lnn.onion.build(client, lnn.cell.relay.cmd.RELAY_DATA, b'data', 1)
+    assert again.raw == first.raw
+
+
+def test_build_many_matches_build():
+    seeds = [secrets.token_bytes(32) for _ in range(3)]
+    client, _ = _states(3, seeds)
+    expected, _ = _states(3, seeds)
+
+    payloads = [b'cell %d' % index for index in range(12)]
+    _, cells = lnn.onion.build_many(client, lnn.cell.relay.cmd.RELAY_DATA, payloads, 1)
+
+    assert len(cells) == len(payloads)
+    assert client.early_count == 0
+    for payload, cell in zip(payloads, cells):
+        _, other = lnn.onion.build(expected, lnn.cell.relay.cmd.RELAY_DATA, payload, 1)
+        assert cell.raw == other.raw
+
+
+def test_peel_many():
+    client, relay = _states(3)
+    payloads = [b'cell %d' % index for index in range(12)]
+
+    _, cells = lnn.onion.peel_many(client, [_backward(relay, p) for p in payloads])
+    assert [cell.relay.data for cell in cells] == payloads
+
+    # (one unrecognized cell: the ones before it are still taken)
+    _, other = _states(3)
+    payloads = [b'first', b'second', b'after']
+    batch = [_backward(relay, p) for p in payloads[:2]]
+    batch += [_backward(other, b'garbage'), _backward(relay, payloads[2])]
+    raws = [bytes(cell.raw) for cell in batch]
+    with pytest.raises(lnn.onion.unrecognized) as error:
+        lnn.onion.peel_many(client, batch)
+
+    assert [cell.relay.data for cell in error.value.cells] == payloads[:2]
+    assert [bytes(cell.raw) for cell in error.value.pending] == raws[2:]
+
+    # (the state is rolled back to the failing cell only)
+    _, cell = lnn.onion.peel(client, lnn.cell.relay.cell(raws[3]))
+    assert cell.relay.data == payloads[2]
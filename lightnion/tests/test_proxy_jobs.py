@@ -0,0 +1,297 @@
+import asyncio
+import json
+
+import pytest
+
+import lightnion as lnn
+import lightnion.proxy
+
+
+class _link:
+    guard = {'digest': 'AAAAAAAAAAAAAAAAAAAAAAAAAAA'}
+
+    def __init__(self):
+        self.to_send = lnn.proxy.scheduler.CircuitScheduler(16)
+        self.circuit_id = 0x80000000
+        self.sent = []
+
+    def gen_cid(self):
+        self.circuit_id += 1
+        return self.circuit_id
+
+    async def schedule_to_send(self, cell, channel):
+        self.sent.append((bytes(cell), channel))
+
+
+class _websocket:
+    subprotocol = None
+
+    def __init__(self, frames):
+        self.frames = asyncio.Queue()
+        for frame in frames:
+            self.frames.put_nowait(frame)
+
+        self.sent = []
+        self.closed = False
+
+    async def recv(self):
+        return await self.frames.get()
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def close(self):
+        self.closed = True
+
+
+def _channel_manager(**kwargs):
+    channel_manager = lnn.proxy.jobs.ChannelManager(**kwargs)
+    channel_manager.set_link(_link())
+
+    answer = channel_manager.create_channel(None, None, select_path=True)
+    return channel_manager, channel_manager.get_channel_by_token(answer['id'])
+
+
+def _relay_cell():
+    return bytearray(lnn.proxy.fake_circuit_id.to_bytes(4, 'big')
+        + bytes([int(lnn.cell.cmd.RELAY)]) + bytes(509))
+
+
+def test_overflow_drop_never_blocks():
+    async def scenario():
+        channel_manager, channel = _channel_manager(
+            overflow='drop', channel_queue=4)
+
+        for _ in range(6):
+            await channel_manager.schedule_to_send(_relay_cell(), channel.cid)
+
+        assert channel.to_send.qsize() == 4
+        assert channel.cells_dropped == 2
+        assert not channel.destroyed.is_set()
+
+    asyncio.run(scenario())
+
+
+def test_overflow_destroy_sends_destroy_cell():
+    async def scenario():
+        channel_manager, channel = _channel_manager(
+            overflow='destroy', channel_queue=4)
+
+        for _ in range(6):
+            await channel_manager.schedule_to_send(_relay_cell(), channel.cid)
+
+        assert channel.destroyed.is_set()
+
+        cell = lnn.cell.destroy.cell(
+            bytes(channel_manager.link.to_send.get_nowait()))
+        assert cell.valid
+        assert cell.circuit_id == channel.cid
+        assert cell.reason is lnn.cell.destroy.reason.RESOURCELIMIT
+
+    asyncio.run(scenario())
+
+
+def test_unused_channels_expire():
+    async def scenario():
+        channel_manager, channel = _channel_manager(open_timeout=10, grace=2)
+        timers = channel_manager.timers
+        now = timers.now
+
+        assert timers.advance(now + 5) == []
+        channel_manager.open_channel(channel, 20)
+
+        # (activity postpones the expiration)
+        timers.advance(now + 15)
+        await channel_manager.schedule_to_send(_relay_cell(), channel.cid)
+
+        for cid in timers.advance(now + 30):
+            channel_manager._expire(cid)
+        assert channel.cid in channel_manager.channels
+
+        for cid in timers.advance(now + 36):
+            channel_manager._expire(cid)
+        assert channel.cid not in channel_manager.channels
+        assert channel.destroyed.is_set()
+
+        cell = lnn.cell.destroy.cell(
+            bytes(channel_manager.link.to_send.get_nowait()))
+        assert cell.reason is lnn.cell.destroy.reason.FINISHED
+
+    asyncio.run(scenario())
+
+
+def test_destroyed_channels_are_deleted():
+    async def scenario():
+        channel_manager, channel = _channel_manager(grace=2)
+        now = channel_manager.timers.now
+
+        await channel_manager.destroy_circuit_from_link(channel)
+        for cid in channel_manager.timers.advance(now + 4):
+            channel_manager._expire(cid)
+
+        assert channel.cid not in channel_manager.channels
+        assert channel_manager.link.to_send.empty()
+
+    asyncio.run(scenario())
+
+
+def test_closed_channels_destroy_their_circuit():
+    async def scenario():
+        channel_manager, channel = _channel_manager()
+
+        channel_manager.close_channel(channel)
+        assert channel.cid not in channel_manager.channels
+
+        cell = lnn.cell.destroy.cell(
+            bytes(channel_manager.link.to_send.get_nowait()))
+        assert cell.circuit_id == channel.cid
+        assert cell.reason is lnn.cell.destroy.reason.REQUESTED
+
+        # (only once)
+        channel_manager.close_channel(channel)
+        assert channel_manager.link.to_send.empty()
+
+    asyncio.run(scenario())
+
+
+def test_token_lookup_and_invalid_token_limit():
+    channel_manager, channel = _channel_manager(invalid_tokens=(0.001, 2))
+    token = channel.token
+
+    assert channel_manager.get_channel_by_token(token) is channel
+
+    # (tokens not issued by create_channel are still decrypted)
+    del channel_manager.tokens[token]
+    assert channel_manager.get_channel_by_token(token + '=') is channel
+
+    for garbage in ['short', 'A' * len(token)]:
+        with pytest.raises(lnn.proxy.jobs.InvalidTokenException):
+            channel_manager.get_channel_by_token(garbage)
+
+    with pytest.raises(lnn.proxy.jobs.TooManyInvalidTokensException):
+        channel_manager.get_channel_by_token(token + '=')
+
+    channel_manager.tokens[token] = channel
+    assert channel_manager.get_channel_by_token(token) is channel
+
+
+def test_tokens_are_routed_to_their_worker():
+    key, binding = bytes(16), bytes(32)
+    workers = [lnn.proxy.workers.Worker(wid, 2, 15000, key, binding)
+        for wid in range(2)]
+    managers = [lnn.proxy.jobs.ChannelManager(crypto=worker.crypto)
+        for worker in workers]
+    for manager in managers:
+        manager.set_link(_link())
+
+    token = managers[1].create_channel(None, None, select_path=True)['id']
+    assert [worker.owner(token) for worker in workers] == [1, 1]
+    assert workers[0].websocket_port(1) == 15003
+
+    del managers[1].tokens[token]
+    assert managers[1].get_channel_by_token(token).token == token
+    with pytest.raises(lnn.proxy.jobs.InvalidTokenException):
+        managers[0].get_channel_by_token(token)
+
+
+def test_link_drops_invalid_client_cells():
+    async def scenario():
+        guard = {'router': {
+            'address': '127.0.0.1', 'orport': 9001, 'nickname': 'guard'}}
+        link = lnn.proxy.link.Link(guard)
+        link.connection.close()
+
+        channel_manager, channel = _channel_manager()
+        header = lnn.proxy.fake_circuit_id.to_bytes(4, 'big')
+        relay = header + bytes([int(lnn.cell.cmd.RELAY)])
+        versions = header + bytes([int(lnn.cell.cmd.VERSIONS)])
+
+        invalid = [
+            header + bytes([42]) + bytes(509),
+            versions + b'\xff',
+            versions + b'\xff\xff' + bytes(16),
+            versions + b'\x00\x02\x00\x04',
+            relay + bytes(510)]
+        for cell in invalid:
+            await link.schedule_to_send(cell, channel)
+        assert link.to_send.qsize() == 0
+
+        await link.schedule_to_send(relay + bytes(16), channel)
+        cell = link.to_send.get_nowait()
+        assert len(cell) == lnn.constants.full_cell_len
+        assert lnn.utils.cell_get_cid(cell) == channel.cid
+
+    asyncio.run(scenario())
+
+
+def test_oneshot_websocket_creates_its_channel():
+    async def scenario():
+        channel_manager = lnn.proxy.jobs.ChannelManager()
+        channel_manager.set_link(_link())
+
+        def factory(select_path, auth):
+            assert select_path and auth is None
+            answer = channel_manager.create_channel(None, None, select_path)
+            return answer['id'], json.dumps(answer)
+
+        websocket_manager = lnn.proxy.jobs.WebsocketManager()
+        websocket_manager.set_channel_manager(channel_manager)
+        websocket_manager.set_channel_factory(factory)
+
+        create2 = lnn.create.ntor_raw2(lnn.proxy.fake_circuit_id, bytes(84))
+        ws = _websocket([create2])
+        handler = asyncio.ensure_future(websocket_manager.handle(ws,
+            lnn.proxy.base_url + '/channels?select_path=true'))
+        await asyncio.sleep(0.01)
+
+        info = json.loads(ws.sent[0])
+        channel = channel_manager.get_channel_by_token(info['id'])
+        assert channel_manager.link.sent == [(create2, channel)]
+
+        await channel_manager.destroy_circuit_from_link(channel)
+        await handler
+        assert ws.closed and channel.cid not in channel_manager.channels
+
+    asyncio.run(scenario())
+
+
+def test_oneshot_websocket_keeps_plus_in_auth():
+    async def scenario(query):
+        channel_manager = lnn.proxy.jobs.ChannelManager()
+        channel_manager.set_link(_link())
+        auths = []
+
+        def factory(select_path, auth):
+            auths.append(auth)
+            answer = channel_manager.create_channel(None, None, select_path)
+            return answer['id'], json.dumps(answer)
+
+        websocket_manager = lnn.proxy.jobs.WebsocketManager()
+        websocket_manager.set_channel_manager(channel_manager)
+        websocket_manager.set_channel_factory(factory)
+
+        ws = _websocket([])
+        handler = asyncio.ensure_future(websocket_manager.handle(ws,
+            lnn.proxy.base_url + '/channels?select_path=true&' + query))
+        await asyncio.sleep(0.01)
+
+        channel = channel_manager.get_channel_by_token(
+            json.loads(ws.sent[0])['id'])
+        await channel_manager.destroy_circuit_from_link(channel)
+        await handler
+        return auths[0]
+
+    # (as sent by clients, either raw or percent-encoded)
+    assert asyncio.run(scenario('auth=a+b/c+d==')) == 'a+b/c+d=='
+    assert asyncio.run(scenario('auth=a%2Bb%2Fc%2Bd%3D%3D')) == 'a+b/c+d=='
+
+
+def test_json_cache_matches_json():
+    guard = {'digest': 'G', 'router': {'nickname': 'guard', 'orport': 9001}}
+    path = [{'digest': 'M', 'bandwidth': [1, 2]}, {'digest': 'E', 'x': None}]
+    answer = {'id': 'token', 'path': path, 'guard': guard}
+
+    cache = lnn.proxy.parts.json_cache()
+    assert json.loads(cache.dumps(answer)) == answer
+    assert cache.fragment(guard) is cache.fragment(dict(guard))
+    assert set(cache.fragments) == {'G', 'M', 'E'}
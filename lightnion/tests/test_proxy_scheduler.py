@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import lightnion as lnn
+import lightnion.proxy
+
+
+def _cell(circuit_id, tag=0):
+    return bytearray(circuit_id.to_bytes(4, 'big')
+        + bytes([int(lnn.cell.cmd.RELAY), tag]) + bytes(508))
+
+
+def _order(scheduler):
+    order = []
+    while not scheduler.empty():
+        cell = scheduler.get_nowait()
+        order.append(lnn.utils.cell_header_unpack(cell)[0])
+    return order
+
+
+def test_circuits_are_served_in_turn():
+    scheduler = lnn.proxy.scheduler.CircuitScheduler()
+
+    for _ in range(100):
+        scheduler.put_nowait(_cell(1))
+    scheduler.put_nowait(_cell(2))
+    scheduler.put_nowait(_cell(2))
+
+    assert _order(scheduler)[:5] == [1, 2, 1, 2, 1]
+
+
+def test_cells_of_a_circuit_keep_their_order():
+    scheduler = lnn.proxy.scheduler.CircuitScheduler()
+
+    for tag in range(10):
+        scheduler.put_nowait(_cell(1, tag))
+        scheduler.put_nowait(_cell(2, tag))
+
+    cells = [scheduler.get_nowait() for _ in range(20)]
+    for cid in [1, 2]:
+        tags = [cell[5] for cell in cells if lnn.utils.cell_header_unpack(cell)[0] == cid]
+        assert tags == list(range(10))
+
+
+def test_weights_and_control_cells():
+    scheduler = lnn.proxy.scheduler.CircuitScheduler()
+    scheduler.set_weight(1, 3)
+
+    for _ in range(6):
+        scheduler.put_nowait(_cell(1))
+        scheduler.put_nowait(_cell(2))
+    scheduler.put_nowait(_cell(0))
+
+    assert scheduler.depths() == {0: 1, 1: 6, 2: 6}
+    assert _order(scheduler)[:6] == [0, 1, 1, 1, 2, 1]
+
+
+def test_queue_interface():
+    async def scenario():
+        scheduler = lnn.proxy.scheduler.CircuitScheduler(maxsize=2)
+        scheduler.put_nowait(_cell(1))
+        scheduler.put_nowait(_cell(2))
+
+        with pytest.raises(asyncio.QueueFull):
+            scheduler.put_nowait(_cell(3))
+
+        putter = asyncio.ensure_future(scheduler.put(_cell(3)))
+        await asyncio.sleep(0)
+        assert not putter.done()
+
+        cells = await lnn.proxy.parts.drain(scheduler, 4096)
+        await putter
+        assert len(cells) == 2 and scheduler.qsize() == 1
+
+        assert lnn.utils.cell_header_unpack(await scheduler.get())[0] == 3
+        with pytest.raises(asyncio.QueueEmpty):
+            scheduler.get_nowait()
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+import lightnion as lnn
+import lightnion.proxy
+
+
+def _wheel(**kwargs):
+    wheel = lnn.proxy.timers.TimerWheel(**kwargs)
+    return wheel, wheel.now
+
+
+def test_timers_expire_in_order():
+    wheel, now = _wheel()
+    wheel.arm('a', 3)
+    wheel.arm('b', 1)
+
+    assert wheel.advance(now + 0.5) == []
+    assert wheel.advance(now + 2.5) == ['b']
+    assert wheel.advance(now + 4) == ['a']
+    assert len(wheel) == 0
+
+
+def test_touch_and_cancel():
+    wheel, now = _wheel()
+    wheel.arm('a', 2)
+    wheel.arm('b', 2)
+    wheel.arm('c', 2)
+
+    wheel.advance(now + 1)
+    wheel.touch('a', 5)
+    wheel.cancel('b')
+    wheel.touch('unknown', 5)
+
+    assert wheel.advance(now + 4) == ['c']
+    assert 'a' in wheel and 'unknown' not in wheel
+    assert wheel.advance(now + 7) == ['a']
+
+
+def test_rearm_earlier_and_long_delays():
+    wheel, now = _wheel(slots=8)
+    wheel.arm('a', 100)
+    wheel.arm('b', 100)
+    wheel.arm('a', 2)
+
+    assert wheel.advance(now + 3) == ['a']
+    for delta in range(4, 100):
+        assert wheel.advance(now + delta) == []
+    assert wheel.advance(now + 101) == ['b']
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+import pytest
+import websockets.exceptions
+
+import lightnion as lnn
+import lightnion.proxy
+from lightnion.proxy import trace
+
+from .test_proxy_jobs import _websocket, _channel_manager, _relay_cell
+
+
+class _closing_websocket(_websocket):
+    async def recv(self):
+        if self.frames.empty():
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        return await super().recv()
+
+
+@pytest.fixture(autouse=True)
+def disabled():
+    yield
+    trace.disable()
+    trace.logger.setLevel(logging.NOTSET)
+
+
+@pytest.fixture
+def hexdumps(monkeypatch):
+    formatted = []
+    def __str__(self):
+        formatted.append(self.data)
+        return self.data.hex()
+
+    monkeypatch.setattr(trace.hexdump, '__str__', __str__)
+    return formatted
+
+
+def _recv(cells):
+    async def scenario():
+        channel_manager, channel = _channel_manager()
+        websocket_manager = lnn.proxy.jobs.WebsocketManager()
+        websocket_manager.set_channel_manager(channel_manager)
+
+        await websocket_manager._recv(_closing_websocket(cells), channel)
+        return channel_manager.link.sent
+
+    return asyncio.run(scenario())
+
+
+def test_one_cell_in_period_is_traced(caplog):
+    trace.enable(4)
+    with caplog.at_level(logging.INFO, logger=trace.logger.name):
+        sent = _recv([_relay_cell() for _ in range(10)])
+
+    assert len(sent) == 10
+    assert [record.args[0] for record in caplog.records] == [4, 8]
+    assert bytes(_relay_cell()[:20]).hex() in caplog.records[0].getMessage()
+
+
+def test_nothing_is_formatted_while_disabled(caplog, hexdumps, monkeypatch):
+    def cell(*args):
+        raise AssertionError('traced while disabled')
+    monkeypatch.setattr(trace, 'cell', cell)
+
+    trace.disable()
+    with caplog.at_level(logging.DEBUG, logger=trace.logger.name):
+        sent = _recv([_relay_cell() for _ in range(10)])
+
+    assert len(sent) == 10
+    assert caplog.records == [] and hexdumps == []
+
+
+def test_hexdump_is_lazy(hexdumps):
+    trace.enable(1, level=logging.WARNING)
+    trace.cell('recv by wbskt', 1, _relay_cell())
+
+    assert hexdumps == []
+    with pytest.raises(ValueError):
+        trace.enable(0)
@@ -0,0 +1,32 @@
+import socket
+import os
+
+import lightnion as lnn
+
+
+def _cell(circuit_id=0x80000001, cmd=3):
+    return circuit_id.to_bytes(4, 'big') + bytes([cmd]) + os.urandom(509)
+
+
+def test_io_moves_cells_both_ways():
+    peer, remote = socket.socketpair()
+    remote.settimeout(2)
+    io = lnn.socket.io(peer)
+
+    cells = [_cell() for _ in range(64)]
+    data = b''.join(cells)
+    remote.sendall(data[:1000])
+    remote.sendall(data[1000:])
+    assert [io.recv() for _ in cells] == cells
+
+    for cell in cells:
+        io.send(cell)
+    received = b''
+    while len(received) < len(data):
+        received += remote.recv(65536)
+    assert received == data
+
+    # (the worker stops once the other end is gone)
+    remote.close()
+    io.worker.join(2)
+    assert io.dead
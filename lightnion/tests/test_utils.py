@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import lightnion as lnn
+import lightnion.utils
+import lightnion.proxy
+
+
+def _fixed_cell(circuit_id=0x80000001, cmd=3):
+    return circuit_id.to_bytes(4, 'big') + bytes([cmd]) + os.urandom(509)
+
+
+def _variable_cell(length, circuit_id=0x80000001, cmd=128):
+    return (circuit_id.to_bytes(4, 'big') + bytes([cmd])
+        + length.to_bytes(2, 'big') + os.urandom(length))
+
+
+def test_cell_buffer_slices_partial_reads():
+    cells = [_fixed_cell(), _variable_cell(0), _variable_cell(700),
+        _fixed_cell(cmd=4), _variable_cell(3)] * 20
+    stream = b''.join(cells)
+
+    buffer = lnn.utils.cell_buffer(compact_size=1024)
+    sliced = []
+    for offset in range(0, len(stream), 333):
+        buffer.feed(stream[offset:offset + 333])
+        for cell in buffer.cells():
+            sliced.append(bytes(cell))
+
+    assert sliced == cells
+    assert len(buffer) == 0
+
+
+def test_cell_buffer_keeps_incomplete_cell():
+    cell = _fixed_cell()
+
+    buffer = lnn.utils.cell_buffer()
+    buffer.feed(cell[:100])
+    assert list(buffer.cells()) == []
+
+    buffer.feed(cell[100:])
+    assert [bytes(c) for c in buffer.cells()] == [cell]
+
+
+def test_cell_buffer_rejects_invalid_header():
+    buffer = lnn.utils.cell_buffer()
+    buffer.feed(_fixed_cell(cmd=42))
+
+    with pytest.raises(lnn.utils.InvalidCellHeaderException):
+        list(buffer.cells())
+
+
+def test_cell_slice_and_length():
+    cells = [_variable_cell(700), _fixed_cell()]
+    stream = b''.join(cells)
+
+    assert lnn.utils.cell_length(stream[:6]) is None
+    assert lnn.utils.cell_length(stream) == len(cells[0])
+    assert lnn.utils.cell_length(stream, len(cells[0])) == len(cells[1])
+
+    assert lnn.utils.cell_slice(stream[:500]) == (None, stream[:500])
+    assert lnn.utils.cell_slice(stream) == (cells[0], cells[1])
+
+
+def test_cell_header_codec_in_place():
+    cell = bytearray(_fixed_cell(circuit_id=0x80000042, cmd=4))
+
+    assert lnn.utils.cell_header_unpack(cell) == (0x80000042, 4)
+
+    lnn.utils.cell_set_cid_inplace(cell, lnn.proxy.fake_circuit_id)
+    header = lnn.cell.header(bytes(cell))
+    assert header.circuit_id == lnn.proxy.fake_circuit_id
+    assert header.cmd is lnn.cell.cmd.DESTROY
+
+
+def test_cell_pad_null_matches_view_padding():
+    fixed = _fixed_cell()[:42]
+    variable = _variable_cell(10)[:12]
+
+    for cell in [fixed, variable]:
+        assert lnn.utils.cell_pad_null(cell) == lnn.cell.pad(cell)
@@ -1,5 +1,6 @@
 import lightnion as lnn
 import socket
+import struct
 import time
 import os
 
@@ -32,9 +33,32 @@ cell_cmd_to_string = {
     132: "AUTHORIZE"
 }
 
+# Precompiled codecs for the (circuit_id, cmd) header of link cells.
+cell_header_struct = struct.Struct('>IB')
+cell_cid_struct = struct.Struct('>I')
+
 def cell_to_str(cell):
     return cell[:20].hex()
 
+
+def cell_header_unpack(cell, offset=0):
+    """Read the header of a cell without building any view.
+    :param cell: bytes-like object
+    :param offset: offset of the cell within the buffer
+    :returns: a tuple (circuit_id, cmd)
+    """
+    return cell_header_struct.unpack_from(cell, offset)
+
+
+def cell_set_cid_inplace(cell, cid, offset=0):
+    """Overwrite the circuit id of a cell in place.
+    :param cell: bytearray (or writable buffer)
+    :param cid: new circuit id
+    :param offset: offset of the cell within the buffer
+    """
+    cell_cid_struct.pack_into(cell, offset, cid)
+
+
 def cell_get_cid(cell):
     return int.from_bytes(cell[0:4], 'big')
 
@@ -59,11 +83,14 @@ def cell_version_get_len(cell):
     return int.from_bytes(cell[3:5], 'big')
 
 
+def cell_full_len(cell):
+    if cell_is_variable_length(cell_get_cmd(cell)):
+        return 7 + cell_get_len(cell)
+    return lnn.constants.full_cell_len
+
+
 def cell_pad_rnd(cell):
-    if cell_is_variable_length(cmd):
-        cell_len = 7 + cell_get_len(payload)
-    else:
-        cell_len = 514
+    cell_len = cell_full_len(cell)
 
     if cell_len > len(cell):
         return cell + os.urandom(cell_len - len(cell))
@@ -72,13 +99,10 @@ def cell_pad_rnd(cell):
 
 
 def cell_pad_null(cell):
-    if cell_is_variable_length(cmd):
-        cell_len = 7 + cell_get_len(payload)
-    else:
-        cell_len = 514
+    cell_len = cell_full_len(cell)
 
     if cell_len > len(cell):
-        return cell + bytearray(cell_len - len(cell))
+        return cell + bytes(cell_len - len(cell))
     else:
         return cell
 
@@ -157,27 +181,40 @@ def cell_netinfo_build(host):
     return cell
 
 
-def cell_slice(payload):
-    """Retrieve the next cell from the payload and truncate that one.
-    :param payload: bytearray
+def cell_length(payload, offset=0):
+    """Length of the cell starting at `offset` in the payload.
+    :param payload: bytes-like object
+    :param offset: where the cell starts
+    :returns: length of the cell, None if its header is incomplete
     """
-    payload_len = len(payload)
-    if payload_len < 7: # (payload too small, need data)
-        return None, payload
+    if len(payload) - offset < 5:
+        return None
 
-    cmd = cell_get_cmd(payload)
+    cmd = payload[offset + 4]
+    if cmd not in cell_cmd_to_string:
+        raise InvalidCellHeaderException(bytes(payload[offset:offset+5]))
 
-    if cell_is_variable_length(cmd):
-        cell_len = 7 + cell_get_len(payload)
-    else:
-        cell_len = 514
+    if not cell_is_variable_length(cmd):
+        return lnn.constants.full_cell_len
+
+    if len(payload) - offset < 7:
+        return None
+
+    length = 7 + int.from_bytes(payload[offset+5:offset+7], 'big')
+    if length > lnn.constants.max_payload_len:
+        raise InvalidCellLengthException()
+    return length
 
-    if payload_len < cell_len:
-        return None, payload
 
-    cell = payload[:cell_len]
+def cell_slice(payload):
+    """Retrieve the next cell from the payload and truncate that one.
+    :param payload: bytearray
+    """
+    cell_len = cell_length(payload)
+    if cell_len is None or len(payload) < cell_len:
+        return None, payload
 
-    return cell, payload[cell_len:]
+    return payload[:cell_len], payload[cell_len:]
 
 
 #def cell_version_slice(payload):
@@ -195,35 +232,64 @@ def cell_slice(payload):
 #    return cell, payload[cell_len:]
 
 
-def cell_slice_old(payload):
-    """Retrieve the next cell from the payload and truncate that one.
-    :param payload: bytearray
-    """
-    cell_header = lnn.cell.header(payload)
-    if len(payload) < cell_header.width: # (payload too small, need data)
-        return None, payload
-
-    if not cell_header.valid:
-        raise InvalidCellHeaderException(cell_header.raw)
-
-    length = cell_header.width + lnn.constants.payload_len
-    if not cell_header.cmd.is_fixed:
-        cell_header = lnn.cell.header_variable(payload)
-        if len(payload) < cell_header.width: # (payload too small, need data)
-            return None, payload
-
-        if not cell_header.valid:
-            raise InvalidCellHeaderException(cell_header.raw)
-
-        length = cell_header.width + cell_header.length
+class cell_buffer:
+    """Accumulate raw link data and cut it into cells without copying.
 
-    if length > lnn.constants.max_payload_len:
-        raise InvalidCellLengthException()
+    Received data is appended to a bytearray and cells are read from an
+    offset that moves forward, the consumed bytes being reclaimed only once
+    they are numerous enough (or when the buffer is empty).
 
-    if len(payload) < length:
-        return None, payload
+    Usage::
 
-    cell = payload[:length]
-
-    return cell, payload[length:]
+      >>> buffer = lnn.utils.cell_buffer()
+      >>> buffer.feed(data)
+      >>> for cell in buffer.cells():
+      ...     handle(bytes(cell))
 
+    *Note: cells are memoryview of the buffer, only valid until next feed().*
+    """
+    def __init__(self, compact_size=65536):
+        self.compact_size = compact_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    @property
+    def pending(self):
+        """Bytes received but not yet sliced into cells."""
+        return memoryview(self._buffer)[self._offset:]
+
+    def feed(self, data):
+        """Append received data to the buffer.
+        :param data: bytes-like object
+        """
+        try:
+            if self._offset > 0 and (self._offset >= self.compact_size
+                    or self._offset == len(self._buffer)):
+                del self._buffer[:self._offset]
+                self._offset = 0
+            self._buffer += data
+        except BufferError:
+            # (a cell is still referenced somewhere, reallocate the buffer)
+            self._buffer = self._buffer[self._offset:] + data
+            self._offset = 0
+
+    def cells(self):
+        """Yield every complete cell available in the buffer.
+        :returns: generator of memoryview
+        """
+        buffer = self._buffer
+        view = memoryview(buffer)
+        size = len(buffer)
+
+        offset = self._offset
+        while True:
+            length = cell_length(buffer, offset)
+            if length is None or size - offset < length:
+                break
+
+            self._offset = offset + length
+            yield view[offset:offset+length]
+            offset = self._offset